@@ -0,0 +1,151 @@
+"""
+识别后端对比基准测试
+
+在同一批音频样本上依次测试各识别后端（main.py 中的 ASR_BACKENDS），每个后端在独立子进程中运行，
+互不影响内存统计。对每个后端报告：
+
+- 模型加载耗时
+- 实时率（RTF）：识别总耗时 / 音频总时长，逐段转写、不含加载和预热
+- 峰值常驻内存（子进程的 ru_maxrss）
+- 字错率（CER）：与样本同名 .txt 参考文本对比，规范化（去标点、统一全半角）后按字计算；
+  没有参考文本的样本不计入
+
+样本目录与 load_test.py 相同，可用 benchmarks/make_fixtures.py 生成或放入自己的录音。
+
+用法:
+    python benchmarks/asr_backends.py --backends whisper,faster-whisper --output asr_backends.json
+    python benchmarks/asr_backends.py --model base --threads 4 --profile fast
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from load_test import DEFAULT_FIXTURES, ROOT_DIR, load_fixtures
+
+
+def edit_distance(a, b):
+    """字符级编辑距离"""
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        previous = current
+    return previous[-1]
+
+
+def run_backend(args):
+    """子进程：加载一个后端并逐段转写全部样本，结果以JSON输出到标准输出"""
+    os.environ["LOG_FILE"] = ""
+    sys.path.insert(0, ROOT_DIR)
+    import main
+
+    config = main.asr_worker_config()
+    config.update({
+        "backend": args.run_backend,
+        "model": args.model or config["model"],
+        "threads": args.threads,
+        "warmup": False,
+    })
+    profile = args.profile or main.ASR_PROFILE
+    if profile not in main.ASR_PROFILES:
+        raise SystemExit(f"未知的识别档位: {profile}，可用: {', '.join(main.ASR_PROFILES)}")
+    # 与服务端相同：档位的解码参数加上语言，各后端使用完全相同的参数
+    options = main.asr_profile_options(profile)
+    options["language"] = "zh"
+    # threads 不是解码参数，与识别进程（_transcribe_batch_in_worker）一样先取出设置推理线程数
+    threads = options.pop("threads", 0)
+    fixtures = load_fixtures(args.fixtures, args.ffmpeg)
+
+    started = time.perf_counter()
+    backend = main.create_asr_backend(config)
+    load_seconds = time.perf_counter() - started
+    backend.set_threads(threads)
+    backend.transcribe(np.zeros(main.SAMPLE_RATE, dtype=np.float32), options)
+
+    results, errors, reference_chars, asr_seconds = [], 0, 0, 0.0
+    for fixture in fixtures:
+        audio = np.frombuffer(fixture.pcm, np.int16).astype(np.float32) / 32768.0
+        started = time.perf_counter()
+        text = backend.transcribe(audio, options).strip()
+        elapsed = time.perf_counter() - started
+        asr_seconds += elapsed
+        entry = {"fixture": fixture.name, "seconds": elapsed, "rtf": elapsed / fixture.duration, "text": text}
+        reference = main.ResponseCache.normalize(fixture.reference or "")
+        if reference:
+            distance = edit_distance(main.ResponseCache.normalize(text), reference)
+            entry["cer"] = distance / len(reference)
+            errors += distance
+            reference_chars += len(reference)
+        results.append(entry)
+
+    audio_seconds = sum(f.duration for f in fixtures)
+    report = {
+        "backend": backend.describe(),
+        "model": config["model"],
+        "profile": profile,
+        "options": options,
+        # 档位指定的推理线程数，0 表示使用 --threads（同为0时为后端默认值）
+        "threads": threads or args.threads,
+        "load_seconds": load_seconds,
+        "audio_seconds": audio_seconds,
+        "rtf": asr_seconds / audio_seconds if audio_seconds else None,
+        # Linux 上 ru_maxrss 的单位为KB
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "cer": errors / reference_chars if reference_chars else None,
+        "fixtures": results,
+    }
+    print(json.dumps(report, ensure_ascii=False))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="识别后端对比基准测试")
+    parser.add_argument("--backends", default="whisper,faster-whisper", help="逗号分隔的后端名")
+    parser.add_argument("--model", help="模型大小，默认使用 WHISPER_MODEL")
+    parser.add_argument("--profile", help="识别档位（main.py 中的 ASR_PROFILES），默认使用 ASR_PROFILE")
+    parser.add_argument("--threads", type=int, default=0, help="每个后端的推理线程数，0表示默认值")
+    parser.add_argument("--fixtures", default=DEFAULT_FIXTURES, help="音频样本目录")
+    parser.add_argument("--ffmpeg", default=os.getenv("FFMPEG_BINARY", "ffmpeg"), help="ffmpeg可执行文件")
+    parser.add_argument("--output", default="asr_backends_results.json", help="结果JSON文件")
+    parser.add_argument("--run-backend", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run_backend:
+        run_backend(args)
+        return
+
+    reports = {}
+    for name in [name.strip() for name in args.backends.split(",") if name.strip()]:
+        command = [
+            sys.executable, os.path.abspath(__file__), "--run-backend", name,
+            "--threads", str(args.threads), "--fixtures", args.fixtures, "--ffmpeg", args.ffmpeg,
+        ]
+        if args.model:
+            command += ["--model", args.model]
+        if args.profile:
+            command += ["--profile", args.profile]
+        process = subprocess.run(command, capture_output=True, text=True)
+        if process.returncode != 0:
+            print(f"{name}: 运行失败\n{process.stderr.strip()}")
+            reports[name] = {"error": process.stderr.strip().splitlines()[-1:]}
+            continue
+        report = json.loads(process.stdout.strip().splitlines()[-1])
+        reports[name] = report
+        cer = f"{report['cer']:.3f}" if report["cer"] is not None else "-"
+        print(
+            f"{name:16s} 档位={report['profile']} 线程={report['threads'] or '默认'} RTF={report['rtf']:.3f} 峰值内存={report['peak_rss_mb']:.0f}MB "
+            f"CER={cer} 加载={report['load_seconds']:.1f}秒"
+        )
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(reports, f, indent=2, ensure_ascii=False)
+    print(f"结果已写入 {args.output}")
+
+
+if __name__ == "__main__":
+    main()
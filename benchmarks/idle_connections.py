@@ -0,0 +1,152 @@
+"""
+空闲WebSocket连接的CPU开销基准测试
+
+对比两种接收循环在大量空闲连接下的服务端CPU占用：
+- legacy: 旧版 websocket_endpoint 的轮询写法（receive_text 超时0.1秒 + receive_bytes + sleep）
+- event:  main.py 中当前的 websocket_endpoint（单次 websocket.receive() 事件驱动）
+
+服务端在独立子进程中运行，通过 /cpu 接口报告自身的进程CPU时间，
+客户端打开N个连接后保持空闲，测量这段时间内服务端消耗的CPU。
+
+用法:
+    python benchmarks/idle_connections.py --connections 200 --duration 10
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+
+import httpx
+import websockets
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def build_app():
+    """构建同时挂载两种接收循环的测试应用（不启动识别进程池）"""
+    sys.path.insert(0, ROOT_DIR)
+    from fastapi import FastAPI, WebSocket
+    import main
+
+    app = FastAPI()
+
+    @app.get("/cpu")
+    async def cpu():
+        return {"cpu": time.process_time()}
+
+    @app.websocket("/legacy")
+    async def legacy_endpoint(websocket: WebSocket):
+        # 旧版轮询写法，仅保留心跳处理，用作对照
+        await websocket.accept()
+        try:
+            while True:
+                try:
+                    message = await asyncio.wait_for(websocket.receive_text(), timeout=0.1)
+                    try:
+                        data = json.loads(message)
+                        if data.get("type") == "ping":
+                            await websocket.send_text(json.dumps({"type": "pong"}))
+                    except:
+                        pass
+                    continue
+                except asyncio.TimeoutError:
+                    try:
+                        await websocket.receive_bytes()
+                    except:
+                        await asyncio.sleep(0.1)
+                        continue
+        except Exception:
+            pass
+
+    app.add_api_websocket_route("/event", main.websocket_endpoint)
+    return app
+
+
+def serve(port):
+    import logging
+    import uvicorn
+
+    app = build_app()
+    # 基准测试只关心CPU，关闭业务日志避免日志输出影响结果
+    logging.getLogger("语音助手").setLevel(logging.WARNING)
+    uvicorn.run(app, host="127.0.0.1", port=port, log_level="warning")
+
+
+async def wait_until_ready(base_url, timeout=60):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                await client.get(f"{base_url}/cpu")
+                return
+            except httpx.HTTPError:
+                await asyncio.sleep(0.2)
+    raise RuntimeError("测试服务启动超时")
+
+
+async def server_cpu(base_url):
+    async with httpx.AsyncClient() as client:
+        response = await client.get(f"{base_url}/cpu")
+        return response.json()["cpu"]
+
+
+async def measure(base_url, path, connections, duration):
+    """打开N个空闲连接，返回这段时间内服务端每个连接每秒消耗的CPU毫秒数"""
+    ws_url = base_url.replace("http://", "ws://") + path
+    sockets = await asyncio.gather(*[websockets.connect(ws_url) for _ in range(connections)])
+    try:
+        # 等连接稳定后再开始计时
+        await asyncio.sleep(1)
+        cpu_before = await server_cpu(base_url)
+        await asyncio.sleep(duration)
+        cpu_after = await server_cpu(base_url)
+    finally:
+        await asyncio.gather(*[ws.close() for ws in sockets], return_exceptions=True)
+    await asyncio.sleep(1)
+    return (cpu_after - cpu_before) * 1000 / duration / connections
+
+
+async def run(args):
+    base_url = f"http://127.0.0.1:{args.port}"
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--serve", "--port", str(args.port)])
+    try:
+        await wait_until_ready(base_url)
+        idle_before = await server_cpu(base_url)
+        await asyncio.sleep(args.duration)
+        baseline = (await server_cpu(base_url) - idle_before) * 1000 / args.duration
+
+        results = {"connections": args.connections, "duration_s": args.duration, "baseline_cpu_ms_per_s": baseline}
+        for name, path in (("legacy", "/legacy"), ("event", "/event")):
+            results[f"{name}_cpu_ms_per_conn_per_s"] = await measure(base_url, path, args.connections, args.duration)
+    finally:
+        server.terminate()
+        server.wait()
+
+    print(f"空闲连接数: {args.connections}, 测量时长: {args.duration}秒")
+    print(f"无连接时服务端CPU: {baseline:.3f} ms/s")
+    print(f"旧版轮询循环:   {results['legacy_cpu_ms_per_conn_per_s']:.4f} ms/连接/秒")
+    print(f"事件驱动循环:   {results['event_cpu_ms_per_conn_per_s']:.4f} ms/连接/秒")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="空闲WebSocket连接的CPU开销基准测试")
+    parser.add_argument("--connections", type=int, default=200, help="空闲连接数")
+    parser.add_argument("--duration", type=float, default=10, help="每轮测量时长（秒）")
+    parser.add_argument("--port", type=int, default=8765, help="测试服务端口")
+    parser.add_argument("--output", help="将结果写入JSON文件")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        serve(args.port)
+    else:
+        asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,526 @@
+"""
+/ws 完整流水线的离线负载测试
+
+在子进程中启动模拟大模型接口（benchmarks/mock_llm.py）和主程序，
+N个并发客户端按 /client 页面的协议反复发送样本音频，每个客户端收到上一段语音的
+完整回复后再发送下一段（闭环压测）。统计以下指标并写入JSON结果文件：
+
+- 端到端延迟：发送音频 → 收到 done 消息
+- 首token延迟（TTFT）：发送音频 → 收到第一个 delta 消息
+- 首段语音延迟（--tts 时）：发送音频 → 收到第一段合成语音
+- 识别延迟与实时率（RTF）：发送音频 → 收到识别结果，除以音频时长；
+  另外根据服务端 /metrics 中识别阶段的总耗时计算服务端 RTF
+- 吞吐量：每秒完成的语音段数、每秒处理的音频秒数
+- 服务端进程树（含识别子进程）的峰值内存
+
+样本目录中的音频（.webm/.wav/.ogg/.mp3）可用 benchmarks/make_fixtures.py 生成，
+也可以放入自己的录音。样本顺序由 --seed 决定，同样的参数可以复现同样的负载。
+
+用法:
+    python benchmarks/load_test.py --clients 8 --utterances 20 --output results.json
+    python benchmarks/load_test.py --mode stream --env ASR_WORKERS=2 --env WHISPER_MODEL=base
+"""
+import argparse
+import asyncio
+import glob
+import json
+import math
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+import threading
+import time
+
+import httpx
+import websockets
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_FIXTURES = os.path.join(ROOT_DIR, "benchmarks", "fixtures")
+AUDIO_EXTENSIONS = (".webm", ".wav", ".ogg", ".mp3")
+SAMPLE_RATE = 16000
+STREAM_FRAME_MS = 100  # 流式模式每帧时长，与 /client 页面的发送间隔接近
+METRIC_LINE = re.compile(r"^(\w+)(\{[^}]*\})?\s+(\S+)$")
+
+
+class Fixture:
+    """一个音频样本：原始文件内容、16kHz PCM 和参考文本"""
+
+    def __init__(self, path, ffmpeg):
+        self.path = path
+        self.name = os.path.basename(path)
+        with open(path, "rb") as f:
+            self.data = f.read()
+        self.pcm = subprocess.run(
+            [ffmpeg, "-loglevel", "error", "-i", path, "-f", "s16le", "-ac", "1", "-ar", str(SAMPLE_RATE), "pipe:1"],
+            check=True, capture_output=True,
+        ).stdout
+        self.duration = len(self.pcm) / 2 / SAMPLE_RATE
+        reference_path = os.path.splitext(path)[0] + ".txt"
+        self.reference = None
+        if os.path.exists(reference_path):
+            with open(reference_path, encoding="utf-8") as f:
+                self.reference = f.read().strip()
+
+
+def load_fixtures(directory, ffmpeg):
+    paths = sorted(p for p in glob.glob(os.path.join(directory, "*")) if p.lower().endswith(AUDIO_EXTENSIONS))
+    if not paths:
+        raise SystemExit(f"样本目录 {directory} 中没有音频，请先运行 benchmarks/make_fixtures.py")
+    return [Fixture(path, ffmpeg) for path in paths]
+
+
+def percentiles(values):
+    """返回 p50/p95/p99/均值/最大值（毫秒或比值，保持输入单位）"""
+    if not values:
+        return None
+    ordered = sorted(values)
+
+    def rank(p):
+        # 最近秩法
+        index = max(0, min(len(ordered), math.ceil(p / 100 * len(ordered))) - 1)
+        return ordered[index]
+
+    return {
+        "p50": rank(50),
+        "p95": rank(95),
+        "p99": rank(99),
+        "mean": sum(ordered) / len(ordered),
+        "max": ordered[-1],
+        "count": len(ordered),
+    }
+
+
+def parse_metrics(text):
+    """把 /metrics 的文本格式解析为 {"名称{标签}": 数值}"""
+    values = {}
+    for line in text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        match = METRIC_LINE.match(line)
+        if match:
+            try:
+                values[match.group(1) + (match.group(2) or "")] = float(match.group(3))
+            except ValueError:
+                pass
+    return values
+
+
+def process_tree_rss(root_pid):
+    """Linux下读取 /proc，返回进程及其全部子孙进程的常驻内存之和（字节）"""
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # 进程名可能包含空格，从最后一个右括号之后开始解析
+                fields = f.read().rsplit(")", 1)[1].split()
+            children.setdefault(int(fields[1]), []).append(int(entry))
+        except (OSError, IndexError):
+            continue
+    total, stack = 0, [root_pid]
+    while stack:
+        pid = stack.pop()
+        stack.extend(children.get(pid, []))
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+                        break
+        except OSError:
+            continue
+    return total
+
+
+class RSSSampler(threading.Thread):
+    """后台定时采样服务端进程树的内存，记录峰值"""
+
+    def __init__(self, pid, interval=0.2):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.peak = max(self.peak, process_tree_rss(self.pid))
+            except OSError:
+                pass
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+class UtteranceResult:
+    def __init__(self, fixture, tts=False):
+        self.fixture = fixture
+        self.tts = tts  # 开启语音播报时，回复要等 audio_end 才算结束
+        self.asr_s = None
+        self.ttft_s = None
+        self.ttfa_s = None
+        self.e2e_s = None
+        self.transcript = None
+        self.finished = 0  # 已收到的结束消息数（done/busy/silence/rejected/错误）
+        self.outcome = "timeout"
+
+    def handle(self, message, elapsed):
+        """
+        记录一条服务端消息
+
+        参数:
+            message (dict | bytes): 服务端消息，二进制消息为合成的语音
+            elapsed (float): 消息到达时距离计时起点的秒数（流式模式下可能早于起点，按0计）
+        """
+        elapsed = max(0.0, elapsed)
+        if isinstance(message, bytes):
+            if self.ttfa_s is None:
+                self.ttfa_s = elapsed
+            return
+        kind = message.get("type")
+        if kind == "final" or (kind == "message" and message.get("role") == "user"):
+            if self.asr_s is None:
+                self.asr_s = elapsed
+            self.transcript = (self.transcript or "") + message.get("content", "")
+        elif kind == "delta":
+            if self.ttft_s is None:
+                self.ttft_s = elapsed
+        elif kind == "audio_end":
+            self.finished += 1
+        elif kind in ("done", "busy", "silence", "rejected") or (kind == "message" and message.get("role") == "assistant"):
+            # 识别为空或处理失败时服务端直接发送一条助手消息
+            if not (self.tts and kind == "done"):
+                self.finished += 1
+            self.e2e_s = elapsed
+            if self.outcome in ("timeout", "ok"):
+                self.outcome = {"done": "ok", "busy": "busy", "silence": "silence", "rejected": "rejected"}.get(kind, "error")
+
+
+def decode_message(raw):
+    """文本消息解析为dict，二进制消息（合成的语音）原样返回"""
+    return raw if isinstance(raw, bytes) else json.loads(raw)
+
+
+async def send_blob(ws, fixture, timeout, tts=False):
+    """整段模式：发送一段完整音频，等待它的结束消息"""
+    result = UtteranceResult(fixture, tts)
+    started = time.perf_counter()
+    await ws.send(fixture.data)
+    deadline = started + timeout
+    try:
+        while result.finished < 1:
+            raw = await asyncio.wait_for(ws.recv(), timeout=max(0.0, deadline - time.perf_counter()))
+            result.handle(decode_message(raw), time.perf_counter() - started)
+    except asyncio.TimeoutError:
+        result.outcome = "timeout"
+    return result
+
+
+async def send_stream(ws, fixture, timeout, tts=False, settle=1.0):
+    """
+    流式模式：按实时速率发送PCM帧后发送 end_stream
+
+    延迟从 end_stream 发出时开始计算（即用户说完话的时刻）。每个 final 消息对应一次回复，
+    等所有 final 的回复都结束后，再静候 settle 秒确认没有新的消息才算本段结束。
+    """
+    result = UtteranceResult(fixture, tts)
+    frame_bytes = SAMPLE_RATE * STREAM_FRAME_MS // 1000 * 2
+    arrivals = asyncio.Queue()
+    finals = 0
+
+    async def reader():
+        # 发送期间也要接收，消息到达时间在这里记录
+        async for raw in ws:
+            await arrivals.put((time.perf_counter(), decode_message(raw)))
+
+    reader_task = asyncio.create_task(reader())
+    try:
+        await ws.send(json.dumps({"type": "start_stream"}))
+        for offset in range(0, len(fixture.pcm), frame_bytes):
+            await ws.send(fixture.pcm[offset:offset + frame_bytes])
+            await asyncio.sleep(STREAM_FRAME_MS / 1000)
+        started = time.perf_counter()
+        await ws.send(json.dumps({"type": "end_stream"}))
+        deadline = started + timeout
+        while True:
+            waiting = result.finished < finals
+            wait = deadline - time.perf_counter() if waiting else settle
+            try:
+                arrived, message = await asyncio.wait_for(arrivals.get(), timeout=max(0.0, wait))
+            except asyncio.TimeoutError:
+                if waiting:
+                    result.outcome = "timeout"
+                elif finals == 0:
+                    # 整段都被判定为静音，没有 final 也没有回复
+                    result.outcome = "silence"
+                break
+            if isinstance(message, dict) and message.get("type") == "final":
+                finals += 1
+            result.handle(message, arrived - started)
+    finally:
+        reader_task.cancel()
+        await asyncio.gather(reader_task, return_exceptions=True)
+    return result
+
+
+async def run_client(index, ws_url, fixtures, args, results):
+    """单个客户端：按种子决定的顺序依次发送语音段"""
+    rng = random.Random(args.seed * 1000 + index)
+    send = send_stream if args.mode == "stream" else send_blob
+    async with websockets.connect(ws_url, max_size=None) as ws:
+        if args.tts:
+            await enable_tts(ws)
+        if args.profile:
+            await select_profile(ws, args.profile)
+        for _ in range(args.utterances):
+            fixture = rng.choice(fixtures)
+            results.append(await send(ws, fixture, args.timeout, args.tts))
+            if args.think_ms:
+                await asyncio.sleep(args.think_ms / 1000)
+
+
+async def enable_tts(ws):
+    """开启语音播报，服务端未配置合成引擎时报错退出"""
+    await ws.send(json.dumps({"type": "tts", "enabled": True}))
+    while True:
+        message = decode_message(await ws.recv())
+        if isinstance(message, dict) and message.get("type") == "tts":
+            if not message.get("enabled"):
+                raise SystemExit("服务端未启用语音合成，请通过 --env TTS_ENGINE=tone 等方式配置")
+            return
+
+
+async def select_profile(ws, name):
+    """选择识别档位，服务端不认识该档位时报错退出"""
+    await ws.send(json.dumps({"type": "profile", "name": name}))
+    while True:
+        message = decode_message(await ws.recv())
+        if isinstance(message, dict) and message.get("type") == "profile":
+            if message.get("name") != name:
+                raise SystemExit(f"服务端没有识别档位 {name}，可用档位: {message.get('available')}")
+            return
+
+
+async def wait_until_ready(base_url, timeout):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                response = await client.get(f"{base_url}/ready")
+                if response.status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.5)
+    raise RuntimeError("服务启动超时（/ready 未就绪）")
+
+
+async def fetch_metrics(base_url):
+    async with httpx.AsyncClient() as client:
+        response = await client.get(f"{base_url}/metrics")
+        return parse_metrics(response.text)
+
+
+def start_servers(args):
+    """启动模拟大模型接口和主程序，返回 (进程列表, 主程序进程)"""
+    llm = subprocess.Popen([
+        sys.executable, os.path.join(ROOT_DIR, "benchmarks", "mock_llm.py"),
+        "--port", str(args.llm_port),
+        "--ttft-ms", str(args.llm_ttft_ms),
+        "--token-ms", str(args.llm_token_ms),
+        "--tokens", str(args.llm_tokens),
+        "--jitter-ms", str(args.llm_jitter_ms),
+        *[option for item in args.llm_model_ttft for option in ("--model-ttft", item)],
+    ])
+    env = dict(os.environ)
+    env.update({
+        "TONGYI_API_BASE": f"http://127.0.0.1:{args.llm_port}/v1",
+        "TONGYI_API_KEY": "mock",
+        # 样本会重复发送，默认关闭回复缓存和音频去重，否则测到的是缓存命中的延迟
+        "RESPONSE_CACHE_ENABLED": "true" if args.cache else "false",
+        "AUDIO_DEDUP_ENABLED": "true" if args.cache else "false",
+        "LOG_FILE": "",
+        "LOG_LEVEL": "WARNING",
+    })
+    for item in args.env:
+        key, _, value = item.partition("=")
+        env[key] = value
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1",
+         "--port", str(args.port), "--log-level", "warning"],
+        cwd=ROOT_DIR, env=env,
+    )
+    return [server, llm], server
+
+
+def summarize(results, mode, wall_seconds, metrics_before, metrics_after, peak_rss):
+    ok = [r for r in results if r.outcome == "ok"]
+    audio_seconds = sum(r.fixture.duration for r in results)
+
+    def delta(name):
+        return metrics_after.get(name, 0.0) - metrics_before.get(name, 0.0)
+
+    server_asr_seconds = delta('voice_stage_duration_seconds_sum{stage="asr"}')
+    outcomes = {}
+    for r in results:
+        outcomes[r.outcome] = outcomes.get(r.outcome, 0) + 1
+    return {
+        "utterances": len(results),
+        "outcomes": outcomes,
+        "wall_seconds": wall_seconds,
+        "e2e_ms": percentiles([r.e2e_s * 1000 for r in ok]),
+        "ttft_ms": percentiles([r.ttft_s * 1000 for r in ok if r.ttft_s is not None]),
+        "ttfa_ms": percentiles([r.ttfa_s * 1000 for r in ok if r.ttfa_s is not None]),
+        "asr_ms": percentiles([r.asr_s * 1000 for r in results if r.asr_s is not None]),
+        # 流式模式下识别与发送同时进行，客户端测到的只是说完话后的剩余等待，不计算该项
+        "asr_rtf_client": percentiles([
+            r.asr_s / r.fixture.duration for r in results if r.asr_s is not None and r.fixture.duration > 0
+        ]) if mode == "blob" else None,
+        # 识别进程实际推理耗时 / 发送的音频总时长（批处理时一次推理覆盖多段音频）
+        "asr_rtf_server": server_asr_seconds / audio_seconds if audio_seconds else None,
+        "throughput_utterances_per_s": len(ok) / wall_seconds if wall_seconds else None,
+        "throughput_audio_s_per_s": audio_seconds / wall_seconds if wall_seconds else None,
+        "peak_rss_mb": peak_rss / 1024 / 1024 if peak_rss else None,
+        "server_llm_ttft_ms_mean": (
+            delta("voice_llm_time_to_first_token_seconds_sum")
+            / delta("voice_llm_time_to_first_token_seconds_count") * 1000
+            if delta("voice_llm_time_to_first_token_seconds_count") else None
+        ),
+        "server_asr_rejected": delta("voice_asr_rejected_total"),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args):
+    fixtures = load_fixtures(args.fixtures, args.ffmpeg)
+    base_url = args.url or f"http://127.0.0.1:{args.port}"
+    ws_url = base_url.replace("http://", "ws://") + "/ws"
+    processes, server_pid = [], args.server_pid
+    if not args.url:
+        processes, server = start_servers(args)
+        server_pid = server.pid
+    sampler = RSSSampler(server_pid) if server_pid and os.path.isdir("/proc") else None
+    try:
+        await wait_until_ready(base_url, args.ready_timeout)
+        if sampler:
+            sampler.start()
+        if args.warmup:
+            # 预热：每个样本发送一次，不计入结果
+            async with websockets.connect(ws_url, max_size=None) as ws:
+                if args.tts:
+                    await enable_tts(ws)
+                for fixture in fixtures[:args.warmup]:
+                    await send_blob(ws, fixture, args.timeout, args.tts)
+
+        metrics_before = await fetch_metrics(base_url)
+        results = []
+        started = time.perf_counter()
+        await asyncio.gather(*[run_client(i, ws_url, fixtures, args, results) for i in range(args.clients)])
+        wall_seconds = time.perf_counter() - started
+        metrics_after = await fetch_metrics(base_url)
+    finally:
+        if sampler:
+            sampler.stop()
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+    report = {
+        "config": {
+            key: value for key, value in vars(args).items() if key not in ("output",)
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "git_revision": git_revision(),
+            "fixtures": [{"name": f.name, "duration_s": f.duration} for f in fixtures],
+        },
+        "results": summarize(results, args.mode, wall_seconds, metrics_before, metrics_after, sampler.peak if sampler else 0),
+        "utterances": [
+            {
+                "fixture": r.fixture.name,
+                "outcome": r.outcome,
+                "asr_ms": r.asr_s * 1000 if r.asr_s is not None else None,
+                "ttft_ms": r.ttft_s * 1000 if r.ttft_s is not None else None,
+                "ttfa_ms": r.ttfa_s * 1000 if r.ttfa_s is not None else None,
+                "e2e_ms": r.e2e_s * 1000 if r.e2e_s is not None else None,
+                "transcript": r.transcript,
+                "reference": r.fixture.reference,
+            }
+            for r in results
+        ],
+    }
+
+    summary = report["results"]
+    print(f"客户端: {args.clients}, 每客户端语音段: {args.utterances}, 模式: {args.mode}")
+    print(f"完成情况: {summary['outcomes']}, 总耗时 {wall_seconds:.1f}秒")
+    for key in ("e2e_ms", "ttft_ms", "ttfa_ms", "asr_ms"):
+        stats = summary[key]
+        if stats:
+            print(f"{key:8s} p50={stats['p50']:.0f} p95={stats['p95']:.0f} p99={stats['p99']:.0f}")
+    if summary["asr_rtf_server"] is not None:
+        print(f"服务端识别RTF: {summary['asr_rtf_server']:.3f}")
+    if summary["throughput_utterances_per_s"] is not None:
+        print(f"吞吐量: {summary['throughput_utterances_per_s']:.2f} 段/秒")
+    if summary["peak_rss_mb"]:
+        print(f"服务端峰值内存: {summary['peak_rss_mb']:.0f} MB")
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"结果已写入 {args.output}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="/ws 完整流水线的离线负载测试")
+    parser.add_argument("--clients", type=int, default=4, help="并发客户端数")
+    parser.add_argument("--utterances", type=int, default=10, help="每个客户端发送的语音段数")
+    parser.add_argument("--mode", choices=("blob", "stream"), default="blob", help="整段发送或流式PCM发送")
+    parser.add_argument("--think-ms", type=float, default=0, help="每段语音之间的停顿（毫秒）")
+    parser.add_argument("--fixtures", default=DEFAULT_FIXTURES, help="音频样本目录")
+    parser.add_argument("--seed", type=int, default=0, help="样本选择的随机种子")
+    parser.add_argument("--warmup", type=int, default=2, help="正式测量前预热发送的样本数")
+    parser.add_argument("--timeout", type=float, default=120, help="单段语音的超时时间（秒）")
+    parser.add_argument("--port", type=int, default=8766, help="主程序端口")
+    parser.add_argument("--url", help="测试已运行的服务（如 http://127.0.0.1:8000），不再启动子进程")
+    parser.add_argument("--server-pid", type=int, help="配合 --url 使用，采样该进程树的内存")
+    parser.add_argument(
+        "--env", action="append", default=[], metavar="KEY=VALUE",
+        help="传给主程序的环境变量，可重复指定（如 ASR_WORKERS=2）",
+    )
+    parser.add_argument("--cache", action="store_true", help="保留回复缓存和音频去重（默认关闭）")
+    parser.add_argument("--profile", help="每个连接选择的识别档位（fast/balanced/accurate），默认使用服务端档位")
+    parser.add_argument("--tts", action="store_true", help="开启语音播报，统计首段语音延迟（需配合 --env TTS_ENGINE=...）")
+    parser.add_argument("--ready-timeout", type=float, default=600, help="等待模型加载完成的时间（秒）")
+    parser.add_argument("--llm-port", type=int, default=9000, help="模拟大模型接口端口")
+    parser.add_argument("--llm-ttft-ms", type=float, default=300, help="模拟首token延迟（毫秒）")
+    parser.add_argument("--llm-token-ms", type=float, default=20, help="模拟token间隔（毫秒）")
+    parser.add_argument("--llm-tokens", type=int, default=60, help="模拟回复的token数")
+    parser.add_argument("--llm-jitter-ms", type=float, default=0, help="模拟延迟的随机抖动上限（毫秒）")
+    parser.add_argument(
+        "--llm-model-ttft", action="append", default=[], metavar="MODEL=MS",
+        help="按模型名覆盖模拟首token延迟，可重复指定，用于测试对冲和降级",
+    )
+    parser.add_argument("--ffmpeg", default=os.getenv("FFMPEG_BINARY", "ffmpeg"), help="ffmpeg可执行文件")
+    parser.add_argument("--output", default="load_test_results.json", help="结果JSON文件")
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
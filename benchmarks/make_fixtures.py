@@ -0,0 +1,104 @@
+"""
+生成负载测试用的音频样本
+
+输出为16kHz单声道 webm/opus（与浏览器 MediaRecorder 发送的格式一致），
+每个样本旁边写一个同名 .txt 参考文本，供识别准确率对比使用。
+
+- 安装了 espeak-ng 时合成中文语音（参考文本即合成内容）
+- 否则生成带停顿的音调片段，只用于压测延迟和吞吐（参考文本为空）
+
+也可以直接把自己录制的音频（.webm/.wav/.ogg/.mp3）和参考文本放进样本目录。
+
+用法:
+    python benchmarks/make_fixtures.py --output benchmarks/fixtures
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import tempfile
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_OUTPUT = os.path.join(ROOT_DIR, "benchmarks", "fixtures")
+
+PHRASES = [
+    "你好，今天天气怎么样？",
+    "帮我查一下明天从北京到上海的火车票。",
+    "请用三句话介绍一下人工智能的发展历史。",
+    "我想听一首轻松的音乐。",
+    "提醒我下午三点开会。",
+    "一加一等于几？",
+    "给我讲一个简短的笑话吧。",
+    "最近有什么好看的电影推荐吗？",
+]
+
+# 音调片段：(频率Hz, 发声秒数, 之后停顿秒数)
+TONE_PATTERNS = [
+    [(220, 1.0, 0.3), (330, 1.2, 0.0)],
+    [(260, 2.0, 0.5), (200, 1.5, 0.0)],
+    [(300, 0.8, 0.2), (240, 0.8, 0.2), (280, 1.0, 0.0)],
+    [(180, 3.0, 0.0)],
+]
+
+
+def ffmpeg_encode(ffmpeg, inputs, filter_complex, output):
+    command = [ffmpeg, "-y", "-loglevel", "error", *inputs]
+    if filter_complex:
+        command += ["-filter_complex", filter_complex]
+    command += ["-ar", "16000", "-ac", "1", "-c:a", "libopus", "-b:a", "32k", output]
+    subprocess.run(command, check=True)
+
+
+def make_speech(ffmpeg, espeak, output_dir):
+    for index, phrase in enumerate(PHRASES):
+        name = os.path.join(output_dir, f"speech_{index:02d}")
+        with tempfile.TemporaryDirectory() as tmp:
+            wav = os.path.join(tmp, "speech.wav")
+            subprocess.run([espeak, "-v", "cmn", "-w", wav, phrase], check=True)
+            # 前后各补0.3秒静音，接近真实录音
+            ffmpeg_encode(ffmpeg, ["-i", wav], "adelay=300,apad=pad_dur=0.3", name + ".webm")
+        with open(name + ".txt", "w", encoding="utf-8") as f:
+            f.write(phrase)
+        yield name + ".webm"
+
+
+def make_tones(ffmpeg, output_dir):
+    for index, pattern in enumerate(TONE_PATTERNS):
+        name = os.path.join(output_dir, f"tone_{index:02d}")
+        inputs, labels = [], []
+        for frequency, duration, pause in pattern:
+            labels.append(f"[{len(inputs) // 4}]")
+            inputs += ["-f", "lavfi", "-i", f"sine=frequency={frequency}:duration={duration}:sample_rate=16000"]
+            if pause:
+                labels.append(f"[{len(inputs) // 4}]")
+                inputs += ["-f", "lavfi", "-i", f"anullsrc=r=16000:cl=mono:d={pause}"]
+        filter_complex = "".join(labels) + f"concat=n={len(labels)}:v=0:a=1"
+        ffmpeg_encode(ffmpeg, inputs, filter_complex, name + ".webm")
+        with open(name + ".txt", "w", encoding="utf-8") as f:
+            f.write("")
+        yield name + ".webm"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="生成负载测试用的音频样本")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT, help="样本输出目录")
+    parser.add_argument("--ffmpeg", default=os.getenv("FFMPEG_BINARY", "ffmpeg"), help="ffmpeg可执行文件")
+    parser.add_argument("--tones", action="store_true", help="即使安装了 espeak-ng 也只生成音调片段")
+    args = parser.parse_args()
+
+    if shutil.which(args.ffmpeg) is None:
+        parser.error(f"未找到ffmpeg: {args.ffmpeg}")
+    os.makedirs(args.output, exist_ok=True)
+
+    espeak = shutil.which("espeak-ng")
+    if espeak and not args.tones:
+        files = list(make_speech(args.ffmpeg, espeak, args.output))
+    else:
+        if not args.tones:
+            print("未安装 espeak-ng，改为生成音调片段（只适合测延迟和吞吐）")
+        files = list(make_tones(args.ffmpeg, args.output))
+    print(f"已生成 {len(files)} 个样本到 {args.output}")
+
+
+if __name__ == "__main__":
+    main()
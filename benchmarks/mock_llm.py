@@ -0,0 +1,131 @@
+"""
+本地的OpenAI兼容聊天接口替身，用于离线基准测试
+
+实现 POST /v1/chat/completions，按可配置的首token延迟和token间隔流式返回内容，
+并在请求 stream_options.include_usage 时于最后一个数据块返回token用量。
+将主程序的 TONGYI_API_BASE 指向 http://127.0.0.1:<port>/v1 即可使用。
+
+用法:
+    python benchmarks/mock_llm.py --port 9000 --ttft-ms 300 --token-ms 20 --tokens 60
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+REPLY_TEXT = "好的，这是一个用于基准测试的模拟回复，内容本身没有意义，只用来模拟大模型逐字生成的过程。"
+
+
+def build_app(ttft_ms, token_ms, tokens, jitter_ms=0.0, model_latency=None):
+    """
+    构建模拟接口应用
+
+    参数:
+        ttft_ms (float): 首个token的延迟（毫秒）
+        token_ms (float): 之后每个token的间隔（毫秒）
+        tokens (int): 每次回复的token数（每个token为一个字）
+        jitter_ms (float): 每次等待叠加的随机抖动上限（毫秒）
+        model_latency (dict): 可选，按模型名覆盖首token延迟，如 {"qwen-turbo": 100}
+    """
+    app = FastAPI()
+    model_latency = model_latency or {}
+
+    def delay(base_ms):
+        return max(0.0, base_ms + random.uniform(0, jitter_ms)) / 1000
+
+    def reply_tokens():
+        return [REPLY_TEXT[i % len(REPLY_TEXT)] for i in range(tokens)]
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        model = body.get("model", "mock")
+        prompt_tokens = sum(len(str(m.get("content", ""))) for m in body.get("messages", []))
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+        created = int(time.time())
+        first_delay = delay(model_latency.get(model, ttft_ms))
+
+        if not body.get("stream"):
+            await asyncio.sleep(first_delay + delay(token_ms) * tokens)
+            return JSONResponse({
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": "".join(reply_tokens())},
+                    "finish_reason": "stop",
+                }],
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": tokens,
+                    "total_tokens": prompt_tokens + tokens,
+                },
+            })
+
+        include_usage = bool((body.get("stream_options") or {}).get("include_usage"))
+
+        def chunk(delta, finish_reason=None, usage=None, choices=True):
+            payload = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}] if choices else [],
+            }
+            if usage is not None:
+                payload["usage"] = usage
+            return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+        async def stream():
+            await asyncio.sleep(first_delay)
+            yield chunk({"role": "assistant", "content": ""})
+            for index, token in enumerate(reply_tokens()):
+                if index:
+                    await asyncio.sleep(delay(token_ms))
+                yield chunk({"content": token})
+            yield chunk({}, finish_reason="stop")
+            if include_usage:
+                yield chunk(None, usage={
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": tokens,
+                    "total_tokens": prompt_tokens + tokens,
+                }, choices=False)
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地OpenAI兼容聊天接口替身")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--ttft-ms", type=float, default=300, help="首个token的延迟（毫秒）")
+    parser.add_argument("--token-ms", type=float, default=20, help="token间隔（毫秒）")
+    parser.add_argument("--tokens", type=int, default=60, help="每次回复的token数")
+    parser.add_argument("--jitter-ms", type=float, default=0, help="随机抖动上限（毫秒）")
+    parser.add_argument(
+        "--model-ttft", action="append", default=[], metavar="MODEL=MS",
+        help="按模型名覆盖首token延迟，可重复指定",
+    )
+    args = parser.parse_args()
+
+    import uvicorn
+
+    model_latency = {}
+    for item in args.model_ttft:
+        name, _, value = item.partition("=")
+        model_latency[name] = float(value)
+    app = build_app(args.ttft_ms, args.token_ms, args.tokens, args.jitter_ms, model_latency)
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
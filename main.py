@@ -1,7 +1,5 @@
-from fastapi import FastAPI, WebSocket
-from fastapi.responses import HTMLResponse
-import whisper
-import tempfile
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse
 import os
 import sys  # 添加sys模块导入
 import asyncio
@@ -10,95 +8,1993 @@ import io
 import wave
 import json
 import logging  # 导入日志模块
+import logging.handlers
+import atexit
+import contextvars
+import queue
+import random
 import time  # 导入时间模块
-from openai import OpenAI  # 导入OpenAI SDK
+import uuid
+import re
+import sqlite3
+import struct
+import threading
+import unicodedata
+import zlib
+import bisect
+import dataclasses
+import difflib
+import hashlib
+import importlib
+import multiprocessing
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
+import httpx
+import tiktoken
+from openai import AsyncOpenAI, BadRequestError  # 导入OpenAI SDK（异步客户端）
 from dotenv import load_dotenv  # 导入dotenv库
 
-# 配置日志
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler("app.log")
-    ]
-)
-logger = logging.getLogger("语音助手")
-
 # 加载.env文件中的环境变量
 load_dotenv()
 
-# 获取通义千问API密钥
+# ---------------- 日志 ----------------
+# 日志记录只把记录放入内存队列，由后台线程负责格式化和写盘，不阻塞事件循环
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_FILE = os.getenv("LOG_FILE", "app.log")
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))  # 单个日志文件上限，超出后轮转
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "5"))  # 保留的历史日志文件数
+LOG_CONTENT_MAX_CHARS = int(os.getenv("LOG_CONTENT_MAX_CHARS", "80"))  # 识别文本、模型回复等内容在日志中的最大长度
+LOG_CONTENT_SAMPLE_RATE = float(os.getenv("LOG_CONTENT_SAMPLE_RATE", "1.0"))  # 记录内容的采样比例，其余只记录长度
+
+# 当前连接和当前语音段的ID，随异步任务自动传递，由日志过滤器写入每条记录
+connection_id_var = contextvars.ContextVar("connection_id", default="-")
+utterance_id_var = contextvars.ContextVar("utterance_id", default="-")
+
+class ContextFilter(logging.Filter):
+    """为日志记录附加连接ID和语音段ID"""
+
+    def filter(self, record):
+        record.connection_id = connection_id_var.get()
+        record.utterance_id = utterance_id_var.get()
+        return True
+
+class JsonFormatter(logging.Formatter):
+    """每条日志输出为一行JSON"""
+
+    def format(self, record):
+        entry = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "pid": record.process,
+            "connection_id": getattr(record, "connection_id", "-"),
+            "utterance_id": getattr(record, "utterance_id", "-"),
+            "msg": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+def content_for_log(text):
+    """按采样比例和长度上限处理要写入日志的内容"""
+    if text is None:
+        return None
+    if LOG_CONTENT_SAMPLE_RATE < 1.0 and random.random() >= LOG_CONTENT_SAMPLE_RATE:
+        return f"<{len(text)}字>"
+    if len(text) > LOG_CONTENT_MAX_CHARS:
+        return text[:LOG_CONTENT_MAX_CHARS] + f"...<共{len(text)}字>"
+    return text
+
+def setup_logging():
+    """配置基于队列的日志：控制台输出可读文本，主进程额外写入按大小轮转的JSON日志文件"""
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter(
+        '%(asctime)s - %(name)s - %(levelname)s - [%(connection_id)s/%(utterance_id)s] %(message)s'
+    ))
+    handlers = [console_handler]
+    # 识别子进程只输出到控制台，避免多个进程同时轮转同一个文件
+    if LOG_FILE and multiprocessing.current_process().name == "MainProcess":
+        file_handler = logging.handlers.RotatingFileHandler(
+            LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf-8"
+        )
+        file_handler.setFormatter(JsonFormatter())
+        handlers.append(file_handler)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter())
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+log_listener = setup_logging()
+logger = logging.getLogger("语音助手")
+
+# 获取通义千问API密钥（网关启动时检查，独立的识别服务不需要）
 tongyi_api_key = os.getenv("TONGYI_API_KEY")
-if not tongyi_api_key:
-    logger.warning("警告: 未设置通义千问API密钥，请在.env文件中配置TONGYI_API_KEY")
 
 # 获取通义千问API地址
 tongyi_api_base = os.getenv("TONGYI_API_BASE", "https://dashscope.aliyuncs.com/compatible-mode/v1")
 
-app = FastAPI()
+def env_flag(name, default=False):
+    """读取布尔型环境变量（1/true/yes/on 视为开启）"""
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
 
-# 加载Whisper模型（可以选择不同大小的模型：tiny, base, small, medium, large）
-# 较小的模型速度更快但准确性较低，较大的模型准确性更高但需要更多资源
-# model = whisper.load_model("base")
-model = whisper.load_model("tiny")
+# 大模型HTTP连接池配置（所有连接共享一个连接池，复用keep-alive连接）
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "50"))  # 最大并发连接数
+LLM_MAX_KEEPALIVE = int(os.getenv("LLM_MAX_KEEPALIVE", "20"))  # 最多保持的空闲连接数
+LLM_KEEPALIVE_EXPIRY = float(os.getenv("LLM_KEEPALIVE_EXPIRY", "60"))  # 空闲连接保持时间（秒）
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "5"))  # 建立连接超时（秒）
+LLM_READ_TIMEOUT = float(os.getenv("LLM_READ_TIMEOUT", "60"))  # 两个数据块之间的最长等待（秒）
+LLM_HTTP2 = env_flag("LLM_HTTP2", True)  # 是否尝试HTTP/2（需要安装h2）
+
+# 大模型路由配置：主模型首token过慢时对冲到备用模型，连续失败时熔断
+LLM_MODEL = os.getenv("LLM_MODEL", "qwen3-235b-a22b")  # 主模型
+LLM_FALLBACK_MODEL = os.getenv("LLM_FALLBACK_MODEL", "qwen-turbo")  # 更快更便宜的备用模型，留空时对冲请求仍发给主模型
+LLM_HEDGE = env_flag("LLM_HEDGE", True)  # 是否发送对冲请求
+LLM_TTFT_SLO_MS = float(os.getenv("LLM_TTFT_SLO_MS", "1500"))  # 首token目标延迟；主模型近期中位数超过该值时优先使用备用模型
+LLM_HEDGE_MIN_MS = float(os.getenv("LLM_HEDGE_MIN_MS", "300"))  # 对冲等待时间的下限
+LLM_FIRST_TOKEN_TIMEOUT = float(os.getenv("LLM_FIRST_TOKEN_TIMEOUT", "10"))  # 等待首token的总时限（秒，含排队）
+LLM_TTFT_WINDOW_S = float(os.getenv("LLM_TTFT_WINDOW_S", "120"))  # 统计首token延迟的滑动窗口（秒）
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))  # 连续失败多少次后熔断该模型
+LLM_BREAKER_COOLDOWN_S = float(os.getenv("LLM_BREAKER_COOLDOWN_S", "30"))  # 熔断持续时间（秒），之后放行请求试探
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "32"))  # 同时进行的大模型请求上限（含对冲请求）
+
+try:
+    import h2  # noqa: F401  HTTP/2 为可选依赖
+    _http2_available = True
+except ImportError:
+    _http2_available = False
 
-# 初始化OpenAI客户端
-client = OpenAI(
-    api_key=tongyi_api_key,
-    base_url=tongyi_api_base
+# 初始化共享的HTTP连接池和OpenAI异步客户端
+http_client = httpx.AsyncClient(
+    http2=LLM_HTTP2 and _http2_available,
+    limits=httpx.Limits(
+        max_connections=LLM_MAX_CONNECTIONS,
+        max_keepalive_connections=LLM_MAX_KEEPALIVE,
+        keepalive_expiry=LLM_KEEPALIVE_EXPIRY,
+    ),
+    timeout=httpx.Timeout(LLM_READ_TIMEOUT, connect=LLM_CONNECT_TIMEOUT),
 )
+client = None  # 首次调用大模型时创建，独立运行的识别服务（asr-server）不需要API密钥
+
+def get_llm_client():
+    """返回共享的OpenAI异步客户端，首次调用时创建"""
+    global client
+    if client is None:
+        client = AsyncOpenAI(
+            api_key=tongyi_api_key,
+            base_url=tongyi_api_base,
+            http_client=http_client,
+        )
+    return client
+
+# 多轮对话上下文配置
+CONVERSATION_MAX_TOKENS = int(os.getenv("CONVERSATION_MAX_TOKENS", "2000"))  # 历史对话的token预算，超出后丢弃最早的轮次
+TOKENIZER_ENCODING = os.getenv("TOKENIZER_ENCODING", "cl100k_base")  # 用于估算token数的tiktoken编码
+
+# 大模型回复缓存配置
+RESPONSE_CACHE_ENABLED = env_flag("RESPONSE_CACHE_ENABLED", False)
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "512"))  # 最多缓存的回复条数（LRU淘汰）
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))  # 缓存有效期（秒）
+RESPONSE_CACHE_PATH = os.getenv("RESPONSE_CACHE_PATH", "")  # 设置后缓存同时写入该SQLite文件，重启后仍然有效
+RESPONSE_CACHE_SIMILARITY = float(os.getenv("RESPONSE_CACHE_SIMILARITY", "0"))  # 近似匹配的相似度阈值，0表示只做精确匹配
+
+# 音频解码配置
+SAMPLE_RATE = 16000  # Whisper要求的采样率
+WHISPER_WINDOW_SAMPLES = 30 * SAMPLE_RATE  # Whisper一次前向计算处理的音频长度（30秒）
+FFMPEG_BINARY = os.getenv("FFMPEG_BINARY", "ffmpeg")
+# 是否保存调试音频（默认关闭，避免热路径上的磁盘写入）
+DEBUG_SAVE_AUDIO = env_flag("DEBUG_SAVE_AUDIO")
+DEBUG_AUDIO_PATH = os.getenv("DEBUG_AUDIO_PATH", os.path.join(os.getcwd(), "debug_audio.webm"))
+
+# 语音活动检测（VAD）配置，在识别之前过滤静音
+VAD_ENABLED = env_flag("VAD_ENABLED", True)
+VAD_FRAME_MS = int(os.getenv("VAD_FRAME_MS", "30"))  # 分帧长度
+VAD_ENERGY_THRESHOLD = float(os.getenv("VAD_ENERGY_THRESHOLD", "0.01"))  # 帧能量(RMS)高于该值视为语音
+VAD_MIN_SPEECH_MS = int(os.getenv("VAD_MIN_SPEECH_MS", "200"))  # 短于该时长的语音段视为噪声丢弃
+VAD_MIN_SILENCE_MS = int(os.getenv("VAD_MIN_SILENCE_MS", "300"))  # 短于该时长的停顿不切分
+VAD_PAD_MS = int(os.getenv("VAD_PAD_MS", "150"))  # 语音段前后保留的余量
+
+# 语音识别调度配置
+# Whisper模型大小（可以选择不同大小的模型：tiny, base, small, medium, large）
+# 较小的模型速度更快但准确性较低，较大的模型准确性更高但需要更多资源
+WHISPER_MODEL = os.getenv("WHISPER_MODEL", "tiny")
+ASR_BACKEND = os.getenv("ASR_BACKEND", "whisper")  # 识别后端：whisper / faster-whisper（CTranslate2 int8）/ 模块:类名
+ASR_WORKERS = max(1, int(os.getenv("ASR_WORKERS", "1")))  # 识别进程数，每个进程持有独立的模型副本
+ASR_WORKER_THREADS = int(os.getenv("ASR_WORKER_THREADS", "0"))  # 每个识别进程的torch线程数，0表示使用默认值
+ASR_DEVICE = os.getenv("ASR_DEVICE", "")  # cpu / cuda，留空时有GPU则用GPU
+ASR_DTYPE = os.getenv("ASR_DTYPE", "")  # whisper后端：float16 / float32，留空时GPU用float16、CPU用float32；faster-whisper后端：CTranslate2计算类型，留空为int8
+ASR_QUANTIZE_INT8 = env_flag("ASR_QUANTIZE_INT8")  # CPU上对Linear层做int8动态量化
+ASR_WARMUP = env_flag("ASR_WARMUP", True)  # 加载后先对一段静音做一次推理，避免首个请求承担初始化开销
+ASR_QUEUE_SIZE = int(os.getenv("ASR_QUEUE_SIZE", "32"))  # 等待识别的任务上限，超出后返回忙碌提示
+ASR_MAX_BATCH = max(1, int(os.getenv("ASR_MAX_BATCH", "8")))  # 跨连接合批的最大音频段数，1表示不合批
+ASR_BATCH_WAIT_MS = float(os.getenv("ASR_BATCH_WAIT_MS", "10"))  # 凑批的最长等待时间（毫秒）
+
+# 识别延迟档位：每档对应一组解码参数，客户端可按连接选择，未选择时使用 ASR_PROFILE
+# temperature 为元组时依次回退重试；beam_size 为 None 表示贪心解码；
+# threads 为该档位的推理线程数（仅 whisper 后端按任务生效），0 表示使用进程默认值
+ASR_PROFILES = {
+    # 单次贪心解码，不做回退和质量检查：延迟稳定，适合实时对话
+    "fast": {
+        "temperature": 0.0,
+        "beam_size": None,
+        "best_of": None,
+        "condition_on_previous_text": False,
+        "compression_ratio_threshold": None,
+        "logprob_threshold": None,
+        "no_speech_threshold": 0.6,
+        "threads": 2,
+    },
+    # 贪心解码，质量检查不通过时最多回退一次
+    "balanced": {
+        "temperature": (0.0, 0.4),
+        "beam_size": None,
+        "best_of": 2,
+        "condition_on_previous_text": False,
+        "compression_ratio_threshold": 2.4,
+        "logprob_threshold": -1.0,
+        "no_speech_threshold": 0.6,
+        "threads": 0,
+    },
+    # 集束搜索加完整的温度回退（Whisper默认行为）：准确率最高，难识别的音频上耗时会成倍增加
+    "accurate": {
+        "temperature": (0.0, 0.2, 0.4, 0.6, 0.8, 1.0),
+        "beam_size": 5,
+        "best_of": 5,
+        "condition_on_previous_text": True,
+        "compression_ratio_threshold": 2.4,
+        "logprob_threshold": -1.0,
+        "no_speech_threshold": 0.6,
+        "threads": 0,
+    },
+}
+# 以JSON形式追加或覆盖档位，如 {"fast": {"threads": 1}, "noisy": {...}}
+for _name, _options in json.loads(os.getenv("ASR_PROFILES_JSON", "") or "{}").items():
+    ASR_PROFILES[_name] = {**ASR_PROFILES.get(_name, ASR_PROFILES["balanced"]), **_options}
+ASR_PROFILE = os.getenv("ASR_PROFILE", "balanced")  # 服务端默认档位
+if ASR_PROFILE not in ASR_PROFILES:
+    logger.warning(f"未知的识别档位 {ASR_PROFILE}，改用 balanced")
+    ASR_PROFILE = "balanced"
+# 拆分部署：设置后本进程只作为网关，识别任务发给独立的识别服务（python main.py asr-server）
+# 地址格式为 unix:///路径 或 tcp://主机:端口，多个识别服务用逗号分隔
+ASR_BROKER_URL = os.getenv("ASR_BROKER_URL", "")
+ASR_BROKER_URLS = [address.strip() for address in ASR_BROKER_URL.split(",") if address.strip()]
+
+# 流式识别配置（客户端持续发送16kHz PCM帧时使用）
+STREAM_STEP_MS = int(os.getenv("STREAM_STEP_MS", "500"))  # 每积累多少毫秒新音频重新识别一次尾部
+STREAM_MAX_SEGMENT_S = float(os.getenv("STREAM_MAX_SEGMENT_S", "15"))  # 未确认尾部的最长时长，超出后强制确认
+STREAM_SILENCE_MS = int(os.getenv("STREAM_SILENCE_MS", "600"))  # 尾部静音达到该时长视为一句话结束
+STREAM_PROMPT_CHARS = int(os.getenv("STREAM_PROMPT_CHARS", "200"))  # 作为prompt的已确认文本最大长度
+STREAM_MAX_BUFFER_S = float(os.getenv("STREAM_MAX_BUFFER_S", "30"))  # 未确认尾部音频的缓冲上限（秒），识别跟不上时丢弃新到达的帧
+
+# 推测式调用大模型（仅流式模式）：识别结果稳定且出现短暂停顿时提前调用大模型
+SPECULATIVE_LLM = env_flag("SPECULATIVE_LLM")
+SPECULATIVE_PAUSE_MS = int(os.getenv("SPECULATIVE_PAUSE_MS", "200"))  # 尾部静音达到该时长开始推测，应小于 STREAM_SILENCE_MS
+SPECULATIVE_MATCH = float(os.getenv("SPECULATIVE_MATCH", "0.9"))  # 确认文本与推测文本的相似度不低于该值时采用推测结果
+
+# 语音合成配置：客户端开启语音播报后，回复按句合成并以二进制消息发送
+TTS_ENGINE = os.getenv("TTS_ENGINE", "")  # tone（测试用音调）/ espeak / 模块:类名，留空不启用
+TTS_VOICE = os.getenv("TTS_VOICE", "cmn")  # espeak-ng 的发音人
+ESPEAK_BINARY = os.getenv("ESPEAK_BINARY", "espeak-ng")
+TTS_MAX_SENTENCE_CHARS = int(os.getenv("TTS_MAX_SENTENCE_CHARS", "60"))  # 没有句末标点时最多累积的字数
+
+# 会话恢复配置：连接断开后处理任务继续运行，结果暂存，客户端带会话ID重连时补发
+SESSION_RESUME_TTL = float(os.getenv("SESSION_RESUME_TTL", "60"))  # 断开后会话保留的时间（秒），0表示断开即释放
+SESSION_OUTBOX_SIZE = int(os.getenv("SESSION_OUTBOX_SIZE", "200"))  # 断开期间暂存的消息条数上限，超出后丢弃最早的
+SESSION_OUTBOX_MAX_BYTES = int(os.getenv("SESSION_OUTBOX_MAX_BYTES", str(2 * 1024 * 1024)))  # 暂存消息的总字节上限（含语音播报音频）
+AUDIO_DEDUP_ENABLED = env_flag("AUDIO_DEDUP_ENABLED", True)  # 重复发送的相同音频直接复用之前的识别结果和回复
+AUDIO_DEDUP_SIZE = int(os.getenv("AUDIO_DEDUP_SIZE", "256"))  # 最多记录的音频段数（LRU淘汰）
+AUDIO_DEDUP_TTL = float(os.getenv("AUDIO_DEDUP_TTL", "300"))  # 记录有效期（秒）
+
+# 准入控制：限制单段音频、单个会话和全局的资源占用，使内存上限可预期
+MAX_AUDIO_BYTES = int(os.getenv("MAX_AUDIO_BYTES", str(2 * 1024 * 1024)))  # 单段音频消息的字节上限
+MAX_AUDIO_SECONDS = float(os.getenv("MAX_AUDIO_SECONDS", "30"))  # 单段音频解码后的时长上限（秒）
+MAX_INFLIGHT_UTTERANCES = int(os.getenv("MAX_INFLIGHT_UTTERANCES", "4"))  # 每个会话同时处理中的语音段上限
+MAX_CONNECTIONS = int(os.getenv("MAX_CONNECTIONS", "200"))  # 同时服务的WebSocket连接上限
+MEMORY_BUDGET_BYTES = int(os.getenv("MEMORY_BUDGET_BYTES", str(256 * 1024 * 1024)))  # 所有会话缓冲字节数的总预算
+ADMISSION_WAIT_S = float(os.getenv("ADMISSION_WAIT_S", "10"))  # 超出连接数或内存预算时新连接的最长排队时间（秒）
+ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", "100"))  # 最多排队的新连接数，超出后直接拒绝
+
+# ---------------- 运行指标 ----------------
+# Prometheus文本格式的简单指标实现，由 /metrics 接口输出
+
+class Metric:
+    """指标基类，按标签组合分别记录取值"""
+
+    metric_type = "untyped"
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.values = {}  # 标签元组 -> 取值
+
+    @staticmethod
+    def _key(labels):
+        return tuple(sorted(labels.items()))
+
+    @staticmethod
+    def _format_labels(pairs):
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}"
+
+    def _samples(self):
+        for key, value in self.values.items():
+            yield self.name, key, value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.metric_type}"]
+        for name, pairs, value in self._samples():
+            lines.append(f"{name}{self._format_labels(pairs)} {value}")
+        return lines
+
+class Counter(Metric):
+    """只增不减的计数器"""
+
+    metric_type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    """当前值；传入 callback 时在输出时实时取值"""
+
+    metric_type = "gauge"
+
+    def __init__(self, name, help_text, callback=None):
+        super().__init__(name, help_text)
+        self.callback = callback
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        self.values[self._key(labels)] = value
+
+    def _samples(self):
+        if self.callback is not None:
+            yield self.name, (), self.callback()
+        else:
+            yield from super()._samples()
+
+class Histogram(Metric):
+    """按桶累计的分布统计"""
+
+    metric_type = "histogram"
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        state = self.values.get(key)
+        if state is None:
+            state = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            state[0][index] += 1
+        state[1] += value
+        state[2] += 1
+
+    def _samples(self):
+        for key, (bucket_counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket", key + (("le", bound),), cumulative
+            yield f"{self.name}_bucket", key + (("le", "+Inf"),), count
+            yield f"{self.name}_sum", key, total
+            yield f"{self.name}_count", key, count
+
+class MetricsRegistry:
+    """指标注册表"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+STAGE_SECONDS = metrics.register(Histogram(
+    "voice_stage_duration_seconds", "各处理阶段耗时（decode/vad/asr_queue/asr/llm_total/tts）"))
+LLM_TTFT_SECONDS = metrics.register(Histogram(
+    "voice_llm_time_to_first_token_seconds", "大模型首个token的等待时间（按模型）"))
+ASR_BATCH_SIZE = metrics.register(Histogram(
+    "voice_asr_batch_size", "每次识别推理的音频段数", buckets=(1, 2, 4, 8, 16, 32)))
+LLM_TOKENS = metrics.register(Counter(
+    "voice_llm_tokens_total", "大模型token用量（来自流式响应的usage字段）"))
+STAGE_ERRORS = metrics.register(Counter(
+    "voice_stage_errors_total", "各处理阶段的错误次数"))
+ASR_REJECTED = metrics.register(Counter(
+    "voice_asr_rejected_total", "因识别队列已满被拒绝的任务数"))
+ASR_POOL_RESTARTS = metrics.register(Counter(
+    "voice_asr_pool_restarts_total", "识别进程异常退出后重建进程池的次数"))
+SESSION_RESUMES = metrics.register(Counter(
+    "voice_session_resumes_total", "会话恢复结果（resumed/expired/unknown）"))
+SESSION_OUTBOX_DROPPED = metrics.register(Counter(
+    "voice_session_outbox_dropped_total", "断开期间因待发队列已满被丢弃的消息数"))
+AUDIO_DEDUP_HITS = metrics.register(Counter(
+    "voice_audio_dedup_hits_total", "重复发送的音频直接复用之前结果的次数"))
+AUDIO_REJECTED = metrics.register(Counter(
+    "voice_audio_rejected_total", "被准入控制拒绝的音频段数（size/duration/inflight/memory）"))
+CONNECTIONS_REJECTED = metrics.register(Counter(
+    "voice_connections_rejected_total", "因连接数或内存预算超限被拒绝的新连接数"))
+STREAM_DROPPED_BYTES = metrics.register(Counter(
+    "voice_stream_dropped_bytes_total", "流式模式下因尾部缓冲已满丢弃的PCM字节数"))
+ACTIVE_CONNECTIONS = metrics.register(Gauge(
+    "voice_active_websocket_connections", "当前WebSocket连接数"))
+SPECULATIVE_RESULTS = metrics.register(Counter(
+    "voice_llm_speculative_total", "推测式大模型调用的结果（hit/miss）"))
+SPECULATIVE_WASTED_TOKENS = metrics.register(Counter(
+    "voice_llm_speculative_wasted_tokens_total", "未被采用的推测式调用消耗的token数（估算）"))
+TTS_FIRST_AUDIO_SECONDS = metrics.register(Histogram(
+    "voice_tts_time_to_first_audio_seconds", "从开始生成回复到发出第一段语音的时间"))
+LLM_REQUESTS = metrics.register(Counter(
+    "voice_llm_requests_total", "大模型请求的结果（won/lost/error/timeout，按模型和用途）"))
+LLM_CIRCUIT_OPEN = metrics.register(Gauge(
+    "voice_llm_circuit_open", "大模型熔断状态，1表示熔断中（按模型）"))
+
+# ---------------- 识别进程内的代码 ----------------
+# 以下代码在子进程中执行，每个子进程只创建一次自己的识别后端（含模型）
+
+_worker_backend = None
+
+def _quantize_linear_layers(model):
+    """
+    对模型的Linear层做int8动态量化（仅适用于CPU）
+
+    Whisper使用自定义的Linear子类，量化工具只识别标准 nn.Linear，
+    因此先替换成权重相同的标准 nn.Linear 再量化。
+    """
+    import torch
+    for module in list(model.modules()):
+        for name, child in module.named_children():
+            if isinstance(child, torch.nn.Linear) and type(child) is not torch.nn.Linear:
+                linear = torch.nn.Linear(child.in_features, child.out_features, bias=child.bias is not None)
+                linear.load_state_dict(child.state_dict())
+                setattr(module, name, linear)
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+class ASRBackend:
+    """
+    识别后端接口，每个识别进程持有一个实例
+
+    解码参数统一使用 openai-whisper 的 transcribe 风格（language、temperature、initial_prompt 等），
+    由各后端转换为自己的参数。
+
+    - transcribe: 转写一段音频
+    - transcribe_batch: 转写多段不超过30秒的音频，默认逐段调用 transcribe
+    - transcribe_stream: 流式模式反复识别未确认的尾部，默认只做一次贪心解码、不输出时间戳
+    """
+
+    name = "base"
+
+    def __init__(self, config):
+        self.config = config
+
+    def describe(self):
+        """用于日志的后端说明"""
+        return self.name
+
+    def set_threads(self, threads):
+        """设置本次任务的推理线程数，0 表示恢复进程默认值；不支持按任务调整的后端忽略"""
+
+    def transcribe(self, audio, options):
+        """
+        参数:
+            audio (np.ndarray): 16kHz float32 音频
+            options (dict): 解码参数
+
+        返回:
+            str: 识别文本
+        """
+        raise NotImplementedError
+
+    def transcribe_batch(self, audios, options):
+        """返回与输入顺序一致的识别文本列表"""
+        return [self.transcribe(audio, options) for audio in audios]
+
+    def transcribe_stream(self, audio, options):
+        """流式识别入口：尾部会被反复识别，不做温度回退重试，也不以之前的输出为条件"""
+        return self.transcribe(audio, {
+            **options,
+            "temperature": 0.0,
+            "condition_on_previous_text": False,
+            "without_timestamps": True,
+        })
+
+class WhisperBackend(ASRBackend):
+    """
+    openai-whisper（PyTorch）后端，支持int8动态量化和批量解码
+
+    openai-whisper 和 torch 只在识别进程创建该后端时导入，网关进程（及使用其他后端时）不需要安装。
+    """
+
+    name = "whisper"
+
+    def __init__(self, config):
+        super().__init__(config)
+        import torch
+        import whisper
+        self.whisper = whisper
+        # transcribe 参数中可以直接传给 DecodingOptions 的字段
+        self.decoding_fields = {field.name for field in dataclasses.fields(whisper.DecodingOptions)}
+        if config["threads"] > 0:
+            torch.set_num_threads(config["threads"])
+        self.default_threads = torch.get_num_threads()
+        model = whisper.load_model(config["model"], device=config["device"] or None)
+        on_cpu = model.device.type == "cpu"
+        self.dtype = config["dtype"] or ("float32" if on_cpu else "float16")
+        self.quantized = bool(config["quantize_int8"]) and on_cpu
+        if config["quantize_int8"] and not on_cpu:
+            logger.warning("int8动态量化只支持CPU，已忽略 ASR_QUANTIZE_INT8")
+        if self.quantized:
+            model = _quantize_linear_layers(model)
+        self.model = model
+        # 该进程所有识别请求的默认解码参数
+        self.decode_defaults = {"fp16": self.dtype == "float16" and not on_cpu}
+
+    def describe(self):
+        return f"whisper(设备={self.model.device}, 精度={self.dtype}, int8量化={self.quantized})"
+
+    def set_threads(self, threads):
+        import torch
+        threads = threads or self.default_threads
+        if torch.get_num_threads() != threads:
+            torch.set_num_threads(threads)
+
+    def transcribe(self, audio, options):
+        result = self.model.transcribe(audio, **{**self.decode_defaults, **options})
+        return result["text"]
+
+    def transcribe_batch(self, audios, options):
+        """
+        批量转写多段音频（每段不超过30秒）
+
+        每段单独计算 log-mel 频谱后堆叠成一个批次，编码器和解码器各只做一次前向计算。
+        批量路径只做单次解码，不做温度回退重试。
+        """
+        if len(audios) == 1:
+            return [self.transcribe(audios[0], options)]
+
+        import torch
+        whisper = self.whisper
+        model = self.model
+        mel = torch.stack([
+            whisper.log_mel_spectrogram(whisper.pad_or_trim(audio), n_mels=model.dims.n_mels)
+            for audio in audios
+        ]).to(model.device)
+
+        decode_kwargs = {key: value for key, value in options.items() if key in self.decoding_fields}
+        if isinstance(decode_kwargs.get("temperature"), (tuple, list)):
+            decode_kwargs["temperature"] = decode_kwargs["temperature"][0]
+        # 与 transcribe 一致：贪心/集束搜索不使用 best_of，采样不使用 beam_size
+        if decode_kwargs.get("temperature", 0.0) == 0:
+            decode_kwargs.pop("best_of", None)
+        else:
+            decode_kwargs.pop("beam_size", None)
+            decode_kwargs.pop("patience", None)
+        if options.get("initial_prompt"):
+            decode_kwargs["prompt"] = options["initial_prompt"]
+        decode_kwargs.setdefault("fp16", self.decode_defaults.get("fp16", False))
+        decode_kwargs.setdefault("without_timestamps", True)
+
+        results = whisper.decode(model, mel, whisper.DecodingOptions(**decode_kwargs))
+
+        # 与 transcribe 一致：判定为无语音的段落返回空文本
+        no_speech_threshold = options.get("no_speech_threshold", 0.6)
+        logprob_threshold = options.get("logprob_threshold", -1.0)
+        texts = []
+        for result in results:
+            silent = (
+                no_speech_threshold is not None
+                and result.no_speech_prob > no_speech_threshold
+                and (logprob_threshold is None or result.avg_logprob < logprob_threshold)
+            )
+            texts.append("" if silent else result.text)
+        return texts
+
+class FasterWhisperBackend(ASRBackend):
+    """
+    faster-whisper（CTranslate2）后端，需要另外安装 faster-whisper
+
+    默认以int8计算（可用 ASR_DTYPE 改为 float16/float32 等 CTranslate2 计算类型），
+    CPU上的实时率通常明显优于PyTorch版本。模型名与 WHISPER_MODEL 相同，首次使用时自动下载转换好的模型。
+    """
+
+    name = "faster-whisper"
+    # transcribe 风格参数名到 faster-whisper 参数名的映射
+    OPTION_ALIASES = {"logprob_threshold": "log_prob_threshold"}
+    # 取值为 None 时的替代值（openai-whisper 中 beam_size=None 表示贪心解码）
+    NONE_VALUES = {"beam_size": 1}
+    # 线程数在加载模型时确定（cpu_threads），不支持按任务调整
+
+    def __init__(self, config):
+        super().__init__(config)
+        try:
+            from faster_whisper import WhisperModel
+        except ImportError as e:
+            raise RuntimeError("使用 faster-whisper 后端需要先安装: pip install faster-whisper") from e
+        import inspect
+        self.device = config["device"] or "auto"
+        self.compute_type = config["dtype"] or "int8"
+        self.model = WhisperModel(
+            config["model"],
+            device=self.device,
+            compute_type=self.compute_type,
+            cpu_threads=max(0, config["threads"]),
+        )
+        self.supported_options = set(inspect.signature(self.model.transcribe).parameters)
+
+    def describe(self):
+        return f"faster-whisper(设备={self.device}, 计算类型={self.compute_type})"
+
+    def _convert_options(self, options):
+        converted = {}
+        for key, value in options.items():
+            key = self.OPTION_ALIASES.get(key, key)
+            # fp16 等 openai-whisper 特有的参数直接忽略
+            if key not in self.supported_options:
+                continue
+            if value is None and key in self.NONE_VALUES:
+                value = self.NONE_VALUES[key]
+            elif value is None and key in ("best_of", "patience"):
+                continue
+            converted[key] = value
+        return converted
+
+    def transcribe(self, audio, options):
+        segments, _ = self.model.transcribe(audio, **self._convert_options(options))
+        # segments 是生成器，遍历时才真正解码
+        return "".join(segment.text for segment in segments)
+
+ASR_BACKENDS = {backend.name: backend for backend in (WhisperBackend, FasterWhisperBackend)}
+
+def create_asr_backend(config):
+    """
+    按配置创建识别后端
+
+    参数:
+        config (dict): 识别进程配置，config["backend"] 为内置后端名（whisper / faster-whisper）
+            或 "模块:类名" 形式的自定义 ASRBackend 子类
+
+    返回:
+        ASRBackend
+    """
+    name = config.get("backend") or "whisper"
+    if name in ASR_BACKENDS:
+        return ASR_BACKENDS[name](config)
+    module_name, _, class_name = name.partition(":")
+    return getattr(importlib.import_module(module_name), class_name)(config)
+
+def _init_asr_worker(config):
+    """识别进程初始化：创建识别后端（加载模型）并预热"""
+    global _worker_backend
+    started = time.perf_counter()
+    _worker_backend = create_asr_backend(config)
+    loaded = time.perf_counter()
+    if config["warmup"]:
+        _worker_backend.transcribe(np.zeros(SAMPLE_RATE, dtype=np.float32), {"language": "zh"})
+    logger.info(
+        f"识别进程 {os.getpid()} 就绪: 模型={config['model']}, 后端={_worker_backend.describe()}, "
+        f"加载耗时={loaded - started:.2f}秒, 预热耗时={time.perf_counter() - loaded:.2f}秒"
+    )
+
+def _asr_worker_ready():
+    """空任务，用于在启动时提前拉起识别进程"""
+    return os.getpid()
+
+def _transcribe_batch_in_worker(audios, options, stream=False):
+    """
+    在识别进程中转写一批音频
+
+    参数:
+        audios (list[np.ndarray]): 16kHz float32 音频列表，多段时每段不超过30秒
+        options (dict): transcribe 风格的解码参数，整批共用；可包含 threads（本批的推理线程数）
+        stream (bool): 是否为流式模式的尾部识别
+
+    返回:
+        list[str]: 与输入顺序一致的识别文本
+    """
+    options = dict(options)
+    _worker_backend.set_threads(options.pop("threads", 0))
+    if stream:
+        return [_worker_backend.transcribe_stream(audio, options) for audio in audios]
+    if len(audios) == 1:
+        return [_worker_backend.transcribe(audios[0], options)]
+    return _worker_backend.transcribe_batch(audios, options)
+
+# ---------------- 主进程内的调度器 ----------------
+
+class ASRBusyError(Exception):
+    """识别队列已满时抛出，调用方应向客户端返回忙碌提示"""
+
+class ASRJob:
+    """一次待识别的任务"""
+
+    def __init__(self, connection_id, audio, options, stream=False):
+        self.connection_id = connection_id
+        self.audio = audio
+        self.options = options
+        self.stream = stream
+        self.future = asyncio.get_event_loop().create_future()
+        self.submitted_at = time.perf_counter()
+        # 不超过30秒的音频可以与解码参数相同的其他任务合批
+        self.batchable = len(audio) <= WHISPER_WINDOW_SAMPLES
+        self.batch_key = repr((stream, sorted(options.items())))
+
+class ASRScheduler:
+    """
+    语音识别调度器
+
+    - 使用进程池执行识别，每个进程持有独立的模型副本，避免GIL和torch线程争用
+    - 等待队列有上限，队列满时立即拒绝，由调用方向客户端发送忙碌提示
+    - 按连接分队列并轮询出队，单个连接的大量音频不会饿死其他连接
+    - 在短时间窗口内收集多个连接的音频合成一批，一次前向计算完成识别
+    """
+
+    def __init__(self, worker_config, num_workers, max_queue, max_batch=1, batch_wait=0.0):
+        self.worker_config = worker_config
+        self.num_workers = num_workers
+        self.max_queue = max_queue
+        self.max_batch = max_batch
+        self.batch_wait = batch_wait
+        self.executor = None
+        self.queues = {}  # connection_id -> deque[ASRJob]
+        self.ready_connections = deque()  # 有待处理任务的连接，按轮询顺序排列
+        self.pending = 0
+        self.job_available = asyncio.Event()
+        self.dispatchers = []
+        self.ready = False  # 全部识别进程加载并预热完成后为True
+        self.startup_seconds = None  # 从开始启动到就绪的耗时
+        self.first_transcription_seconds = None  # 第一个识别请求的耗时
+        self.restart_lock = asyncio.Lock()
+
+    async def start(self):
+        """
+        创建进程池并等待全部识别进程加载、预热完成
+
+        进程池和调度循环会先创建好，因此在就绪之前提交的任务会排队等待，而不是失败。
+        """
+        started = time.perf_counter()
+        self.executor = self._create_executor()
+        self.dispatchers = [asyncio.create_task(self._dispatch_loop()) for _ in range(self.num_workers)]
+        try:
+            await self._warm_up(self.executor)
+        except Exception as e:
+            logger.error(f"识别进程池启动失败: {e}")
+            raise
+
+        self.startup_seconds = time.perf_counter() - started
+        self.ready = True
+        logger.info(
+            f"识别进程池已就绪: 模型={self.worker_config['model']}, 后端={self.worker_config['backend']}, "
+            f"进程数={self.num_workers}, "
+            f"队列上限={self.max_queue}, 最大批次={self.max_batch}, 凑批等待={self.batch_wait * 1000:.0f}ms, "
+            f"启动耗时={self.startup_seconds:.2f}秒"
+        )
+
+    def _create_executor(self):
+        """创建识别进程池，每个进程启动时加载模型"""
+        return ProcessPoolExecutor(
+            max_workers=self.num_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_asr_worker,
+            initargs=(self.worker_config,),
+        )
+
+    async def _warm_up(self, executor):
+        """反复提交空任务，直到每个识别进程都完成初始化并应答过"""
+        loop = asyncio.get_event_loop()
+        ready_pids = set()
+        while len(ready_pids) < self.num_workers:
+            pids = await asyncio.gather(*[
+                loop.run_in_executor(executor, _asr_worker_ready)
+                for _ in range(self.num_workers)
+            ])
+            ready_pids.update(pids)
+            if len(ready_pids) < self.num_workers:
+                await asyncio.sleep(0.2)
+
+    async def _restart_pool(self, broken):
+        """
+        识别进程意外退出后重建进程池
+
+        进程池中任一进程异常退出（被OOM杀死、段错误等）后，整个进程池都无法再提交任务。
+        重建期间 ready 为False（/ready 返回503），调度循环在新进程池预热完成前不会取任务，
+        排队的任务会继续等待而不是失败。多个调度循环同时发现时只重建一次。
+
+        参数:
+            broken (ProcessPoolExecutor): 发现已损坏的进程池
+        """
+        async with self.restart_lock:
+            if self.executor is not broken:
+                return  # 其他调度循环已经重建过
+            self.ready = False
+            ASR_POOL_RESTARTS.inc()
+            logger.error("识别进程异常退出，进程池已损坏，正在重建")
+            broken.shutdown(wait=False, cancel_futures=True)
+            started = time.perf_counter()
+            while True:
+                executor = self._create_executor()
+                try:
+                    await self._warm_up(executor)
+                    break
+                except Exception as e:
+                    logger.error(f"识别进程池重建失败，稍后重试: {e}")
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    await asyncio.sleep(1.0)
+                except asyncio.CancelledError:
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    raise
+            self.executor = executor
+            self.ready = True
+            logger.info(f"识别进程池已重建，耗时={time.perf_counter() - started:.2f}秒")
+
+    async def stop(self):
+        """停止调度并关闭进程池，未完成的任务以异常结束"""
+        self.ready = False
+        for task in self.dispatchers:
+            task.cancel()
+        await asyncio.gather(*self.dispatchers, return_exceptions=True)
+        for connection_queue in self.queues.values():
+            for job in connection_queue:
+                if not job.future.done():
+                    job.future.set_exception(RuntimeError("识别服务已停止"))
+        self.queues.clear()
+        self.ready_connections.clear()
+        self.pending = 0
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def queue_depth(self):
+        """当前等待识别的任务数"""
+        return self.pending
+
+    async def transcribe(self, connection_id, audio, stream=False, **options):
+        """
+        提交识别任务并等待结果
+
+        参数:
+            connection_id (str): 所属连接，用于公平调度
+            audio (np.ndarray): 16kHz float32 音频
+            stream (bool): 是否为流式模式的尾部识别（使用后端的流式识别入口）
+            options: 透传给识别后端的解码参数（transcribe 风格）
+
+        返回:
+            str: 识别的文本
+
+        异常:
+            ASRBusyError: 等待队列已满
+        """
+        if self.pending >= self.max_queue:
+            ASR_REJECTED.inc()
+            raise ASRBusyError(f"识别队列已满 ({self.pending}/{self.max_queue})")
+        job = ASRJob(connection_id, audio, options, stream)
+        connection_queue = self.queues.get(connection_id)
+        if connection_queue is None:
+            connection_queue = self.queues[connection_id] = deque()
+        if not connection_queue:
+            self.ready_connections.append(connection_id)
+        connection_queue.append(job)
+        self.pending += 1
+        self.job_available.set()
+        try:
+            return await job.future
+        except asyncio.CancelledError:
+            # 调用方已放弃，若任务仍在排队则移出队列
+            if job in connection_queue:
+                connection_queue.remove(job)
+                self.pending -= 1
+                if not connection_queue:
+                    del self.queues[connection_id]
+                    self.ready_connections.remove(connection_id)
+            raise
+
+    def _take_job(self, match=None):
+        """
+        按连接轮询取出下一个任务
+
+        参数:
+            match (callable): 可选的筛选条件，只取队首任务满足条件的连接
+
+        返回:
+            ASRJob | None: 没有符合条件的任务时返回None
+        """
+        for _ in range(len(self.ready_connections)):
+            connection_id = self.ready_connections.popleft()
+            connection_queue = self.queues.get(connection_id)
+            if not connection_queue:
+                self.queues.pop(connection_id, None)
+                continue
+            if match is not None and not match(connection_queue[0]):
+                self.ready_connections.append(connection_id)
+                continue
+            job = connection_queue.popleft()
+            if connection_queue:
+                self.ready_connections.append(connection_id)
+            else:
+                del self.queues[connection_id]
+            self.pending -= 1
+            return job
+        return None
+
+    async def _collect_batch(self, first):
+        """以 first 为首，在等待窗口内收集解码参数相同的任务组成一批"""
+        batch = [first]
+        if not first.batchable or self.max_batch <= 1:
+            return batch
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + self.batch_wait
+        match = lambda job: job.batchable and job.batch_key == first.batch_key
+        while len(batch) < self.max_batch:
+            job = self._take_job(match)
+            if job is not None:
+                batch.append(job)
+                continue
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            self.job_available.clear()
+            try:
+                await asyncio.wait_for(self.job_available.wait(), remaining)
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _dispatch_loop(self):
+        """每个循环占用一个识别进程，不断取任务（或一批任务）执行"""
+        loop = asyncio.get_event_loop()
+        while True:
+            if self.restart_lock.locked():
+                # 进程池重建中，等重建完成再取任务
+                async with self.restart_lock:
+                    pass
+            first = self._take_job()
+            if first is None:
+                self.job_available.clear()
+                await self.job_available.wait()
+                continue
+            batch = [first]
+            executor = self.executor
+            try:
+                batch = await self._collect_batch(first)
+                if len(batch) > 1:
+                    logger.info(f"合批识别: {len(batch)} 段音频")
+                started = time.perf_counter()
+                for job in batch:
+                    STAGE_SECONDS.observe(started - job.submitted_at, stage="asr_queue")
+                ASR_BATCH_SIZE.observe(len(batch))
+                texts = await loop.run_in_executor(
+                    executor,
+                    _transcribe_batch_in_worker,
+                    [job.audio for job in batch],
+                    first.options,
+                    first.stream,
+                )
+                STAGE_SECONDS.observe(time.perf_counter() - started, stage="asr")
+                if self.first_transcription_seconds is None:
+                    self.first_transcription_seconds = time.perf_counter() - started
+                    logger.info(f"首次识别耗时: {self.first_transcription_seconds:.3f}秒")
+                for job, text in zip(batch, texts):
+                    if not job.future.done():
+                        job.future.set_result(text)
+            except asyncio.CancelledError:
+                for job in batch:
+                    if not job.future.done():
+                        job.future.set_exception(RuntimeError("识别服务已停止"))
+                raise
+            except BrokenProcessPool as e:
+                STAGE_ERRORS.inc(stage="asr")
+                for job in batch:
+                    if not job.future.done():
+                        job.future.set_exception(e)
+                await self._restart_pool(executor)
+            except Exception as e:
+                STAGE_ERRORS.inc(stage="asr")
+                for job in batch:
+                    if not job.future.done():
+                        job.future.set_exception(e)
+
+# ---------------- 拆分部署：网关与识别服务 ----------------
+# 设置 ASR_BROKER_URL 后，本进程只作为网关处理WebSocket连接，不加载模型；
+# 识别任务通过Unix套接字或TCP发给独立运行的识别服务（python main.py asr-server），
+# 网关进程和识别服务可以分别扩容，识别服务也可以部署在其他机器上。
+#
+# 帧格式：8字节头（JSON长度、负载长度，网络字节序）+ JSON + 负载
+# 网关 → 识别服务: {"type": "transcribe", "id", "connection_id", "options", "stream"} + float32音频
+#                  {"type": "cancel", "id"}
+# 识别服务 → 网关: {"type": "result", "id", "text"} / {"type": "result", "id", "busy": true}
+#                  {"type": "result", "id", "error"} / {"type": "status", "ready", "queue_depth"}
+
+_FRAME_HEADER = struct.Struct("!II")
+
+def _encode_frame(message, payload=b""):
+    """把一条消息编码为完整的帧，调用方一次写入，避免并发写入时帧交错"""
+    header = json.dumps(message, ensure_ascii=False).encode("utf-8")
+    return _FRAME_HEADER.pack(len(header), len(payload)) + header + payload
+
+async def _read_frame(reader):
+    """
+    读取一帧
+
+    返回:
+        tuple[dict, bytes]: 消息和负载
+
+    异常:
+        asyncio.IncompleteReadError: 对端已关闭连接
+    """
+    header_size, payload_size = _FRAME_HEADER.unpack(await reader.readexactly(_FRAME_HEADER.size))
+    message = json.loads(await reader.readexactly(header_size))
+    payload = await reader.readexactly(payload_size) if payload_size else b""
+    return message, payload
+
+def _parse_broker_address(address):
+    """
+    解析识别服务地址
+
+    参数:
+        address (str): unix:///路径、tcp://主机:端口，或直接写套接字文件路径
+
+    返回:
+        tuple[str, tuple]: ("unix", (路径,)) 或 ("tcp", (主机, 端口))
+    """
+    address = address.strip()
+    if address.startswith("tcp://"):
+        host, _, port = address[len("tcp://"):].rpartition(":")
+        return "tcp", (host or "127.0.0.1", int(port))
+    if address.startswith("unix://"):
+        address = address[len("unix://"):]
+    return "unix", (address,)
+
+class BrokerLink:
+    """网关到一个识别服务的长连接，断开后自动重连；多个请求复用同一连接，按 id 对应结果"""
+
+    def __init__(self, address):
+        self.address = address
+        self.kind, self.target = _parse_broker_address(address)
+        self.writer = None
+        self.ready = False  # 已连接且识别服务报告模型就绪
+        self.remote_queue_depth = 0
+        self.pending = {}  # 请求id -> Future
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+        self._disconnected(RuntimeError("识别服务已停止"))
+
+    def load(self):
+        """用于选择识别服务：本网关在途任务数 + 识别服务上报的排队数"""
+        return len(self.pending) + self.remote_queue_depth
+
+    async def _run(self):
+        retry_delay = 0.5
+        while True:
+            try:
+                if self.kind == "unix":
+                    reader, writer = await asyncio.open_unix_connection(*self.target)
+                else:
+                    reader, writer = await asyncio.open_connection(*self.target)
+            except OSError as e:
+                logger.warning(f"连接识别服务 {self.address} 失败: {e}，{retry_delay:.1f}秒后重试")
+                await asyncio.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, 10)
+                continue
+            retry_delay = 0.5
+            self.writer = writer
+            logger.info(f"已连接识别服务 {self.address}")
+            try:
+                while True:
+                    message, _ = await _read_frame(reader)
+                    if message.get("type") == "status":
+                        if message.get("ready") and not self.ready:
+                            logger.info(f"识别服务 {self.address} 已就绪")
+                        self.ready = bool(message.get("ready"))
+                        self.remote_queue_depth = int(message.get("queue_depth", 0))
+                        continue
+                    future = self.pending.pop(message.get("id"), None)
+                    if future is None or future.done():
+                        continue
+                    if message.get("busy"):
+                        future.set_exception(ASRBusyError(message.get("error", "识别服务繁忙")))
+                    elif "error" in message:
+                        future.set_exception(RuntimeError(f"识别服务出错: {message['error']}"))
+                    else:
+                        future.set_result(message.get("text", ""))
+            except (asyncio.IncompleteReadError, ConnectionError) as e:
+                logger.warning(f"与识别服务 {self.address} 的连接断开: {e}")
+            finally:
+                writer.close()
+                self._disconnected(RuntimeError("与识别服务的连接断开"))
+
+    def _disconnected(self, error):
+        self.writer = None
+        self.ready = False
+        pending, self.pending = self.pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(error)
+
+    async def transcribe(self, connection_id, audio, options, stream=False):
+        request_id = uuid.uuid4().hex
+        future = asyncio.get_event_loop().create_future()
+        self.pending[request_id] = future
+        writer = self.writer
+        writer.write(_encode_frame(
+            {
+                "type": "transcribe",
+                "id": request_id,
+                "connection_id": connection_id,
+                "options": options,
+                "stream": stream,
+            },
+            np.ascontiguousarray(audio, dtype=np.float32).tobytes(),
+        ))
+        try:
+            await writer.drain()
+            return await future
+        except asyncio.CancelledError:
+            # 调用方已放弃（例如连接断开），通知识别服务把任务移出队列
+            if self.pending.pop(request_id, None) is not None and self.writer is writer:
+                writer.write(_encode_frame({"type": "cancel", "id": request_id}))
+            raise
+        finally:
+            self.pending.pop(request_id, None)
+
+class RemoteASRScheduler:
+    """
+    网关模式下的识别调度器，接口与 ASRScheduler 相同
+
+    任务发给当前负载最低的已就绪识别服务；没有可用的识别服务时按忙碌处理。
+    公平调度、合批和排队上限由识别服务端的 ASRScheduler 负责。
+    """
+
+    def __init__(self, addresses):
+        self.links = [BrokerLink(address) for address in addresses]
+        self.startup_seconds = None
+        self.first_transcription_seconds = None
+        self.started_at = None
+
+    @property
+    def ready(self):
+        return any(link.ready for link in self.links)
+
+    async def start(self):
+        """连接全部识别服务，等到至少一个就绪后返回"""
+        self.started_at = time.perf_counter()
+        for link in self.links:
+            link.start()
+        while not self.ready:
+            await asyncio.sleep(0.1)
+        self.startup_seconds = time.perf_counter() - self.started_at
+        logger.info(
+            f"网关模式: 识别服务={', '.join(link.address for link in self.links)}, "
+            f"启动耗时={self.startup_seconds:.2f}秒"
+        )
+
+    async def stop(self):
+        await asyncio.gather(*[link.stop() for link in self.links])
+
+    def queue_depth(self):
+        """本网关发出、尚未返回结果的任务数"""
+        return sum(len(link.pending) for link in self.links)
+
+    async def transcribe(self, connection_id, audio, stream=False, **options):
+        """
+        把识别任务发给负载最低的识别服务并等待结果
+
+        异常:
+            ASRBusyError: 没有可用的识别服务，或识别服务队列已满
+        """
+        links = [link for link in self.links if link.ready and link.writer is not None]
+        if not links:
+            ASR_REJECTED.inc()
+            raise ASRBusyError("没有可用的识别服务")
+        link = min(links, key=lambda link: link.load())
+        started = time.perf_counter()
+        try:
+            text = await link.transcribe(connection_id, audio, options, stream)
+        except ASRBusyError:
+            ASR_REJECTED.inc()
+            raise
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            STAGE_ERRORS.inc(stage="asr")
+            raise
+        # 网关侧记录的是往返耗时（含识别服务内的排队）
+        STAGE_SECONDS.observe(time.perf_counter() - started, stage="asr")
+        if self.first_transcription_seconds is None:
+            self.first_transcription_seconds = time.perf_counter() - started
+        return text
+
+class ASRBrokerServer:
+    """
+    独立运行的识别服务：接收网关发来的任务，交给本机的 ASRScheduler 处理
+
+    每个网关连接上的任务并发处理，结果按请求 id 返回；任务的连接标识加上网关前缀，
+    因此多个网关的连接一起参与轮询调度。
+    """
+
+    def __init__(self, address, scheduler, status_interval=1.0):
+        self.address = address
+        self.kind, self.target = _parse_broker_address(address)
+        self.scheduler = scheduler
+        self.status_interval = status_interval
+        self.server = None
+        self.gateways = set()  # 已连接网关的 writer
+
+    async def serve_forever(self):
+        if self.kind == "unix":
+            path = self.target[0]
+            if os.path.exists(path):
+                os.unlink(path)  # 上次运行遗留的套接字文件
+            self.server = await asyncio.start_unix_server(self._handle_gateway, path)
+        else:
+            self.server = await asyncio.start_server(self._handle_gateway, *self.target)
+        logger.info(f"识别服务监听 {self.address}")
+        startup_task = asyncio.create_task(self.scheduler.start())
+        try:
+            async with self.server:
+                await self.server.serve_forever()
+        finally:
+            if not startup_task.done():
+                startup_task.cancel()
+            await asyncio.gather(startup_task, return_exceptions=True)
+            # 关闭网关连接，网关随即把本服务标记为不可用
+            for writer in list(self.gateways):
+                writer.close()
+            await self.scheduler.stop()
+
+    async def _handle_gateway(self, reader, writer):
+        gateway_id = uuid.uuid4().hex[:8]
+        logger.info(f"网关 {gateway_id} 已连接")
+        self.gateways.add(writer)
+        jobs = {}  # 请求id -> Task
+
+        def send(message):
+            if not writer.is_closing():
+                writer.write(_encode_frame(message))
+
+        async def report_status():
+            while True:
+                send({"type": "status", "ready": self.scheduler.ready, "queue_depth": self.scheduler.queue_depth()})
+                await asyncio.sleep(self.status_interval)
+
+        async def run_job(request_id, connection_id, audio, options, stream):
+            try:
+                text = await self.scheduler.transcribe(
+                    f"{gateway_id}:{connection_id}", audio, stream=stream, **options
+                )
+                send({"type": "result", "id": request_id, "text": text})
+            except ASRBusyError as e:
+                send({"type": "result", "id": request_id, "busy": True, "error": str(e)})
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                send({"type": "result", "id": request_id, "error": str(e)})
+            finally:
+                jobs.pop(request_id, None)
+
+        status_task = asyncio.create_task(report_status())
+        try:
+            while True:
+                message, payload = await _read_frame(reader)
+                if message.get("type") == "transcribe":
+                    audio = np.frombuffer(payload, dtype=np.float32)
+                    jobs[message["id"]] = asyncio.create_task(run_job(
+                        message["id"], message.get("connection_id", ""), audio,
+                        message.get("options") or {}, bool(message.get("stream")),
+                    ))
+                elif message.get("type") == "cancel":
+                    task = jobs.pop(message.get("id"), None)
+                    if task is not None:
+                        task.cancel()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            logger.info(f"网关 {gateway_id} 已断开，取消 {len(jobs)} 个未完成的任务")
+            status_task.cancel()
+            for task in list(jobs.values()):
+                task.cancel()
+            await asyncio.gather(status_task, *jobs.values(), return_exceptions=True)
+            self.gateways.discard(writer)
+            writer.close()
+
+def asr_worker_config():
+    """识别进程的配置（传给 create_asr_backend）"""
+    return {
+        "backend": ASR_BACKEND,
+        "model": WHISPER_MODEL,
+        "device": ASR_DEVICE,
+        "dtype": ASR_DTYPE,
+        "threads": ASR_WORKER_THREADS,
+        "quantize_int8": ASR_QUANTIZE_INT8,
+        "warmup": ASR_WARMUP,
+    }
+
+def create_local_asr_scheduler():
+    """按配置创建本机的识别进程池调度器"""
+    return ASRScheduler(
+        asr_worker_config(),
+        ASR_WORKERS,
+        ASR_QUEUE_SIZE,
+        max_batch=ASR_MAX_BATCH,
+        batch_wait=ASR_BATCH_WAIT_MS / 1000,
+    )
+
+def asr_profile_options(profile=None):
+    """
+    返回识别档位对应的解码参数
+
+    参数:
+        profile (str): 档位名，为空时使用服务端默认档位 ASR_PROFILE
+    """
+    return dict(ASR_PROFILES[profile or ASR_PROFILE])
+
+# 网关模式下不加载模型，识别任务发给独立的识别服务
+asr_scheduler = RemoteASRScheduler(ASR_BROKER_URLS) if ASR_BROKER_URLS else create_local_asr_scheduler()
+
+metrics.register(Gauge("voice_asr_queue_depth", "等待识别的任务数", callback=asr_scheduler.queue_depth))
+
+def detect_server_workers():
+    """
+    估计承载本应用的服务进程数
+
+    uvicorn / gunicorn 的 --workers 默认取 WEB_CONCURRENCY；uvicorn 以 spawn 方式启动工作进程，
+    子进程的 sys.argv 与主进程相同，因此也检查命令行中的 --workers / -w。
+
+    返回:
+        int: 服务进程数，无法判断时为1
+    """
+    workers = int(os.getenv("WEB_CONCURRENCY", "1") or "1")
+    argv = sys.argv[1:]
+    for i, arg in enumerate(argv):
+        if arg.startswith("--workers="):
+            workers = int(arg.split("=", 1)[1])
+        elif arg in ("--workers", "-w") and i + 1 < len(argv) and argv[i + 1].isdigit():
+            workers = int(argv[i + 1])
+    return workers
+
+@asynccontextmanager
+async def lifespan(app):
+    """
+    应用生命周期：启动和关闭识别进程池、大模型连接池
+
+    识别模型和tiktoken编码在后台加载，不阻塞端口监听；识别模型加载和预热完成前 /ready 返回503。
+    """
+    if not tongyi_api_key:
+        logger.warning("警告: 未设置通义千问API密钥，请在.env文件中配置TONGYI_API_KEY")
+    workers = detect_server_workers()
+    if workers > 1:
+        # 会话、音频去重记录和准入预算都保存在进程内存中
+        logger.warning(
+            f"检测到 {workers} 个服务进程：会话只存在于创建它的进程中，重连落到其他进程时无法恢复，"
+            f"MAX_CONNECTIONS / MEMORY_BUDGET_BYTES 也按进程分别计算。"
+            f"请在负载均衡上按会话ID做粘性路由，或只运行一个服务进程"
+        )
+    startup_task = asyncio.create_task(asr_scheduler.start())
+    # 编码文件可能需要下载，在线程池中加载，不阻塞端口监听和事件循环
+    asyncio.get_running_loop().run_in_executor(None, load_tokenizer)
+    try:
+        yield
+    finally:
+        if not startup_task.done():
+            startup_task.cancel()
+        await asyncio.gather(startup_task, return_exceptions=True)
+        await asr_scheduler.stop()
+        await http_client.aclose()
+        if response_cache is not None:
+            response_cache.close()
+
+app = FastAPI(lifespan=lifespan)
+
+_tokenizer = None  # 启动时由 load_tokenizer 加载，加载完成前或加载失败时按字符数估算
+
+def load_tokenizer():
+    """
+    加载tiktoken编码
+
+    本地没有缓存时 tiktoken 会同步下载BPE文件（没有超时），因此只在启动时放到线程池中调用，
+    不在事件循环上加载。
+    """
+    global _tokenizer
+    started = time.perf_counter()
+    try:
+        _tokenizer = tiktoken.get_encoding(TOKENIZER_ENCODING)
+    except Exception as e:
+        logger.warning(f"加载tiktoken编码失败，改为按字符数估算token: {e}")
+        return
+    logger.info(f"tiktoken编码 {TOKENIZER_ENCODING} 已加载，耗时={time.perf_counter() - started:.2f}秒")
+
+def count_tokens(text):
+    """估算文本的token数；tiktoken编码尚未加载或不可用（如离线环境）时按字符数估算"""
+    if _tokenizer is None:
+        return len(text)
+    return len(_tokenizer.encode(text))
+
+class Conversation:
+    """
+    单个连接的多轮对话历史
+
+    每条消息只在加入时计算一次token数，并维护历史的token总数；
+    总数超过预算时从最早的轮次开始丢弃，使请求的prompt大小保持有界。
+    """
+
+    MESSAGE_OVERHEAD_TOKENS = 4  # 每条消息的角色、分隔符等额外开销
+
+    def __init__(self, max_tokens=CONVERSATION_MAX_TOKENS):
+        self.max_tokens = max_tokens
+        self.turns = deque()  # (用户消息, 助手消息, token数)
+        self.total_tokens = 0
+
+    def copy(self):
+        """复制当前历史（用于推测式调用，不影响原对话）"""
+        snapshot = Conversation(self.max_tokens)
+        snapshot.turns = deque(self.turns)
+        snapshot.total_tokens = self.total_tokens
+        return snapshot
+
+    def messages(self, prompt):
+        """返回包含历史对话和本轮用户输入的消息列表"""
+        messages = []
+        for user_message, assistant_message, _ in self.turns:
+            messages.append(user_message)
+            messages.append(assistant_message)
+        messages.append({"role": "user", "content": prompt})
+        return messages
+
+    def add_turn(self, prompt, reply):
+        """记录一轮完整的问答，并按预算裁剪最早的轮次"""
+        tokens = count_tokens(prompt) + count_tokens(reply) + 2 * self.MESSAGE_OVERHEAD_TOKENS
+        self.turns.append((
+            {"role": "user", "content": prompt},
+            {"role": "assistant", "content": reply},
+            tokens,
+        ))
+        self.total_tokens += tokens
+        while self.turns and self.total_tokens > self.max_tokens:
+            _, _, dropped = self.turns.popleft()
+            self.total_tokens -= dropped
+
+class ResponseCache:
+    """
+    大模型回复缓存
+
+    - 以规范化后的识别文本为键（统一全半角、大小写，去掉标点和空白）
+    - 容量满时按LRU淘汰，条目超过TTL后失效
+    - 可选近似匹配：用字符二元组哈希向量的余弦相似度匹配几乎相同的问题
+    - 可选SQLite持久化：写入在线程池中进行，启动时加载未过期的条目
+    """
+
+    EMBEDDING_DIM = 512
+
+    def __init__(self, max_size, ttl, path="", similarity=0.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.similarity = similarity
+        self.entries = OrderedDict()  # key -> (reply, created_at)
+        self.embeddings = {}  # key -> np.ndarray，仅在开启近似匹配时维护
+        self.hits = 0
+        self.misses = 0
+        self.db = None
+        self.db_lock = threading.Lock()
+        if path:
+            self._open_db(path)
+
+    @staticmethod
+    def normalize(text):
+        """规范化文本作为缓存键"""
+        text = unicodedata.normalize("NFKC", text).lower()
+        return re.sub(r"[\W_]+", "", text)
+
+    def _embed(self, key):
+        """字符二元组哈希到固定维度并归一化"""
+        vector = np.zeros(self.EMBEDDING_DIM, dtype=np.float32)
+        grams = [key[i:i + 2] for i in range(len(key) - 1)] or [key]
+        np.add.at(vector, [zlib.crc32(gram.encode()) % self.EMBEDDING_DIM for gram in grams], 1.0)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _open_db(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.db_lock, self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, reply TEXT, created_at REAL)")
+            self.db.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - self.ttl,))
+            rows = self.db.execute(
+                "SELECT key, reply, created_at FROM responses ORDER BY created_at DESC LIMIT ?", (self.max_size,)
+            ).fetchall()
+        for key, reply, created_at in reversed(rows):
+            self._store(key, reply, created_at)
+        logger.info(f"从 {path} 加载了 {len(rows)} 条缓存回复")
+
+    def _store(self, key, reply, created_at):
+        self.entries[key] = (reply, created_at)
+        self.entries.move_to_end(key)
+        if self.similarity > 0:
+            self.embeddings[key] = self._embed(key)
+        while len(self.entries) > self.max_size:
+            evicted, _ = self.entries.popitem(last=False)
+            self.embeddings.pop(evicted, None)
+
+    def _remove(self, key):
+        self.entries.pop(key, None)
+        self.embeddings.pop(key, None)
+
+    def _find_similar(self, key):
+        """返回相似度最高且超过阈值的已缓存键"""
+        if not self.embeddings:
+            return None
+        keys = list(self.embeddings)
+        scores = np.stack([self.embeddings[k] for k in keys]) @ self._embed(key)
+        best = int(np.argmax(scores))
+        return keys[best] if scores[best] >= self.similarity else None
+
+    def get(self, text):
+        """查找缓存的回复，未命中时返回None"""
+        key = self.normalize(text)
+        if not key:
+            return None
+        if key not in self.entries and self.similarity > 0:
+            key = self._find_similar(key) or key
+        entry = self.entries.get(key)
+        if entry is not None and time.time() - entry[1] > self.ttl:
+            self._remove(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, text, reply):
+        """缓存一条回复；开启持久化时异步写入SQLite"""
+        key = self.normalize(text)
+        if not key or not reply:
+            return
+        created_at = time.time()
+        self._store(key, reply, created_at)
+        if self.db is not None:
+            asyncio.get_event_loop().run_in_executor(None, self._write_db, key, reply, created_at)
+
+    def _write_db(self, key, reply, created_at):
+        with self.db_lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO responses (key, reply, created_at) VALUES (?, ?, ?)",
+                (key, reply, created_at),
+            )
+
+    def stats(self):
+        """命中统计"""
+        total = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def close(self):
+        if self.db is not None:
+            with self.db_lock:
+                self.db.close()
+            self.db = None
+
+response_cache = ResponseCache(
+    RESPONSE_CACHE_SIZE,
+    RESPONSE_CACHE_TTL,
+    path=RESPONSE_CACHE_PATH,
+    similarity=RESPONSE_CACHE_SIMILARITY,
+) if RESPONSE_CACHE_ENABLED else None
+
+# ---------------- 大模型路由 ----------------
+
+class LLMUnavailableError(Exception):
+    """候选模型均已熔断，或在首token时限内都没有开始输出时抛出"""
+
+class ModelHealth:
+    """
+    单个模型的近期首token延迟和熔断状态
+
+    首token延迟只保留滑动窗口内的样本，模型一段时间没有被调用后统计自然清空，
+    被降级的主模型因此会重新得到尝试的机会。连续失败达到阈值后熔断一段时间，
+    到期后放行请求试探：成功即解除熔断，失败则立即重新熔断。
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.samples = deque()  # (记录时间, 首token秒数)
+        self.failures = 0  # 连续失败次数
+        self.open_until = 0.0  # 熔断到期时间，0表示未熔断
+        LLM_CIRCUIT_OPEN.set(0, model=model)
+
+    def _expire(self):
+        cutoff = time.monotonic() - LLM_TTFT_WINDOW_S
+        while self.samples and self.samples[0][0] < cutoff:
+            self.samples.popleft()
+
+    def record_ttft(self, seconds):
+        self.samples.append((time.monotonic(), seconds))
+        self._expire()
+
+    def percentile(self, q):
+        """窗口内首token延迟的分位数（秒），没有样本时返回None"""
+        self._expire()
+        if not self.samples:
+            return None
+        values = sorted(seconds for _, seconds in self.samples)
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+    @property
+    def available(self):
+        """未熔断或熔断已到期"""
+        return time.monotonic() >= self.open_until
+
+    def record_success(self):
+        self.failures = 0
+        if self.open_until:
+            self.open_until = 0.0
+            LLM_CIRCUIT_OPEN.set(0, model=self.model)
+            logger.info(f"大模型 {self.model} 已恢复，解除熔断")
+
+    def record_failure(self):
+        self.failures += 1
+        # 熔断到期后的试探请求失败时立即重新熔断
+        if self.failures >= LLM_BREAKER_FAILURES or self.open_until:
+            self.open_until = time.monotonic() + LLM_BREAKER_COOLDOWN_S
+            LLM_CIRCUIT_OPEN.set(1, model=self.model)
+            logger.warning(f"大模型 {self.model} 连续失败 {self.failures} 次，熔断 {LLM_BREAKER_COOLDOWN_S:.0f} 秒")
+
+    def status(self):
+        p50, p95 = self.percentile(0.5), self.percentile(0.95)
+        return {
+            "ttft_p50_ms": round(p50 * 1000) if p50 is not None else None,
+            "ttft_p95_ms": round(p95 * 1000) if p95 is not None else None,
+            "samples": len(self.samples),
+            "circuit_open": not self.available,
+            "consecutive_failures": self.failures,
+        }
+
+class LLMAttempt:
+    """
+    发给某个模型的一次流式请求
+
+    task 在收到第一段内容（或流直接结束）时完成，结果为首token耗时；此前收到的数据块暂存，
+    由 chunks() 连同之后的数据块一起交给调用方。每个请求占用路由器的一个并发名额，close() 时归还。
+    """
+
+    def __init__(self, router, model, messages, role):
+        self.router = router
+        self.model = model
+        self.role = role  # primary / hedge / retry
+        self.messages = messages
+        self.stream = None
+        self.iterator = None
+        self.pending = []
+        self.closed = False
+        self.started_at = time.perf_counter()
+        self.task = asyncio.create_task(self._start())
+
+    async def _start(self):
+        self.stream = await get_llm_client().chat.completions.create(
+            model=self.model,
+            messages=self.messages,
+            stream=True,  # 启用流式模式
+            stream_options={"include_usage": True}  # 在最后一个数据块中返回token用量
+        )
+        self.iterator = self.stream.__aiter__()
+        while True:
+            try:
+                chunk = await self.iterator.__anext__()
+            except StopAsyncIteration:
+                break
+            self.pending.append(chunk)
+            if chunk.choices and chunk.choices[0].delta and chunk.choices[0].delta.content:
+                break
+        return time.perf_counter() - self.started_at
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.started_at
+
+    async def chunks(self):
+        """依次产出全部数据块；中途出错时计入该模型的连续失败次数"""
+        try:
+            pending, self.pending = self.pending, []
+            for chunk in pending:
+                yield chunk
+            async for chunk in self.iterator:
+                yield chunk
+        except Exception:
+            self.router.health[self.model].record_failure()
+            raise
+
+    async def close(self):
+        """取消未完成的请求、关闭响应并归还并发名额（可重复调用）"""
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if not self.task.done():
+                self.task.cancel()
+                await asyncio.gather(self.task, return_exceptions=True)
+            if self.stream is not None:
+                try:
+                    await self.stream.close()
+                except Exception as e:
+                    logger.debug(f"关闭大模型响应失败: {e}")
+        finally:
+            # 关闭过程中被取消也要归还名额，否则名额永久泄漏
+            self.router.release()
+
+class LLMRouter:
+    """
+    大模型请求路由
+
+    - 按模型统计近期首token延迟；主模型近期中位数超过 LLM_TTFT_SLO_MS 或已熔断时优先使用备用模型
+    - 对冲：首选模型超过等待时间（近期p95，限制在 LLM_HEDGE_MIN_MS 与 LLM_TTFT_SLO_MS 之间）仍未输出时，
+      向另一个模型再发一次请求，采用先开始输出的一个并取消另一个；首选模型在输出前出错时立即改用另一个
+    - 熔断：连续失败的模型暂停使用 LLM_BREAKER_COOLDOWN_S 秒
+    - 并发上限：所有请求（含对冲）共用 LLM_MAX_CONCURRENCY 个名额，排队时间计入首token时限；
+      没有空闲名额时不发对冲请求，避免上游已经过载时成倍放大请求量
+    """
+
+    def __init__(self, primary, fallback, max_concurrency):
+        self.primary = primary
+        self.fallback = fallback or primary  # 未配置备用模型时对冲请求发给主模型本身
+        self.health = {model: ModelHealth(model) for model in (self.primary, self.fallback)}
+        self.slots = asyncio.Semaphore(max_concurrency)
+        self.in_flight = 0
+
+    def candidates(self):
+        """按优先顺序排列当前可用的模型"""
+        models = [model for model in dict.fromkeys((self.primary, self.fallback)) if self.health[model].available]
+        if len(models) == 2:
+            median = self.health[self.primary].percentile(0.5)
+            if median is not None and median * 1000 > LLM_TTFT_SLO_MS:
+                models.reverse()
+        return models
+
+    def hedge_delay(self, model):
+        """发出对冲请求前的等待时间（秒）"""
+        p95 = self.health[model].percentile(0.95)
+        if p95 is None:
+            return LLM_TTFT_SLO_MS / 1000
+        return min(LLM_TTFT_SLO_MS, max(LLM_HEDGE_MIN_MS, p95 * 1000)) / 1000
+
+    async def _launch(self, model, messages, role, timeout=None):
+        """占用一个并发名额发出请求；timeout 为0时只在有空闲名额时发出，否则返回None"""
+        if timeout == 0:
+            if self.slots.locked():
+                return None
+            await self.slots.acquire()
+        else:
+            try:
+                await asyncio.wait_for(self.slots.acquire(), timeout)
+            except asyncio.TimeoutError:
+                return None
+        self.in_flight += 1
+        return LLMAttempt(self, model, messages, role)
+
+    def release(self):
+        self.in_flight -= 1
+        self.slots.release()
+
+    def _record_start(self, attempt, ttft):
+        health = self.health[attempt.model]
+        health.record_ttft(ttft)
+        health.record_success()
+        LLM_TTFT_SECONDS.observe(ttft, model=attempt.model)
+        LLM_REQUESTS.inc(model=attempt.model, role=attempt.role, outcome="won")
+
+    async def open(self, messages):
+        """
+        发出请求并返回最先开始输出的一次请求
+
+        参数:
+            messages (list): 发送给模型的消息列表
+
+        返回:
+            LLMAttempt: 已开始输出的请求，调用方读完 chunks() 后必须调用 close()
+
+        异常:
+            LLMUnavailableError: 候选模型均已熔断、排队超时或都未在时限内开始输出
+            BadRequestError: 请求本身被拒绝（不重试，也不计入熔断）
+            Exception: 所有请求都失败时抛出最后一个错误
+        """
+        models = self.candidates()
+        if not models:
+            raise LLMUnavailableError("所有大模型均已熔断")
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + LLM_FIRST_TOKEN_TIMEOUT
+        first = await self._launch(models[0], messages, "primary", LLM_FIRST_TOKEN_TIMEOUT)
+        if first is None:
+            raise LLMUnavailableError("等待大模型并发名额超时")
+        backup = models[-1] if len(models) > 1 else models[0]
+        hedge_at = loop.time() + self.hedge_delay(models[0]) if LLM_HEDGE else None
+        attempts = [first]
+        winner, error, backup_sent = None, None, False
+        try:
+            try:
+                while winner is None:
+                    now = loop.time()
+                    if now >= deadline:
+                        break
+                    if not backup_sent and hedge_at is not None and now >= hedge_at:
+                        backup_sent = True
+                        # 因出错改发的请求可以排队等待名额，对冲请求只在有空闲名额时发出
+                        if error is not None:
+                            attempt = await self._launch(backup, messages, "retry", deadline - now)
+                            message = f"改用大模型 {backup} 重试"
+                        else:
+                            attempt = await self._launch(backup, messages, "hedge", 0)
+                            message = f"大模型 {models[0]} 超过 {first.elapsed * 1000:.0f}ms 未输出，对冲请求 {backup}"
+                        if attempt is not None:
+                            logger.info(message)
+                            attempts.append(attempt)
+                        continue
+                    running = [attempt.task for attempt in attempts]
+                    if not running:
+                        break
+                    wake = deadline if backup_sent or hedge_at is None else min(deadline, hedge_at)
+                    done, _ = await asyncio.wait(running, timeout=wake - now, return_when=asyncio.FIRST_COMPLETED)
+                    for attempt in list(attempts):
+                        if attempt.task not in done:
+                            continue
+                        if attempt.task.exception() is None:
+                            if winner is None:
+                                winner = attempt
+                                self._record_start(attempt, attempt.task.result())
+                            continue
+                        error = attempt.task.exception()
+                        attempts.remove(attempt)
+                        await attempt.close()
+                        if isinstance(error, BadRequestError):
+                            if winner is None:
+                                raise error
+                            continue
+                        logger.warning(f"大模型 {attempt.model} 请求失败: {error}")
+                        self.health[attempt.model].record_failure()
+                        LLM_REQUESTS.inc(model=attempt.model, role=attempt.role, outcome="error")
+                        # 出错后不再等待对冲时间，立即改用另一个模型
+                        if not backup_sent:
+                            hedge_at = loop.time()
+            finally:
+                losers = [attempt for attempt in attempts if attempt is not winner]
+                for attempt in losers:
+                    if winner is not None:
+                        # 输出较慢的一方被取消，已等待的时间作为其首token延迟的下限计入统计
+                        self.health[attempt.model].record_ttft(attempt.elapsed)
+                        LLM_REQUESTS.inc(model=attempt.model, role=attempt.role, outcome="lost")
+                    elif loop.time() >= deadline:
+                        self.health[attempt.model].record_failure()
+                        LLM_REQUESTS.inc(model=attempt.model, role=attempt.role, outcome="timeout")
+                # 一起关闭：即使在此期间被取消，每个请求的 close() 也会归还名额
+                await asyncio.gather(*(attempt.close() for attempt in losers), return_exceptions=True)
+        except BaseException:
+            # 已选出胜者但未能交给调用方（如在关闭落选请求时被取消），由这里关闭
+            if winner is not None:
+                await winner.close()
+            raise
+        if winner is not None:
+            return winner
+        if error is not None and loop.time() < deadline:
+            raise error
+        raise LLMUnavailableError(f"大模型在 {LLM_FIRST_TOKEN_TIMEOUT:.0f} 秒内未开始输出")
+
+    def status(self):
+        """路由状态，用于 /ready"""
+        return {
+            "primary": self.primary,
+            "fallback": self.fallback,
+            "order": self.candidates(),
+            "in_flight": self.in_flight,
+            "models": {model: health.status() for model, health in self.health.items()},
+        }
+
+llm_router = LLMRouter(LLM_MODEL, LLM_FALLBACK_MODEL, LLM_MAX_CONCURRENCY)
+
+metrics.register(Gauge("voice_llm_in_flight", "进行中的大模型请求数（含对冲请求）", callback=lambda: llm_router.in_flight))
 
 # 使用OpenAI SDK调用通义千问大模型
-async def call_tongyi_model(prompt):
+async def call_tongyi_model(prompt, on_delta=None, conversation=None):
     """
     使用OpenAI SDK调用通义千问大模型 (流式)
 
+    请求经 llm_router 路由：主模型首token过慢时对冲到备用模型，出错时改用另一个模型，连续失败时熔断。
+
     参数:
         prompt (str): 用户输入的文本
+        on_delta (callable): 可选的异步回调，每收到一段增量内容就以该内容调用一次
+        conversation (Conversation): 可选的对话历史，会随请求一并发送，成功后记录本轮问答
 
     返回:
         str: 模型生成的完整回复
     """
     try:
-        logger.info(f"调用通义千问大模型 (流式)，输入: '{prompt}'")
-        start_time = time.time()
+        # 回复缓存只按本轮识别文本做键，有对话历史时同一句话的合适回复可能不同
+        # （如"那明天呢"），因此只用于没有历史的第一轮
+        cacheable = response_cache is not None and not (conversation is not None and conversation.turns)
 
-        # 使用异步执行模型调用
-        loop = asyncio.get_event_loop()
+        # 先查回复缓存，命中时不调用大模型
+        if cacheable:
+            cached_reply = response_cache.get(prompt)
+            if cached_reply is not None:
+                logger.info(f"回复缓存命中: '{content_for_log(prompt)}' ({response_cache.stats()})")
+                if on_delta is not None:
+                    await on_delta(cached_reply)
+                if conversation is not None:
+                    conversation.add_turn(prompt, cached_reply)
+                return cached_reply
 
-        # 使用OpenAI SDK调用模型，启用流式输出
-        def call_api_stream():
-            stream = client.chat.completions.create(
-                model="qwen3-235b-a22b",  # 确认使用的模型名称，日志中是qwen-max
-                messages=[
-                    {"role": "user", "content": prompt}
-                ],
-                stream=True  # 启用流式模式
-            )
-            return stream
+        logger.info(f"调用通义千问大模型 (流式)，输入: '{content_for_log(prompt)}'")
+        start_time = time.time()
 
-        stream = await loop.run_in_executor(None, call_api_stream)
+        # 由路由器选择模型并发出流式请求，返回最先开始输出的一个
+        attempt = await llm_router.open(
+            conversation.messages(prompt) if conversation else [
+                {"role": "user", "content": prompt}
+            ]
+        )
 
         full_reply = ""
         completion_tokens = 0
         prompt_tokens = 0 # Prompt tokens 通常在第一个 chunk 或 usage 中提供，这里简化处理
 
-        logger.info("开始接收流式响应...")
-        for chunk in stream:
-            # 提取 token 使用信息 (如果可用)
-            # 注意：通义千问的流式接口可能不会在每个 chunk 中都提供完整的 usage 信息
-            # 通常在最后一个 chunk 或需要单独处理
-            if hasattr(chunk, 'usage') and chunk.usage:
-                 if chunk.usage.prompt_tokens:
-                     prompt_tokens = chunk.usage.prompt_tokens
-                 if chunk.usage.completion_tokens:
-                     completion_tokens = chunk.usage.completion_tokens # 累加或取最后值
+        logger.info(f"开始接收流式响应... (模型: {attempt.model}, {attempt.role})")
+        try:
+            # 异步迭代数据块，等待网络数据时不阻塞事件循环
+            async for chunk in attempt.chunks():
+                # 提取 token 使用信息 (如果可用)
+                # 注意：通义千问的流式接口可能不会在每个 chunk 中都提供完整的 usage 信息
+                # 通常在最后一个 chunk 或需要单独处理
+                if hasattr(chunk, 'usage') and chunk.usage:
+                     if chunk.usage.prompt_tokens:
+                         prompt_tokens = chunk.usage.prompt_tokens
+                     if chunk.usage.completion_tokens:
+                         completion_tokens = chunk.usage.completion_tokens # 累加或取最后值
 
-            if chunk.choices and chunk.choices[0].delta and chunk.choices[0].delta.content:
-                content = chunk.choices[0].delta.content
-                full_reply += content
-                # logger.info(f"收到 chunk: {content}") # 可以取消注释以查看每个 chunk
+                if chunk.choices and chunk.choices[0].delta and chunk.choices[0].delta.content:
+                    content = chunk.choices[0].delta.content
+                    full_reply += content
+                    # logger.info(f"收到 chunk: {content}") # 可以取消注释以查看每个 chunk
+                    if on_delta is not None:
+                        await on_delta(content)
+        finally:
+            await attempt.close()
 
         # 流结束后记录最终 token 信息
         # 注意：需要根据实际API返回情况调整 token 记录逻辑
@@ -110,25 +2006,348 @@ async def call_tongyi_model(prompt):
         logger.info(f"总token数 (估算): {total_tokens}")
 
 
+        LLM_TOKENS.inc(prompt_tokens, type="prompt")
+        LLM_TOKENS.inc(completion_tokens, type="completion")
+
         elapsed_time = time.time() - start_time
+        STAGE_SECONDS.observe(elapsed_time, stage="llm_total")
         logger.info(f"API请求耗时: {elapsed_time:.2f}秒")
-        logger.info(f"模型回复: {full_reply}")
+        logger.info(f"模型回复: {content_for_log(full_reply)}")
+
+        # 备用模型的回复质量较低，不写入缓存
+        if cacheable and attempt.model == LLM_MODEL:
+            response_cache.put(prompt, full_reply)
+
+        if conversation is not None and full_reply:
+            conversation.add_turn(prompt, full_reply)
+            logger.info(f"对话历史: {len(conversation.turns)} 轮, {conversation.total_tokens} token")
 
         return full_reply
     except Exception as e:
+        STAGE_ERRORS.inc(stage="llm")
         logger.error(f"调用通义千问大模型失败: {e}")
         import traceback
         logger.error(traceback.format_exc())
         # 检查是否是 BadRequestError 并提取更具体的 API 错误信息
-        if isinstance(e, OpenAI.BadRequestError):
+        if isinstance(e, BadRequestError):
              logger.error(f"API 返回错误详情: {e.body}")
              return f"模型调用失败: {e.body.get('error', {}).get('message', '未知API错误')}"
+        if isinstance(e, LLMUnavailableError):
+            return "抱歉，模型服务繁忙，请稍后再试"
         return "抱歉，模型调用出错，请稍后再试"
 
+class SpeculativeReply:
+    """
+    推测式大模型调用
+
+    流式识别的结果稳定且出现短暂停顿时，用尚未确认的文本提前调用大模型，生成的内容先缓存起来。
+    确认文本与推测文本足够相似时直接采用（先重放已缓存的内容，再继续转发后续内容），
+    把识别的收尾时间藏在大模型的首token延迟之后；否则取消推测，用确认文本重新调用。
+    推测调用使用对话历史的副本，只有被采用时才把本轮问答写入真正的对话历史。
+    """
+
+    def __init__(self, text, conversation=None):
+        self.text = text
+        self.conversation = conversation.copy() if conversation is not None else None
+        self.chunks = []
+        self.forward = None  # 被采用后直接转发增量内容的回调
+        self.settled = False  # 已被采用或取消
+        self.task = asyncio.create_task(
+            call_tongyi_model(text, on_delta=self._on_delta, conversation=self.conversation)
+        )
+
+    async def _on_delta(self, content):
+        if self.forward is not None:
+            await self.forward(content)
+        else:
+            self.chunks.append(content)
+
+    def matches(self, text):
+        """确认文本与推测文本（规范化后）的相似度是否达到阈值"""
+        a, b = ResponseCache.normalize(self.text), ResponseCache.normalize(text)
+        if not a or not b:
+            return False
+        return a == b or difflib.SequenceMatcher(None, a, b).ratio() >= SPECULATIVE_MATCH
+
+    async def adopt(self, on_delta, text, conversation=None):
+        """
+        采用推测结果
+
+        参数:
+            on_delta (callable): 转发增量内容的异步回调
+            text (str): 确认的识别文本，作为本轮用户输入写入对话历史
+            conversation (Conversation): 真正的对话历史
+
+        返回:
+            str: 完整回复
+        """
+        self.settled = True
+        SPECULATIVE_RESULTS.inc(result="hit")
+        logger.info(f"采用推测回复: '{content_for_log(self.text)}'，已生成 {len(self.chunks)} 段")
+        sent = 0
+        while sent < len(self.chunks):
+            await on_delta(self.chunks[sent])
+            sent += 1
+        # 重放与切换之间没有 await，期间不会漏掉新到达的内容
+        self.forward = on_delta
+        reply = await self.task
+        succeeded = self.conversation is None or (
+            self.conversation.turns and self.conversation.turns[-1][1]["content"] == reply
+        )
+        if conversation is not None and reply and succeeded:
+            conversation.add_turn(text, reply)
+        return reply
+
+    def cancel(self):
+        """放弃推测结果，取消仍在进行的调用并估算浪费的token"""
+        if self.settled:
+            return
+        self.settled = True
+        SPECULATIVE_RESULTS.inc(result="miss")
+        if self.task.done() and not self.task.cancelled() and self.task.exception() is None:
+            completion = self.task.result()
+        else:
+            completion = "".join(self.chunks)
+        self.task.cancel()
+        history_tokens = self.conversation.total_tokens if self.conversation is not None else 0
+        SPECULATIVE_WASTED_TOKENS.inc(history_tokens + count_tokens(self.text), type="prompt")
+        SPECULATIVE_WASTED_TOKENS.inc(count_tokens(completion), type="completion")
+        logger.info(f"放弃推测回复: '{content_for_log(self.text)}'")
+
+# ---------------- 语音合成 ----------------
+
+# 句子结束标点（含紧随其后的右引号、右括号）
+SENTENCE_END = re.compile(r"[。！？!?；;\n]+[”’\"')）]*")
+# 句子过长时的次选切分点
+CLAUSE_END = re.compile(r"[，,、：:]")
+
+def _pcm_to_wav(samples, sample_rate):
+    """把float32采样编码为16位单声道WAV"""
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframes((np.clip(samples, -1.0, 1.0) * 32767).astype(np.int16).tobytes())
+    return buffer.getvalue()
+
+class TTSEngine:
+    """语音合成引擎接口：子类实现 synthesize，把一句文本合成为WAV音频"""
+
+    name = "base"
+
+    async def synthesize(self, text):
+        """
+        合成一句文本
+
+        参数:
+            text (str): 一句完整的文本
+
+        返回:
+            bytes: WAV格式的音频
+        """
+        raise NotImplementedError
+
+class ToneTTSEngine(TTSEngine):
+    """
+    不依赖任何外部程序的测试引擎
+
+    每个字合成一段音高随字变化的短音，标点处停顿。没有可懂度，只用于验证
+    分句、发送和播放链路，以及测量首段音频的延迟。
+    """
+
+    name = "tone"
+    SAMPLE_RATE = 16000
+    CHAR_SECONDS = 0.12
+    PAUSE_SECONDS = 0.2
+
+    async def synthesize(self, text):
+        pieces = []
+        char_samples = int(self.CHAR_SECONDS * self.SAMPLE_RATE)
+        t = np.arange(char_samples, dtype=np.float32) / self.SAMPLE_RATE
+        envelope = np.sin(np.pi * np.arange(char_samples) / char_samples).astype(np.float32)
+        for char in text:
+            if char.isspace() or unicodedata.category(char).startswith("P"):
+                pieces.append(np.zeros(int(self.PAUSE_SECONDS * self.SAMPLE_RATE), dtype=np.float32))
+                continue
+            frequency = 180 + (ord(char) % 12) * 15
+            pieces.append(0.3 * envelope * np.sin(2 * np.pi * frequency * t))
+        samples = np.concatenate(pieces) if pieces else np.zeros(0, dtype=np.float32)
+        return _pcm_to_wav(samples, self.SAMPLE_RATE)
+
+class EspeakTTSEngine(TTSEngine):
+    """调用本机的 espeak-ng 离线合成语音"""
+
+    name = "espeak"
+
+    def __init__(self, voice=None, binary=None):
+        self.voice = voice or TTS_VOICE
+        self.binary = binary or ESPEAK_BINARY
+
+    async def synthesize(self, text):
+        # 文本经标准输入传入，以"-"开头的句子不会被当作命令行选项解析
+        process = await asyncio.create_subprocess_exec(
+            self.binary, "-v", self.voice, "--stdout", "--stdin",
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        wav, err = await process.communicate(input=text.encode("utf-8"))
+        if process.returncode != 0:
+            raise RuntimeError(f"espeak-ng合成失败: {err.decode(errors='ignore').strip()}")
+        return wav
+
+TTS_ENGINES = {engine.name: engine for engine in (ToneTTSEngine, EspeakTTSEngine)}
+
+def create_tts_engine(name):
+    """
+    按名称创建语音合成引擎
+
+    参数:
+        name (str): 内置引擎名（tone / espeak），或 "模块:类名" 形式的自定义 TTSEngine 子类；为空时不启用
+
+    返回:
+        TTSEngine | None
+    """
+    if not name:
+        return None
+    if name in TTS_ENGINES:
+        return TTS_ENGINES[name]()
+    module_name, _, class_name = name.partition(":")
+    return getattr(importlib.import_module(module_name), class_name)()
+
+tts_engine = create_tts_engine(TTS_ENGINE)
+
+class TTSStream:
+    """
+    一次回复的语音合成
+
+    大模型的增量内容按句切分，每句完整后立即交给后台任务合成并发送，不等待整段回复，
+    首段音频的延迟约为首token延迟加一句话的生成和合成时间。各句按顺序合成和发送。
+    音频以二进制消息发送：4字节（网络字节序）头部长度 + JSON头部 + WAV音频，
+    头部包含回复 id、seq 和句子序号；全部发送完毕后发送 {"type": "audio_end"} 消息。
+    """
+
+    def __init__(self, websocket, engine, reply_id, seq=None):
+        self.websocket = websocket
+        self.engine = engine
+        self.reply_id = reply_id
+        self.seq = seq
+        self.buffer = ""
+        self.sentences = asyncio.Queue()
+        self.sent = 0
+        self.started = time.perf_counter()
+        self.worker = asyncio.create_task(self._run())
+
+    def feed(self, content):
+        """追加一段增量内容，切出其中已完整的句子"""
+        self.buffer += content
+        while True:
+            match = SENTENCE_END.search(self.buffer)
+            if match:
+                cut = match.end()
+            elif len(self.buffer) >= TTS_MAX_SENTENCE_CHARS:
+                # 长句没有句末标点时在最后一个逗号处切开，避免首段音频等待过久
+                clauses = list(CLAUSE_END.finditer(self.buffer))
+                cut = clauses[-1].end() if clauses else len(self.buffer)
+            else:
+                return
+            sentence, self.buffer = self.buffer[:cut], self.buffer[cut:]
+            self._enqueue(sentence)
+
+    def _enqueue(self, sentence):
+        # 只含标点或空白的片段不合成
+        if ResponseCache.normalize(sentence):
+            self.sentences.put_nowait(sentence.strip())
+
+    async def finish(self):
+        """送出剩余文本，等待全部句子合成发送完毕"""
+        self._enqueue(self.buffer)
+        self.buffer = ""
+        self.sentences.put_nowait(None)
+        await asyncio.gather(self.worker, return_exceptions=True)
+        try:
+            await self.websocket.send_text(json.dumps({
+                "type": "audio_end", "id": self.reply_id, "seq": self.seq, "count": self.sent,
+            }))
+        except Exception as e:
+            logger.error(f"发送audio_end消息失败: {e}")
+
+    def cancel(self):
+        self.worker.cancel()
+
+    async def _run(self):
+        while True:
+            sentence = await self.sentences.get()
+            if sentence is None:
+                return
+            started = time.perf_counter()
+            try:
+                audio = await self.engine.synthesize(sentence)
+            except Exception as e:
+                STAGE_ERRORS.inc(stage="tts")
+                logger.error(f"语音合成失败: {e}")
+                continue
+            STAGE_SECONDS.observe(time.perf_counter() - started, stage="tts")
+            header = json.dumps({
+                "type": "audio",
+                "id": self.reply_id,
+                "seq": self.seq,
+                "index": self.sent,
+                "format": "wav",
+                "text": sentence,
+            }, ensure_ascii=False).encode("utf-8")
+            try:
+                await self.websocket.send_bytes(struct.pack("!I", len(header)) + header + audio)
+            except Exception as e:
+                logger.error(f"发送语音失败: {e}")
+                return
+            if self.sent == 0:
+                TTS_FIRST_AUDIO_SECONDS.observe(time.perf_counter() - self.started)
+            self.sent += 1
+
 @app.get("/")
 async def read_root():
     return {"Hello": "World"}
 
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Prometheus格式的运行指标"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/ready")
+async def readiness():
+    """就绪检查：识别模型全部加载并预热完成后返回200，否则返回503"""
+    status = {
+        "ready": asr_scheduler.ready,
+        "model": WHISPER_MODEL,
+        "backend": ASR_BACKEND,
+        "profile": ASR_PROFILE,
+        "workers": ASR_WORKERS,
+        "llm": llm_router.status(),
+        "startup_seconds": asr_scheduler.startup_seconds,
+        "first_transcription_seconds": asr_scheduler.first_transcription_seconds,
+    }
+    if ASR_BROKER_URLS:
+        status["asr_servers"] = {link.address: link.ready for link in asr_scheduler.links}
+    return JSONResponse(status_code=200 if asr_scheduler.ready else 503, content=status)
+
+@app.get("/sessions")
+async def sessions_status():
+    """各会话当前缓冲的字节数和处理中的语音段数，以及全局准入状态"""
+    return {
+        "admission": admission.status(),
+        "sessions": [
+            {
+                "id": session.short_id,
+                "connected": session.websocket is not None,
+                "inflight": session.pipeline.inflight,
+                "buffered_bytes": session.buffered_bytes(),
+            }
+            for session in sessions.values()
+        ],
+    }
+
 @app.get("/client")
 async def get_client():
     """返回前端页面HTML"""
@@ -183,6 +2402,16 @@ async def get_client():
                 margin: 5px 0;
                 text-align: left;
             }
+            
+            .partial-message {
+                opacity: 0.6;
+            }
+            
+            .busy-message {
+                color: #b36b00;
+                font-size: 0.9em;
+                margin: 5px 0;
+            }
         </style>
     </head>
     <body>
@@ -190,6 +2419,16 @@ async def get_client():
         <div>
             <button id="startButton">开始录音</button>
             <button id="stopButton" disabled>停止录音</button>
+            <label><input type="checkbox" id="streamingMode"> 流式识别（低延迟）</label>
+            <label><input type="checkbox" id="speakReplies"> 语音播报</label>
+            <label>识别档位
+                <select id="asrProfile">
+                    <option value="">服务器默认</option>
+                    <option value="fast">快速</option>
+                    <option value="balanced">均衡</option>
+                    <option value="accurate">精确</option>
+                </select>
+            </label>
         </div>
         <div id="result">
             <p>识别结果将显示在这里...</p>
@@ -202,18 +2441,118 @@ async def get_client():
             let accumulatedChunks = [];
             let reconnectAttempts = 0;
             const maxReconnectAttempts = 5;
+            // 会话ID：重连时带上以恢复对话历史，并取回断开期间产生的消息
+            let sessionId = null;
+            // 已录制但还没收到结果的整段音频（按发送顺序），会话无法恢复时重新发送
+            const pendingClips = [];
+            // 流式模式：持续发送16kHz int16 PCM帧，而不是每6秒上传一段webm
+            let streaming = false;
+            let pcmProcessor;
+            let micStream;
+            const targetSampleRate = 16000;
+            // 正在逐段显示的AI回复，按回复id索引
+            const streamingReplies = {};
+            // 语音播报：服务器按句发送的WAV音频依次排队播放
+            let playbackContext;
+            let playbackChain = Promise.resolve();
+            let nextPlayTime = 0;
             
             const startButton = document.getElementById('startButton');
             const stopButton = document.getElementById('stopButton');
+            const streamingCheckbox = document.getElementById('streamingMode');
+            const speakCheckbox = document.getElementById('speakReplies');
+            const profileSelect = document.getElementById('asrProfile');
             const resultDiv = document.getElementById('result');
             
+            // 解析二进制语音消息：4字节头部长度 + JSON头部 + WAV音频，按到达顺序接在上一句之后播放
+            function playAudioFrame(buffer) {
+                const headerLength = new DataView(buffer).getUint32(0);
+                const header = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, 4, headerLength)));
+                const audio = buffer.slice(4 + headerLength);
+                console.log(`收到语音: 回复${header.id} 第${header.index}句`);
+                if (!playbackContext) {
+                    playbackContext = new AudioContext();
+                }
+                // 解码是异步的，串成一条链保证按顺序排入播放
+                playbackChain = playbackChain
+                    .then(() => playbackContext.decodeAudioData(audio))
+                    .then((decoded) => {
+                        const source = playbackContext.createBufferSource();
+                        source.buffer = decoded;
+                        source.connect(playbackContext.destination);
+                        nextPlayTime = Math.max(nextPlayTime, playbackContext.currentTime);
+                        source.start(nextPlayTime);
+                        nextPlayTime += decoded.duration;
+                    })
+                    .catch((e) => console.error("播放语音失败:", e));
+            }
+            
+            // 切换识别档位：对之后发送的语音生效
+            profileSelect.onchange = () => {
+                if (socket && socket.readyState === WebSocket.OPEN && profileSelect.value) {
+                    socket.send(JSON.stringify({type: "profile", name: profileSelect.value}));
+                }
+            };
+            
+            speakCheckbox.onchange = () => {
+                if (speakCheckbox.checked && !playbackContext) {
+                    // 在用户操作中创建，避免浏览器的自动播放限制
+                    playbackContext = new AudioContext();
+                }
+                if (socket && socket.readyState === WebSocket.OPEN) {
+                    socket.send(JSON.stringify({type: "tts", enabled: speakCheckbox.checked}));
+                }
+            };
+            
+            // 将浏览器采集的float32音频降采样为16kHz int16 PCM
+            function toPcm16(input, inputRate) {
+                const ratio = inputRate / targetSampleRate;
+                const length = Math.floor(input.length / ratio);
+                const output = new Int16Array(length);
+                for (let i = 0; i < length; i++) {
+                    const sample = Math.max(-1, Math.min(1, input[Math.floor(i * ratio)]));
+                    output[i] = sample < 0 ? sample * 0x8000 : sample * 0x7FFF;
+                }
+                return output;
+            }
+            
+            // 发送尚未发出的音频；all为true时（服务器已丢失会话）全部重发，已处理过的音频服务器会直接返回原结果
+            function sendPendingClips(all) {
+                for (const clip of pendingClips) {
+                    if (all || !clip.sent) {
+                        console.log(`发送音频数据，大小: ${clip.data.byteLength} 字节`);
+                        socket.send(clip.data);
+                        clip.sent = true;
+                    }
+                }
+            }
+            
+            // 一段音频的处理已结束（回复完成、静音、繁忙或出错），回复按发送顺序到达
+            function finishClip() {
+                pendingClips.shift();
+            }
+            
             function connectWebSocket() {
-                socket = new WebSocket(`ws://${window.location.host}/ws`);
+                const query = sessionId ? `?session=${sessionId}` : "";
+                socket = new WebSocket(`ws://${window.location.host}/ws${query}`);
+                socket.binaryType = "arraybuffer";
                 
                 socket.onopen = () => {
                     console.log("WebSocket连接已打开");
                     reconnectAttempts = 0;
                     
+                    if (speakCheckbox.checked) {
+                        socket.send(JSON.stringify({type: "tts", enabled: true}));
+                    }
+                    if (profileSelect.value) {
+                        socket.send(JSON.stringify({type: "profile", name: profileSelect.value}));
+                    }
+                    
+                    // 流式模式下告知服务器后续二进制消息为PCM帧
+                    if (streaming) {
+                        socket.send(JSON.stringify({type: "start_stream", sample_rate: targetSampleRate}));
+                    }
+                    
                     // 添加心跳机制，每15秒发送一次ping保持连接
                     const pingInterval = setInterval(() => {
                         if (socket.readyState === WebSocket.OPEN) {
@@ -228,6 +2567,11 @@ async def get_client():
                 socket.onclose = (event) => {
                     console.log("WebSocket连接已关闭", event);
                     
+                    // 同一会话已在新连接上恢复（如再次点击开始），旧连接不再重连
+                    if (event.code === 4001) {
+                        return;
+                    }
+                    
                     // 尝试重连
                     if (reconnectAttempts < maxReconnectAttempts) {
                         reconnectAttempts++;
@@ -241,6 +2585,11 @@ async def get_client():
                 };
                 
                 socket.onmessage = (event) => {
+                    // 二进制消息是回复的语音
+                    if (event.data instanceof ArrayBuffer) {
+                        playAudioFrame(event.data);
+                        return;
+                    }
                     console.log("收到服务器消息:", event.data);
                     
                     // 如果是pong消息，不显示在结果区域
@@ -251,6 +2600,135 @@ async def get_client():
                             return;
                         }
                         
+                        // 会话信息：恢复成功时服务器随后补发断开期间的消息，否则重发没有结果的音频
+                        if (data.type === "session") {
+                            console.log(`会话 ${data.id} ${data.resumed ? "已恢复" : "已创建"}，待补发 ${data.pending} 条`);
+                            if (data.dropped) {
+                                console.warn(`断开期间有 ${data.dropped} 条消息因缓冲区已满被丢弃`);
+                            }
+                            sessionId = data.id;
+                            sendPendingClips(!data.resumed);
+                            return;
+                        }
+                        
+                        // 语音播报的实际状态（服务器未配置合成引擎时为关闭）和一段回复的语音结束标记
+                        if (data.type === "tts") {
+                            speakCheckbox.checked = data.enabled;
+                            return;
+                        }
+                        if (data.type === "audio_end") {
+                            return;
+                        }
+                        if (data.type === "profile") {
+                            console.log(`识别档位: ${data.name}`);
+                            return;
+                        }
+                        
+                        // AI回复的增量内容，逐段追加显示
+                        if (data.type === "delta") {
+                            const processingElements = document.querySelectorAll('.processing-message');
+                            processingElements.forEach(el => el.remove());
+                            let replyElement = streamingReplies[data.id];
+                            if (!replyElement) {
+                                replyElement = document.createElement('div');
+                                replyElement.className = 'bot-message';
+                                resultDiv.appendChild(replyElement);
+                                streamingReplies[data.id] = replyElement;
+                            }
+                            replyElement.textContent += data.content;
+                            resultDiv.scrollTop = resultDiv.scrollHeight;
+                            return;
+                        }
+                        
+                        // AI回复结束，以完整回复为准
+                        if (data.type === "done") {
+                            let replyElement = streamingReplies[data.id];
+                            if (!replyElement) {
+                                replyElement = document.createElement('div');
+                                replyElement.className = 'bot-message';
+                                resultDiv.appendChild(replyElement);
+                            }
+                            replyElement.textContent = data.content;
+                            delete streamingReplies[data.id];
+                            finishClip();
+                            resultDiv.scrollTop = resultDiv.scrollHeight;
+                            return;
+                        }
+                        
+                        // 流式识别的中间结果和确认结果
+                        if (data.type === "partial" || data.type === "final") {
+                            let partialElement = resultDiv.querySelector('.partial-message');
+                            if (!data.content) {
+                                // 中间结果被撤回（只是噪声）
+                                if (partialElement) {
+                                    partialElement.remove();
+                                }
+                                return;
+                            }
+                            if (!partialElement) {
+                                partialElement = document.createElement('div');
+                                partialElement.className = 'user-message partial-message';
+                                resultDiv.appendChild(partialElement);
+                            }
+                            partialElement.textContent = data.content;
+                            if (data.type === "final") {
+                                partialElement.classList.remove('partial-message');
+                            }
+                            resultDiv.scrollTop = resultDiv.scrollHeight;
+                            return;
+                        }
+                        
+                        // 本段音频全是静音，服务器未做识别
+                        if (data.type === "silence") {
+                            const processingElements = document.querySelectorAll('.processing-message');
+                            processingElements.forEach(el => el.remove());
+                            finishClip();
+                            return;
+                        }
+                        
+                        // 准入控制：服务器已满时排队或拒绝连接（拒绝后按重连逻辑稍后再试）
+                        if (data.type === "queued" || data.type === "overloaded") {
+                            const noticeElement = document.createElement('p');
+                            noticeElement.className = 'busy-message';
+                            noticeElement.textContent = data.type === "queued" ? `服务器繁忙，正在排队（第${data.position}位）...` : data.content;
+                            resultDiv.appendChild(noticeElement);
+                            resultDiv.scrollTop = resultDiv.scrollHeight;
+                            return;
+                        }
+                        
+                        // 音频超出限制未被处理：带seq的按顺序到达；不带seq的是收到时立即拒绝的，对应最近发出的一段
+                        if (data.type === "rejected") {
+                            const processingElements = document.querySelectorAll('.processing-message');
+                            processingElements.forEach(el => el.remove());
+                            if (data.seq === undefined || data.seq === null) {
+                                const index = pendingClips.map(clip => clip.sent).lastIndexOf(true);
+                                if (index >= 0) {
+                                    pendingClips.splice(index, 1);
+                                }
+                            } else {
+                                finishClip();
+                            }
+                            const rejectedElement = document.createElement('p');
+                            rejectedElement.className = 'busy-message';
+                            rejectedElement.textContent = data.content;
+                            resultDiv.appendChild(rejectedElement);
+                            resultDiv.scrollTop = resultDiv.scrollHeight;
+                            return;
+                        }
+                        
+                        // 服务器繁忙，本段语音未处理
+                        if (data.type === "busy") {
+                            const processingElements = document.querySelectorAll('.processing-message');
+                            processingElements.forEach(el => el.remove());
+                            const busyElement = document.createElement('p');
+                            busyElement.className = 'busy-message';
+                            busyElement.textContent = data.content;
+                            resultDiv.appendChild(busyElement);
+                            finishClip();
+                            resultDiv.scrollTop = resultDiv.scrollHeight;
+                            return;
+                        }
+                        
                         // 如果是消息类型
                         if (data.type === "message") {
                             // 移除"正在处理"的提示
@@ -262,6 +2740,9 @@ async def get_client():
                             messageElement.className = data.role === 'user' ? 'user-message' : 'bot-message';
                             messageElement.textContent = data.content;
                             resultDiv.appendChild(messageElement);
+                            if (data.role === 'assistant') {
+                                finishClip();
+                            }
                             
                             // 滚动到底部
                             resultDiv.scrollTop = resultDiv.scrollHeight;
@@ -281,6 +2762,8 @@ async def get_client():
             }
             
             startButton.onclick = async () => {
+                streaming = streamingCheckbox.checked;
+                
                 // 连接WebSocket
                 connectWebSocket();
                 
@@ -295,14 +2778,16 @@ async def get_client():
                         } 
                     });
                     console.log("麦克风权限已获取");
-                    
-                    // 使用MediaRecorder API，指定MIME类型
-                    mediaRecorder = new MediaRecorder(stream, {
-                        mimeType: 'audio/webm;codecs=opus'
-                    });
+                    micStream = stream;
                     
                     // 添加音频可视化，帮助调试
-                    const audioContext = new AudioContext();
+                    // 流式模式尽量直接以16kHz采集，不支持时在toPcm16中降采样
+                    let audioContext;
+                    try {
+                        audioContext = streaming ? new AudioContext({ sampleRate: targetSampleRate }) : new AudioContext();
+                    } catch (e) {
+                        audioContext = new AudioContext();
+                    }
                     const analyser = audioContext.createAnalyser();
                     const source = audioContext.createMediaStreamSource(stream);
                     source.connect(analyser);
@@ -331,6 +2816,27 @@ async def get_client():
                     }
                     updateAudioLevel();
                     
+                    if (streaming) {
+                        // 持续把麦克风音频转成PCM帧发送给服务器
+                        pcmProcessor = audioContext.createScriptProcessor(2048, 1, 1);
+                        pcmProcessor.onaudioprocess = (event) => {
+                            if (socket && socket.readyState === WebSocket.OPEN) {
+                                const pcm = toPcm16(event.inputBuffer.getChannelData(0), audioContext.sampleRate);
+                                socket.send(pcm.buffer);
+                            }
+                        };
+                        source.connect(pcmProcessor);
+                        pcmProcessor.connect(audioContext.destination);
+                        startButton.disabled = true;
+                        stopButton.disabled = false;
+                        return;
+                    }
+                    
+                    // 使用MediaRecorder API，指定MIME类型
+                    mediaRecorder = new MediaRecorder(stream, {
+                        mimeType: 'audio/webm;codecs=opus'
+                    });
+                    
                     // 收集音频数据
                     mediaRecorder.ondataavailable = (event) => {
                         if (event.data.size > 0) {
@@ -344,18 +2850,18 @@ async def get_client():
                         const audioBlob = new Blob(audioChunks, { type: 'audio/webm;codecs=opus' });
                         audioChunks = [];
                         
-                        if (socket && socket.readyState === WebSocket.OPEN) {
-                            console.log(`发送音频数据，大小: ${audioBlob.size} 字节`);
-                            const arrayBuffer = await audioBlob.arrayBuffer();
-                            socket.send(arrayBuffer);
-                            
-                            // 添加处理状态指示器
-                            const processingMessage = document.createElement('p');
-                            processingMessage.className = 'processing-message';
-                            processingMessage.innerHTML = '正在处理语音，请稍候... <span class="spinner"></span>';
-                            resultDiv.appendChild(processingMessage);
+                        // 先记入待处理列表，连接断开期间录制的音频在重连后发送
+                        pendingClips.push({data: await audioBlob.arrayBuffer(), sent: false});
+                        if (socket && socket.readyState === WebSocket.OPEN && sessionId) {
+                            sendPendingClips(false);
                         }
                         
+                        // 添加处理状态指示器
+                        const processingMessage = document.createElement('p');
+                        processingMessage.className = 'processing-message';
+                        processingMessage.innerHTML = '正在处理语音，请稍候... <span class="spinner"></span>';
+                        resultDiv.appendChild(processingMessage);
+                        
                         // 继续录音
                         if (!stopButton.disabled) {
                             mediaRecorder.start(6000); // 每6秒一段
@@ -374,7 +2880,20 @@ async def get_client():
             };
             
             stopButton.onclick = () => {
-                if (mediaRecorder && mediaRecorder.state === "recording") {
+                if (streaming) {
+                    // 停止采集并通知服务器确认剩余音频
+                    if (pcmProcessor) {
+                        pcmProcessor.disconnect();
+                        pcmProcessor = null;
+                    }
+                    if (micStream) {
+                        micStream.getTracks().forEach(track => track.stop());
+                    }
+                    if (socket && socket.readyState === WebSocket.OPEN) {
+                        socket.send(JSON.stringify({type: "end_stream"}));
+                    }
+                    streaming = false;
+                } else if (mediaRecorder && mediaRecorder.state === "recording") {
                     mediaRecorder.stop();
                 }
                 
@@ -396,182 +2915,1064 @@ async def get_client():
     """
     return HTMLResponse(content=html_content)
 
+# ---------------- 会话 ----------------
+
+class AudioDedupCache:
+    """
+    按音频内容哈希记录最近处理过的语音段
+
+    客户端重连后会重发没有收到结果的音频，其中可能有已经处理过或仍在处理的。
+    每个条目是一个future：原处理完成后得到 (识别文本, 回复)，忙碌、失败或被取消时得到None。
+    重发的音频命中已完成的条目时直接复用结果，命中仍在处理的条目时等待其结果，都不再重复识别和调用大模型；
+    得到None时按正常流程处理。
+
+    回复依赖所属会话的对话历史，因此条目按 (会话ID, 哈希) 登记，只在同一会话（或客户端声明的、
+    已失效的前一个会话）内复用，其他用户发送相同的音频不会得到本会话的回复。
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()  # (会话ID, 哈希) -> (future, created_at)
+
+    @staticmethod
+    def digest(audio_data):
+        return hashlib.blake2b(audio_data, digest_size=16).hexdigest()
+
+    def get(self, scopes, digest):
+        """
+        按顺序在各会话ID下查找条目
+
+        参数:
+            scopes (tuple[str]): 可以复用其结果的会话ID
+            digest (str): 音频哈希
+
+        返回:
+            asyncio.Future | None: 未命中或已过期时返回None
+        """
+        for scope in scopes:
+            key = (scope, digest)
+            entry = self.entries.get(key)
+            if entry is None:
+                continue
+            future, created_at = entry
+            if time.monotonic() - created_at > self.ttl:
+                del self.entries[key]
+                continue
+            self.entries.move_to_end(key)
+            return future
+        return None
+
+    def register(self, scope, digest):
+        """在会话 scope 下登记一段开始处理的音频，返回需由处理方设置结果的future"""
+        key = (scope, digest)
+        future = asyncio.get_event_loop().create_future()
+        self.entries[key] = (future, time.monotonic())
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return future
+
+audio_dedup = AudioDedupCache(AUDIO_DEDUP_SIZE, AUDIO_DEDUP_TTL) if AUDIO_DEDUP_ENABLED else None
+
+class Session:
+    """
+    可恢复的客户端会话
+
+    会话持有对话历史、处理流水线和仍在运行的处理任务，生命周期长于单个WebSocket连接：
+    连接断开后任务继续运行，发往客户端的消息暂存在有界的待发队列（outbox）中，
+    客户端在 SESSION_RESUME_TTL 秒内带着会话ID重连时按原顺序补发；超时未恢复才取消任务、释放会话。
+    流水线、流式识别和语音合成都通过会话的 send_text / send_bytes 发送消息，不直接持有连接。
+    """
+
+    def __init__(self, previous_id=None):
+        """
+        参数:
+            previous_id (str): 可选，客户端请求恢复但已失效的会话ID；重发的音频可以复用该会话的去重记录
+        """
+        self.id = uuid.uuid4().hex
+        self.short_id = self.id[:8]  # 用于日志和识别调度
+        self.websocket = None
+        self.outbox = deque()  # (是否二进制, 内容)
+        self.outbox_bytes = 0
+        self.dropped = 0  # 累计丢弃的待发消息数
+        self.lock = asyncio.Lock()  # 保证补发与新消息的顺序
+        self.tasks = set()  # 正在运行的处理任务，完成后自动移除
+        self.expiry = None  # 断开后的释放任务
+        self.streaming = None  # 当前连接的流式识别会话
+        self.conversation = Conversation()
+        self.pipeline = UtterancePipeline(self, self.short_id, self.conversation)
+        self.pipeline.dedup_scopes = (self.id, previous_id) if previous_id else (self.id,)
+        sessions[self.id] = self
+
+    def track(self, task):
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def buffered_bytes(self):
+        """本会话当前缓冲的字节数：待处理的整段音频（含解码结果）、流式识别的尾部音频、待发消息"""
+        audio = sum(self.pipeline.buffered.values())
+        stream = self.streaming.tail.nbytes if self.streaming is not None else 0
+        return {"audio": audio, "stream": stream, "outbox": self.outbox_bytes, "total": audio + stream + self.outbox_bytes}
+
+    async def send_text(self, text):
+        await self._send(False, text)
+
+    async def send_bytes(self, data):
+        await self._send(True, data)
+
+    async def _send(self, binary, payload):
+        async with self.lock:
+            if self.websocket is not None:
+                try:
+                    if binary:
+                        await self.websocket.send_bytes(payload)
+                    else:
+                        await self.websocket.send_text(payload)
+                    return
+                except Exception as e:
+                    logger.info(f"[{self.short_id}] 发送失败，消息暂存到待发队列: {e}")
+            self._enqueue(binary, payload)
+
+    def _enqueue(self, binary, payload):
+        self.outbox.append((binary, payload))
+        self.outbox_bytes += len(payload)
+        while self.outbox and (len(self.outbox) > SESSION_OUTBOX_SIZE or self.outbox_bytes > SESSION_OUTBOX_MAX_BYTES):
+            _, dropped = self.outbox.popleft()
+            self.outbox_bytes -= len(dropped)
+            self.dropped += 1
+            SESSION_OUTBOX_DROPPED.inc()
+
+    async def attach(self, websocket, resumed):
+        """
+        绑定新连接：先发送会话信息，再按顺序补发待发队列中的消息
+
+        参数:
+            websocket (WebSocket): 新连接
+            resumed (bool): 是否为恢复已有会话
+
+        返回:
+            int: 补发的消息数
+        """
+        if self.expiry is not None:
+            self.expiry.cancel()
+            self.expiry = None
+        async with self.lock:
+            previous, self.websocket = self.websocket, websocket
+            if previous is not None:
+                # 同一会话在别处仍有连接（如重复打开页面），由新连接接管
+                logger.info(f"[{self.short_id}] 会话被新连接接管，关闭旧连接")
+                try:
+                    await previous.close(code=4001)
+                except Exception:
+                    pass
+            await websocket.send_text(json.dumps({
+                "type": "session",
+                "id": self.id,
+                "resumed": resumed,
+                "pending": len(self.outbox),
+                "dropped": self.dropped,
+            }))
+            replayed = 0
+            while self.outbox:
+                binary, payload = self.outbox[0]
+                if binary:
+                    await websocket.send_bytes(payload)
+                else:
+                    await websocket.send_text(payload)
+                self.outbox.popleft()
+                self.outbox_bytes -= len(payload)
+                replayed += 1
+        return replayed
+
+    async def detach(self, websocket):
+        """连接断开：保留会话等待恢复，不保留时立即释放"""
+        if self.websocket is not websocket:
+            # 已被新连接接管
+            return
+        self.websocket = None
+        if SESSION_RESUME_TTL <= 0:
+            await self.close()
+            return
+        logger.info(f"[{self.short_id}] 会话保留 {SESSION_RESUME_TTL:.0f} 秒等待恢复，{len(self.tasks)} 个任务继续运行")
+        self.expiry = asyncio.create_task(self._expire())
+
+    async def _expire(self):
+        await asyncio.sleep(SESSION_RESUME_TTL)
+        self.expiry = None
+        SESSION_RESUMES.inc(result="expired")
+        logger.info(f"[{self.short_id}] 会话超时未恢复，释放")
+        await self.close()
+
+    async def close(self):
+        """释放会话：取消仍在运行的任务并等待它们退出"""
+        sessions.pop(self.id, None)
+        if self.tasks:
+            logger.info(f"[{self.short_id}] 取消 {len(self.tasks)} 个未完成的处理任务")
+            pending = list(self.tasks)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        self.outbox.clear()
+        self.outbox_bytes = 0
+
+# 会话ID -> 会话（包括断开后等待恢复的会话）
+sessions = {}
+
+metrics.register(Gauge("voice_sessions", "当前会话数（含断开后等待恢复的）", callback=lambda: len(sessions)))
+
+class AudioRejectedError(Exception):
+    """音频超出准入限制时抛出，args[0] 为原因（size/duration/inflight/memory）"""
+
+class AdmissionController:
+    """
+    全局连接数与内存预算
+
+    新会话在连接数达到 MAX_CONNECTIONS 或各会话缓冲的总字节数超过 MEMORY_BUDGET_BYTES 时排队等待，
+    最多等待 ADMISSION_WAIT_S 秒；排队的连接超过 ADMISSION_QUEUE_SIZE 或等待超时则拒绝。
+    恢复已有会话的连接不排队（其资源已计入预算）。整段音频在超出单段、单会话或全局限制时被拒绝，
+    不进入流水线，因此每个会话的缓冲上限为：
+    MAX_INFLIGHT_UTTERANCES 段音频（每段不超过 MAX_AUDIO_BYTES，解码后不超过 MAX_AUDIO_SECONDS 秒）
+    + STREAM_MAX_BUFFER_S 秒流式尾部 + SESSION_OUTBOX_MAX_BYTES 待发消息。
+    """
+
+    REJECT_MESSAGES = {
+        "size": f"音频超过 {MAX_AUDIO_BYTES // 1024}KB，本段语音未被处理，请缩短录音。",
+        "duration": f"音频时长超过 {MAX_AUDIO_SECONDS:.0f} 秒，本段语音未被处理，请缩短录音。",
+        "inflight": "前面的语音还在处理中，本段语音未被处理，请稍后再说。",
+        "memory": "服务器繁忙，本段语音未被处理，请稍后再说。",
+    }
+
+    def __init__(self, max_connections, memory_budget):
+        self.max_connections = max_connections
+        self.memory_budget = memory_budget
+        self.connections = 0
+        self.waiting = 0
+        self.changed = asyncio.Condition()  # 有连接释放时通知排队者
+
+    def buffered_bytes(self):
+        """所有会话当前缓冲的总字节数"""
+        return sum(session.buffered_bytes()["total"] for session in sessions.values())
+
+    def _has_room(self):
+        return self.connections < self.max_connections and self.buffered_bytes() < self.memory_budget
+
+    async def admit(self, websocket, resume=False):
+        """
+        为新连接申请名额，必要时排队
+
+        参数:
+            websocket (WebSocket): 已接受的连接
+            resume (bool): 是否为恢复已有会话
+
+        返回:
+            bool: 是否获准；未获准时已通知客户端并关闭连接
+        """
+        # 有连接在排队时新来的连接也要排在后面
+        if resume or (self.waiting == 0 and self._has_room()):
+            self.connections += 1
+            return True
+        if self.waiting < ADMISSION_QUEUE_SIZE:
+            self.waiting += 1
+            try:
+                await websocket.send_text(json.dumps({"type": "queued", "position": self.waiting}))
+                deadline = time.monotonic() + ADMISSION_WAIT_S
+                async with self.changed:
+                    while not self._has_room():
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        try:
+                            # 缓冲字节数的下降没有通知，最多每0.5秒重新检查一次
+                            await asyncio.wait_for(self.changed.wait(), min(0.5, remaining))
+                        except asyncio.TimeoutError:
+                            pass
+                    else:
+                        self.connections += 1
+                        return True
+            except Exception as e:
+                logger.info(f"排队中的连接已断开: {e}")
+                return False
+            finally:
+                self.waiting -= 1
+        CONNECTIONS_REJECTED.inc()
+        logger.warning(f"拒绝新连接: 连接数 {self.connections}/{self.max_connections}，"
+                       f"缓冲 {self.buffered_bytes()}/{self.memory_budget} 字节，排队 {self.waiting}")
+        try:
+            await websocket.send_text(json.dumps({"type": "overloaded", "content": "服务器繁忙，请稍后再连接。"}))
+            await websocket.close(code=1013)  # Try Again Later
+        except Exception:
+            pass
+        return False
+
+    async def release(self):
+        """连接关闭，唤醒排队的连接"""
+        self.connections -= 1
+        async with self.changed:
+            self.changed.notify_all()
+
+    def check_audio(self, session, size):
+        """
+        检查一段整段音频能否进入流水线
+
+        返回:
+            str | None: 拒绝原因，可以接受时返回None
+        """
+        if size > MAX_AUDIO_BYTES:
+            return "size"
+        if session.pipeline.inflight >= MAX_INFLIGHT_UTTERANCES:
+            return "inflight"
+        if self.buffered_bytes() + size > self.memory_budget:
+            return "memory"
+        return None
+
+    def status(self):
+        return {
+            "connections": self.connections,
+            "max_connections": self.max_connections,
+            "waiting": self.waiting,
+            "buffered_bytes": self.buffered_bytes(),
+            "memory_budget": self.memory_budget,
+        }
+
+admission = AdmissionController(MAX_CONNECTIONS, MEMORY_BUDGET_BYTES)
+
+metrics.register(Gauge("voice_buffered_bytes", "所有会话当前缓冲的字节数（待处理音频、流式尾部、待发消息）",
+                       callback=admission.buffered_bytes))
+metrics.register(Gauge("voice_session_buffered_bytes_max", "缓冲字节数最多的会话的缓冲字节数",
+                       callback=lambda: max((s.buffered_bytes()["total"] for s in sessions.values()), default=0)))
+metrics.register(Gauge("voice_admission_waiting", "排队等待准入的新连接数", callback=lambda: admission.waiting))
+
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
-    logger.info("连接已打开")
+    # 客户端重连时通过 ?session=<id> 恢复之前的会话（对话历史、未完成的任务和未送达的消息）
+    requested = websocket.query_params.get("session")
+    session = sessions.get(requested) if requested else None
+    # 新会话受连接数和内存预算限制，超出时排队或拒绝
+    if not await admission.admit(websocket, resume=session is not None):
+        return
+    resumed = session is not None
+    if requested:
+        SESSION_RESUMES.inc(result="resumed" if resumed else "unknown")
+    if session is None:
+        session = Session(previous_id=requested)
+    connection_id = session.short_id
+    # 之后在本连接中创建的任务都会继承该ID，日志自动带上
+    connection_id_var.set(connection_id)
+    logger.info(f"连接已打开: {connection_id}" + (" (恢复会话)" if resumed else ""))
+    ACTIVE_CONNECTIONS.inc()
     
-    # 创建一个任务队列
-    processing_tasks = []
+    # 该会话的分阶段处理流水线
+    pipeline = session.pipeline
+    track = session.track
     
     try:
+        replayed = await session.attach(websocket, resumed)
+        if replayed:
+            logger.info(f"[{connection_id}] 补发了 {replayed} 条断开期间的消息")
         while True:
+            # 单次 receive 同时等待文本和二进制消息，空闲连接不会被周期性唤醒
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                logger.info(f"[{connection_id}] 客户端断开连接 (code={message.get('code')})")
+                break
+
+            if message.get("bytes") is not None:
+                data = message["bytes"]
+                if session.streaming is not None:
+                    # 流式模式：PCM帧追加到会话缓冲区
+                    session.streaming.feed(data)
+                    continue
+                reason = admission.check_audio(session, len(data))
+                if reason is not None:
+                    # 超出准入限制：立即告知客户端，音频不进入流水线
+                    AUDIO_REJECTED.inc(reason=reason)
+                    logger.warning(f"[{connection_id}] 拒绝 {len(data)} 字节的音频: {reason}")
+                    await session.send_text(json.dumps({
+                        "type": "rejected",
+                        "reason": reason,
+                        "content": AdmissionController.REJECT_MESSAGES[reason],
+                    }))
+                    continue
+                logger.info(f"接收到音频数据，开始处理...")
+                # 创建一个异步任务来处理音频，不阻塞WebSocket连接
+                track(pipeline.submit_audio(data))
+                continue
+
+            text = message.get("text")
+            if text is None:
+                continue
+            logger.debug(f"收到文本消息: {content_for_log(text)}")
             try:
-                # 先尝试接收文本消息（可能是ping）
-                message = await asyncio.wait_for(websocket.receive_text(), timeout=0.1)
-                logger.info(f"收到文本消息: {message}")
-                
+                data = json.loads(text)
+            except json.JSONDecodeError:
+                logger.warning(f"[{connection_id}] 忽略无法解析的文本消息")
+                continue
+            if not isinstance(data, dict):
+                continue
+
+            if data.get("type") == "ping":
                 # 如果是ping消息，回复pong
-                try:
-                    data = json.loads(message)
-                    if data.get("type") == "ping":
-                        await websocket.send_text(json.dumps({"type": "pong"}))
-                        logger.info("回复pong消息")
-                except:
-                    pass
-                    
-                continue  # 继续等待下一条消息
-            except asyncio.TimeoutError:
-                # 如果不是文本消息，尝试接收二进制数据
-                try:
-                    data = await websocket.receive_bytes()
-                    logger.info(f"接收到音频数据，开始处理...")
-                    
-                    # 创建一个异步任务来处理音频，不阻塞WebSocket连接
-                    task = asyncio.create_task(process_and_send_result(websocket, data))
-                    processing_tasks.append(task)
-                    
-                    # 清理已完成的任务
-                    processing_tasks = [t for t in processing_tasks if not t.done()]
-                    
-                except:
-                    # 如果没有收到任何消息，继续等待
-                    await asyncio.sleep(0.1)
-                    continue
+                await websocket.send_text(json.dumps({"type": "pong"}))
+                logger.debug("回复pong消息")
+            elif data.get("type") == "tts":
+                # 开启或关闭语音播报，回复实际状态（未配置合成引擎时始终为关闭）
+                pipeline.speak = bool(data.get("enabled")) and tts_engine is not None
+                await websocket.send_text(json.dumps({"type": "tts", "enabled": pipeline.speak}))
+            elif data.get("type") == "profile":
+                # 选择识别档位（fast/balanced/accurate），回复实际使用的档位
+                name = data.get("name")
+                if name in ASR_PROFILES:
+                    pipeline.asr_profile = name
+                elif name:
+                    logger.warning(f"[{connection_id}] 忽略未知的识别档位: {name}")
+                await websocket.send_text(json.dumps({
+                    "type": "profile",
+                    "name": pipeline.asr_profile or ASR_PROFILE,
+                    "available": list(ASR_PROFILES),
+                }))
+            elif data.get("type") == "start_stream":
+                # 进入流式模式，之后的二进制消息都是16kHz int16 PCM帧
+                if session.streaming is None:
+                    session.streaming = StreamingSession(session, connection_id, pipeline)
+                    logger.info(f"[{connection_id}] 进入流式识别模式")
+            elif data.get("type") == "end_stream":
+                # 结束流式模式，确认剩余音频
+                if session.streaming is not None:
+                    track(asyncio.create_task(session.streaming.finish()))
+                    session.streaming = None
+                    logger.info(f"[{connection_id}] 退出流式识别模式")
+    except WebSocketDisconnect as e:
+        logger.info(f"[{connection_id}] 客户端断开连接 (code={e.code})")
     except Exception as e:
-        logger.error(f"WebSocket连接关闭: {e}")
+        logger.error(f"WebSocket连接异常关闭: {e}")
         import traceback
         logger.error(traceback.format_exc())
     finally:
-        # 等待所有处理任务完成
-        if processing_tasks:
-            logger.info(f"等待 {len(processing_tasks)} 个处理任务完成...")
-            await asyncio.gather(*processing_tasks, return_exceptions=True)
+        # 流式识别的音频流已中断，丢弃未确认的尾部；已提交的任务由会话保留，结果在恢复后补发
+        # （会话已被新连接接管时流式识别会话归新连接所有）
+        if session.streaming is not None and session.websocket is websocket:
+            for task in await session.streaming.close():
+                track(task)
+            session.streaming = None
+        await session.detach(websocket)
+        await admission.release()
+        ACTIVE_CONNECTIONS.dec()
+        logger.info(f"连接已关闭: {connection_id}")
 
-async def process_and_send_result(websocket, audio_data):
-    """异步处理音频并发送结果"""
-    try:
-        # 使用Whisper识别语音
-        text = await process_audio_with_whisper(audio_data)
+class UtterancePipeline:
+    """
+    单个连接的分阶段处理流水线：解码 → 识别 → 大模型 → 发送
 
-        if not text:
-            # 如果识别结果为空，不发送给大模型，直接告知用户
-            logger.warning("语音识别结果为空，不调用大模型。")
-            user_message = {
-                "type": "message",
-                "role": "user",
-                "content": "(未能识别语音)" # 或者保持原来的 text = "未能识别语音，请重试"
-            }
-            await websocket.send_text(json.dumps(user_message))
-            bot_message = {
-                "type": "message",
-                "role": "assistant",
-                "content": "抱歉，我没有听清您说什么，请再说一遍。"
-            }
-            await websocket.send_text(json.dumps(bot_message))
-            return
+    每段语音按到达顺序分配序号 seq。解码、VAD和识别阶段不等待前面的语音，
+    可以与前一段语音的大模型阶段重叠进行；大模型和发送阶段则按序号依次执行，
+    后到的语音即使先识别完成也要等前一段的回复发送完毕。这样回复顺序与说话顺序一致，
+    每轮请求也都能带上前一轮的对话历史。发给客户端的消息都携带 seq 字段。
+    """
+
+    def __init__(self, websocket, connection_id, conversation=None):
+        self.websocket = websocket
+        self.connection_id = connection_id
+        self.conversation = conversation
+        self.next_seq = 0
+        self.last_turn = None  # 上一段语音的完成信号
+        self.speak = False  # 客户端是否开启了语音播报
+        self.asr_profile = None  # 客户端选择的识别档位，None 表示服务端默认
+        self.inflight = 0  # 尚未处理完的语音段数
+        self.buffered = {}  # seq -> 仍在内存中的音频字节数（原始数据和解码结果），识别完成后释放
+        self.dedup_scopes = (connection_id,)  # 音频去重记录的会话范围，第一个用于登记
+
+    def _next_turn(self):
+        """分配序号，并取得前一段语音的完成信号"""
+        seq = self.next_seq
+        self.next_seq += 1
+        self.inflight += 1
+        previous = self.last_turn
+        done = asyncio.get_event_loop().create_future()
+        self.last_turn = done
+        return seq, previous, done
+
+    def submit_audio(self, audio_data):
+        """提交一段webm/opus音频，返回处理任务"""
+        seq, previous, done = self._next_turn()
+        self.buffered[seq] = len(audio_data)
+        return asyncio.create_task(self._run(seq, previous, done, audio_data=audio_data))
 
-        # 检查WebSocket是否仍然连接
+    def submit_text(self, text, speculation=None):
+        """
+        提交一段已识别的文本（流式模式的确认结果），返回处理任务
+
+        参数:
+            speculation (SpeculativeReply): 可选，针对这段语音提前发起的推测式调用
+        """
+        seq, previous, done = self._next_turn()
+        return asyncio.create_task(self._run(seq, previous, done, text=text, speculation=speculation))
+
+    def idle(self):
+        """之前提交的语音是否都已处理完毕（对话历史已是最新）"""
+        return self.last_turn is None or self.last_turn.done()
+
+    async def _run(self, seq, previous, done, audio_data=None, text=None, speculation=None):
+        utterance_id_var.set(f"{self.connection_id}-{seq}")
+        dedup = None  # 本段音频登记的去重条目，处理完成后写入结果
+        echo_user = audio_data is not None
         try:
-            logger.info("准备发送识别结果到客户端...")
+            busy = False
+            rejected = None  # 超出准入限制的原因
+            reused = None  # 重复音频复用的 (识别文本, 回复)
+            if audio_data is not None and audio_dedup is not None:
+                digest = audio_dedup.digest(audio_data)
+                original = audio_dedup.get(self.dedup_scopes, digest)
+                if original is not None:
+                    # 相同的音频已处理过或仍在处理（客户端重连后重发），等待并复用其结果
+                    reused = await asyncio.shield(original)
+                if reused is None:
+                    dedup = audio_dedup.register(self.dedup_scopes[0], digest)
+                else:
+                    AUDIO_DEDUP_HITS.inc()
+                    logger.info(f"[{self.connection_id}] 重复的音频，复用之前的识别结果和回复")
+                    text = reused[0]
+            if audio_data is not None and reused is None:
+                def on_decoded(nbytes):
+                    self.buffered[seq] = len(audio_data) + nbytes
 
-            # 发送语音识别结果
-            user_message = {
-                "type": "message",
-                "role": "user",
-                "content": text
-            }
-            await websocket.send_text(json.dumps(user_message))
-            logger.info(f"已发送识别结果到客户端: '{text}'")
+                # 解码、VAD、识别阶段：与前面语音的大模型阶段并行
+                try:
+                    text = await process_audio_with_whisper(
+                        audio_data, self.connection_id, self.asr_profile, on_decoded=on_decoded,
+                    )
+                except ASRBusyError as e:
+                    # 识别队列已满，告知客户端稍后再试（背压）
+                    logger.warning(f"[{self.connection_id}] {e}，丢弃本段音频")
+                    busy = True
+                except AudioRejectedError as e:
+                    rejected = e.args[0]
+                    AUDIO_REJECTED.inc(reason=rejected)
+                    logger.warning(f"[{self.connection_id}] 拒绝本段音频: {rejected}")
+            # 识别已完成，释放音频数据，等待大模型期间不再占用内存
+            audio_data = None
+            self.buffered.pop(seq, None)
 
-            # 调用通义千问大模型 (现在是流式处理)
-            bot_response = await call_tongyi_model(text)
+            # 大模型、发送阶段：等前一段语音处理完毕后再开始
+            if previous is not None:
+                await asyncio.shield(previous)
+            # 流式模式的确认结果已经通过 final 消息显示过，不再重复发送
+            reply = await self._respond(
+                seq, text, busy, echo_user=echo_user, speculation=speculation,
+                reply=reused[1] if reused is not None else None, rejected=rejected,
+            )
+            if dedup is not None and reply is not None:
+                dedup.set_result((text, reply))
+        finally:
+            if speculation is not None:
+                speculation.cancel()
+            if dedup is not None and not dedup.done():
+                dedup.set_result(None)
+            if not done.done():
+                done.set_result(None)
+            self.buffered.pop(seq, None)
+            self.inflight -= 1
 
-            # 发送AI回复
-            bot_message = {
-                "type": "message",
-                "role": "assistant",
-                "content": bot_response
-            }
-            await websocket.send_text(json.dumps(bot_message))
-            logger.info(f"已发送AI回复到客户端")
+    async def _send(self, message):
+        await self.websocket.send_text(json.dumps(message))
+
+    async def _respond(self, seq, text, busy, echo_user=True, speculation=None, reply=None, rejected=None):
+        """
+        按顺序发送识别结果，并调用大模型发送回复
+
+        参数:
+            reply (str): 可选，已有的回复（重复音频复用之前的结果），传入时不调用大模型
+            rejected (str): 可选，音频超出准入限制的原因，传入时只发送 rejected 消息
+
+        返回:
+            str: 成功生成并写入对话历史的回复；忙碌、静音、识别为空或调用失败时返回None
+        """
+        try:
+            if busy:
+                await self._send({
+                    "type": "busy",
+                    "seq": seq,
+                    "content": "服务器繁忙，本段语音未被处理，请稍后再说。"
+                })
+                return
+
+            if rejected is not None:
+                await self._send({
+                    "type": "rejected",
+                    "seq": seq,
+                    "reason": rejected,
+                    "content": AdmissionController.REJECT_MESSAGES[rejected],
+                })
+                return
+
+            if text is None:
+                # 整段静音：不识别也不调用大模型，只通知客户端结束等待
+                await self._send({"type": "silence", "seq": seq})
+                return
+
+            if not text:
+                # 如果识别结果为空，不发送给大模型，直接告知用户
+                logger.warning("语音识别结果为空，不调用大模型。")
+                await self._send({
+                    "type": "message",
+                    "seq": seq,
+                    "role": "user",
+                    "content": "(未能识别语音)" # 或者保持原来的 text = "未能识别语音，请重试"
+                })
+                await self._send({
+                    "type": "message",
+                    "seq": seq,
+                    "role": "assistant",
+                    "content": "抱歉，我没有听清您说什么，请再说一遍。"
+                })
+                return
+
+            # 检查WebSocket是否仍然连接
+            try:
+                logger.info("准备发送识别结果到客户端...")
+
+                # 发送语音识别结果
+                if echo_user:
+                    await self._send({
+                        "type": "message",
+                        "seq": seq,
+                        "role": "user",
+                        "content": text
+                    })
+                    logger.info("已发送识别结果到客户端")
+
+                # 调用通义千问大模型并发送AI回复
+                reply = await send_assistant_reply(
+                    self.websocket, text, self.conversation, seq, speculation, speak=self.speak, reply=reply,
+                )
+                # 大模型调用失败时返回的是提示语，不会写入对话历史
+                turns = self.conversation.turns if self.conversation is not None else None
+                if turns and turns[-1][0]["content"] == text and turns[-1][1]["content"] == reply:
+                    return reply
+
+            except Exception as e:
+                await send_reply_error(self.websocket, e, seq)
 
         except Exception as e:
-            logger.error(f"发送结果失败: {e}")
+            logger.error(f"处理音频失败: {e}")
             # 可以在这里向客户端发送错误消息
             error_message = {
                 "type": "message",
+                "seq": seq,
                 "role": "assistant",
-                "content": "抱歉，处理您的请求时发生错误。"
+                "content": "抱歉，处理音频时发生错误。"
             }
             try:
-                await websocket.send_text(json.dumps(error_message))
+                await self._send(error_message)
             except Exception as send_error:
                 logger.error(f"向客户端发送错误消息失败: {send_error}")
 
-    except Exception as e:
-        logger.error(f"处理音频失败: {e}")
-        # 可以在这里向客户端发送错误消息
-        error_message = {
-            "type": "message",
-            "role": "assistant",
-            "content": "抱歉，处理音频时发生错误。"
+
+async def send_assistant_reply(websocket, text, conversation=None, seq=None, speculation=None, speak=False, reply=None):
+    """
+    调用通义千问大模型，并将回复逐段转发给客户端
+
+    每收到一段增量内容就发送 {"type": "delta"} 消息，生成结束后发送带完整回复的
+    {"type": "done"} 消息。同一次回复的消息携带相同的 id，便于客户端区分并发的回复。
+    传入的推测式调用与 text 足够相似时直接采用其结果，否则取消后重新调用。
+    传入 reply 时不调用大模型，直接发送该回复并写入对话历史。
+    speak 为True且配置了语音合成引擎时，回复同时按句合成语音发送，全部发送完毕后才返回。
+
+    返回:
+        str: 发送的完整回复
+    """
+    reply_id = uuid.uuid4().hex[:8]
+    tts = TTSStream(websocket, tts_engine, reply_id, seq) if speak and tts_engine is not None else None
+
+    async def forward_delta(content):
+        await websocket.send_text(json.dumps({"type": "delta", "id": reply_id, "seq": seq, "content": content}))
+        if tts is not None:
+            tts.feed(content)
+
+    try:
+        if reply is not None:
+            bot_response = reply
+            await forward_delta(reply)
+            if conversation is not None:
+                conversation.add_turn(text, reply)
+        elif speculation is not None and speculation.matches(text):
+            bot_response = await speculation.adopt(forward_delta, text, conversation)
+        else:
+            if speculation is not None:
+                speculation.cancel()
+            # 调用通义千问大模型 (流式处理，增量内容实时转发)
+            bot_response = await call_tongyi_model(text, on_delta=forward_delta, conversation=conversation)
+
+        # 发送回复结束标记
+        done_message = {
+            "type": "done",
+            "id": reply_id,
+            "seq": seq,
+            "content": bot_response
         }
-        try:
-            await websocket.send_text(json.dumps(error_message))
-        except Exception as send_error:
-            logger.error(f"向客户端发送错误消息失败: {send_error}")
+        await websocket.send_text(json.dumps(done_message))
+    except BaseException:
+        if tts is not None:
+            tts.cancel()
+        raise
+    logger.info(f"已发送AI回复到客户端")
+
+    # 文本已全部发出，等待剩余句子的语音合成发送完毕，下一段回复的语音不会与本段交错
+    if tts is not None:
+        await tts.finish()
+    return bot_response
+
+async def send_reply_error(websocket, error, seq=None):
+    """发送结果失败时记录日志，并尽量告知客户端"""
+    STAGE_ERRORS.inc(stage="send")
+    logger.error(f"发送结果失败: {error}")
+    error_message = {
+        "type": "message",
+        "seq": seq,
+        "role": "assistant",
+        "content": "抱歉，处理您的请求时发生错误。"
+    }
+    try:
+        await websocket.send_text(json.dumps(error_message))
+    except Exception as send_error:
+        logger.error(f"向客户端发送错误消息失败: {send_error}")
+
+def detect_speech_segments(audio):
+    """
+    基于短时能量的语音活动检测（全部为NumPy向量化运算）
+
+    参数:
+        audio (np.ndarray): 16kHz float32 音频
+
+    返回:
+        list[tuple[int, int]]: 各语音段的起止采样位置（已包含前后余量）
+    """
+    frame = VAD_FRAME_MS * SAMPLE_RATE // 1000
+    n_frames = len(audio) // frame
+    if n_frames == 0:
+        return []
+    frames = audio[:n_frames * frame].reshape(n_frames, frame)
+    voiced = np.sqrt(np.mean(frames ** 2, axis=1)) >= VAD_ENERGY_THRESHOLD
+
+    # 找出连续语音帧的起止帧号
+    edges = np.diff(np.concatenate(([0], voiced.astype(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    if len(starts) == 0:
+        return []
+
+    # 合并停顿短于 VAD_MIN_SILENCE_MS 的相邻语音段
+    new_group = np.concatenate(([True], starts[1:] - ends[:-1] >= VAD_MIN_SILENCE_MS // VAD_FRAME_MS))
+    starts = starts[new_group]
+    ends = ends[np.concatenate((new_group[1:], [True]))]
+
+    # 丢弃过短的语音段（咔哒声、噪声等）
+    long_enough = ends - starts >= VAD_MIN_SPEECH_MS // VAD_FRAME_MS
+    starts, ends = starts[long_enough], ends[long_enough]
+
+    pad = VAD_PAD_MS * SAMPLE_RATE // 1000
+    return [
+        (max(0, int(start) * frame - pad), min(len(audio), int(end) * frame + pad))
+        for start, end in zip(starts, ends)
+    ]
+
+def trim_silence(audio):
+    """去掉首尾静音并压缩较长的停顿，没有语音时返回空数组"""
+    segments = detect_speech_segments(audio)
+    if not segments:
+        return audio[:0]
+    return np.concatenate([audio[start:end] for start, end in segments])
+
+def save_debug_audio(audio_data):
+    """将原始音频保存到调试文件（仅在 DEBUG_SAVE_AUDIO 开启时调用）"""
+    with open(DEBUG_AUDIO_PATH, "wb") as f:
+        f.write(audio_data)
+    logger.info(f"调试音频保存到: {DEBUG_AUDIO_PATH}")
+
+async def decode_audio_to_array(audio_data, max_seconds=None):
+    """
+    在内存中将 webm/opus 音频解码为 16kHz 单声道 float32 数组
+
+    通过 stdin/stdout 管道与 ffmpeg 交换数据，不落盘，也不阻塞事件循环。
+
+    参数:
+        audio_data (bytes): 从WebSocket接收的音频数据
+        max_seconds (float): 可选，最多解码的时长，超出部分由ffmpeg直接丢弃
 
+    返回:
+        np.ndarray: 取值范围 [-1, 1] 的 float32 音频采样
+    """
+    process = await asyncio.create_subprocess_exec(
+        FFMPEG_BINARY,
+        "-nostdin",
+        "-loglevel", "error",
+        "-threads", "0",
+        "-i", "pipe:0",
+        "-f", "s16le",
+        "-ac", "1",
+        "-acodec", "pcm_s16le",
+        "-ar", str(SAMPLE_RATE),
+        *(("-t", str(max_seconds)) if max_seconds else ()),
+        "pipe:1",
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    pcm, err = await process.communicate(input=audio_data)
+    if process.returncode != 0:
+        raise RuntimeError(f"ffmpeg解码失败: {err.decode(errors='ignore').strip()}")
+    return np.frombuffer(pcm, np.int16).astype(np.float32) / 32768.0
 
-async def process_audio_with_whisper(audio_data):
+async def process_audio_with_whisper(audio_data, connection_id, profile=None, on_decoded=None):
     """
     使用Whisper处理音频数据并返回识别的文本
     
     参数:
         audio_data (bytes): 从WebSocket接收的音频数据
+        connection_id (str): 所属连接，用于识别调度的公平性
+        profile (str): 识别档位，为空时使用服务端默认档位
+        on_decoded (callable): 可选，解码完成后以解码结果的字节数调用，用于统计内存占用
         
     返回:
-        str: 识别的文本
+        str | None: 识别的文本；VAD判定整段为静音时返回None
+
+    异常:
+        ASRBusyError: 识别队列已满
+        AudioRejectedError: 音频时长超过 MAX_AUDIO_SECONDS
     """
+    stage = "decode"
     try:
         logger.info(f"接收到音频数据，大小: {len(audio_data)} 字节")
         
-        # 创建临时文件来保存音频数据
-        with tempfile.NamedTemporaryFile(suffix='.webm', delete=False) as temp_audio:
-            temp_audio_path = temp_audio.name
-            
-            # 直接写入接收到的二进制数据
-            temp_audio.write(audio_data)
-            
-            logger.info(f"音频保存到临时文件: {temp_audio_path}")
-            
-            # 保存一份音频文件用于调试
-            debug_path = os.path.join(os.getcwd(), "debug_audio.webm")
-            with open(debug_path, "wb") as f:
-                f.write(audio_data)
-            logger.info(f"调试音频保存到: {debug_path}")
-        
-        # 使用线程池执行Whisper处理（避免阻塞事件循环）
         loop = asyncio.get_event_loop()
-        # 指定语言为中文
-        result = await loop.run_in_executor(None, lambda: model.transcribe(
-            temp_audio_path, 
-            language="zh"  # 明确指定语言为中文
-        ))
+
+        # 仅在配置开启时保存调试音频，并放到线程池中写盘
+        if DEBUG_SAVE_AUDIO:
+            loop.run_in_executor(None, save_debug_audio, audio_data)
+
+        # 在内存中解码为Whisper可直接使用的采样数组
+        started = time.perf_counter()
+        # 多解码一秒用于判断是否超长，超出部分不会进入内存
+        audio = await decode_audio_to_array(audio_data, MAX_AUDIO_SECONDS + 1)
+        STAGE_SECONDS.observe(time.perf_counter() - started, stage="decode")
+        logger.info(f"音频解码完成，时长: {len(audio) / SAMPLE_RATE:.2f}秒")
+        if len(audio) > MAX_AUDIO_SECONDS * SAMPLE_RATE:
+            raise AudioRejectedError("duration")
+        if on_decoded is not None:
+            on_decoded(audio.nbytes)
+
+        # 语音活动检测：静音段直接丢弃，有语音时去掉首尾静音
+        if VAD_ENABLED:
+            stage = "vad"
+            started = time.perf_counter()
+            audio = trim_silence(audio)
+            STAGE_SECONDS.observe(time.perf_counter() - started, stage="vad")
+            if audio.size == 0:
+                logger.info("未检测到语音，跳过识别")
+                return None
+            logger.info(f"VAD保留语音时长: {len(audio) / SAMPLE_RATE:.2f}秒")
+        elif audio.size == 0:
+            return ""
         
-        # 删除临时文件
-        os.unlink(temp_audio_path)
+        # 交给识别进程池处理（避免阻塞事件循环）
+        # 指定语言为中文
+        stage = "asr"
+        options = asr_profile_options(profile)
+        options["language"] = "zh"  # 明确指定语言为中文
+        text = await asr_scheduler.transcribe(connection_id, audio, **options)
         
         # 返回识别的文本
-        text = result["text"].strip()
-        logger.info(f"识别结果: '{text}'")
+        text = text.strip()
+        logger.info(f"识别结果: '{content_for_log(text)}'")
         return text
+    except (ASRBusyError, AudioRejectedError):
+        raise
     except Exception as e:
+        # 识别阶段的错误已由调度器计数
+        if stage != "asr":
+            STAGE_ERRORS.inc(stage=stage)
         logger.error(f"语音识别错误: {e}")
         import traceback
         logger.error(traceback.format_exc())
         return ""
 
+class StreamingSession:
+    """
+    流式识别会话（每个连接一个）
+
+    客户端持续发送16kHz单声道int16 PCM帧，服务端只保留尚未确认的尾部音频：
+    每积累 STREAM_STEP_MS 的新音频就重新识别一次尾部并推送 partial 消息；
+    VAD检测到自然停顿或尾部过长时确认该段结果，推送 final 消息并交给大模型回复，
+    已确认的文本作为后续识别的 prompt。
+    """
+
+    def __init__(self, websocket, connection_id, pipeline):
+        self.websocket = websocket
+        self.connection_id = connection_id
+        self.pipeline = pipeline
+        self.tail = np.zeros(0, dtype=np.float32)  # 尚未确认的音频
+        self.committed_text = ""  # 已确认的文本
+        self.last_partial = ""
+        self.pending_samples = 0  # 上次识别之后新到达的采样数
+        self.decode_task = None
+        self.reply_tasks = []
+        self.speculation = None  # 针对当前未确认文本的推测式大模型调用
+        self.closed = False
+        self.overflowing = False  # 尾部缓冲已满，正在丢弃新到达的帧
+
+    def feed(self, pcm_bytes):
+        """追加一帧PCM音频，必要时触发尾部重新识别；尾部缓冲已满时丢弃该帧"""
+        if self.closed:
+            return
+        if len(self.tail) + len(pcm_bytes) // 2 > STREAM_MAX_BUFFER_S * SAMPLE_RATE:
+            # 识别跟不上音频到达的速度：丢弃新帧而不是旧音频，正在识别的尾部与缓冲区保持对齐
+            STREAM_DROPPED_BYTES.inc(len(pcm_bytes))
+            if not self.overflowing:
+                self.overflowing = True
+                logger.warning(f"[{self.connection_id}] 流式尾部缓冲已满（{STREAM_MAX_BUFFER_S:.0f}秒），丢弃新到达的音频")
+            return
+        self.overflowing = False
+        samples = np.frombuffer(pcm_bytes, np.int16).astype(np.float32) / 32768.0
+        self.tail = np.concatenate((self.tail, samples))
+        self.pending_samples += len(samples)
+        self._maybe_decode()
+
+    async def finish(self):
+        """客户端结束流式发送：等待当前识别完成，确认剩余音频，并等待回复发送完毕"""
+        self.closed = True
+        if self.decode_task is not None:
+            await asyncio.gather(self.decode_task, return_exceptions=True)
+        if len(self.tail) > 0:
+            await self._decode(final=True)
+        self._cancel_speculation()
+        if self.reply_tasks:
+            await asyncio.gather(*self.reply_tasks, return_exceptions=True)
+
+    async def close(self):
+        """
+        连接断开：取消仍在进行的识别，丢弃未确认的尾部
+
+        返回:
+            list: 已确认语音段仍未完成的回复任务，由会话继续运行
+        """
+        self.closed = True
+        self._cancel_speculation()
+        if self.decode_task is not None and not self.decode_task.done():
+            self.decode_task.cancel()
+            await asyncio.gather(self.decode_task, return_exceptions=True)
+        return [task for task in self.reply_tasks if not task.done()]
+
+    def _maybe_decode(self):
+        # 同一会话同时只有一个识别任务，识别期间到达的音频留到下一轮
+        if self.decode_task is not None and not self.decode_task.done():
+            return
+        if self.pending_samples < STREAM_STEP_MS * SAMPLE_RATE // 1000:
+            return
+        self.decode_task = asyncio.create_task(self._decode())
+
+
+    def _cancel_speculation(self):
+        if self.speculation is not None:
+            self.speculation.cancel()
+            self.speculation = None
+
+    def _maybe_speculate(self, text, trailing_silence):
+        """识别结果与上一轮相同、且尾部已有短暂停顿时，提前调用大模型"""
+        if not SPECULATIVE_LLM or self.closed or not text or text != self.last_partial:
+            return
+        if trailing_silence < SPECULATIVE_PAUSE_MS * SAMPLE_RATE // 1000:
+            return
+        if self.speculation is not None:
+            if self.speculation.text == text:
+                return
+            self._cancel_speculation()
+        # 前面的回复还没结束时对话历史不完整，不做推测
+        if not self.pipeline.idle():
+            return
+        logger.info(f"[{self.connection_id}] 推测式调用大模型: '{content_for_log(text)}'")
+        self.speculation = SpeculativeReply(text, self.pipeline.conversation)
+
+    async def _send(self, message_type, content):
+        try:
+            await self.websocket.send_text(json.dumps({"type": message_type, "content": content}))
+        except Exception as e:
+            logger.error(f"[{self.connection_id}] 发送{message_type}消息失败: {e}")
+
+    async def _decode(self, final=False):
+        """对未确认的尾部音频重新识别一次"""
+        audio = self.tail
+        self.pending_samples = 0
+        silence_samples = STREAM_SILENCE_MS * SAMPLE_RATE // 1000
+        speech = audio
+        if VAD_ENABLED:
+            started = time.perf_counter()
+            segments = detect_speech_segments(audio)
+            STAGE_SECONDS.observe(time.perf_counter() - started, stage="vad")
+            if not segments:
+                # 尾部没有语音：不做识别，只保留最近一小段以免切掉刚开始的语音
+                self.tail = self.tail[max(0, len(audio) - silence_samples):]
+                self._cancel_speculation()
+                if self.last_partial:
+                    self.last_partial = ""
+                    await self._send("partial", "")
+                if not final and not self.closed:
+                    self.decode_task = None
+                    self._maybe_decode()
+                return
+            # 只识别首个语音段开始到最后一个语音段结束的部分
+            speech = audio[segments[0][0]:segments[-1][1]]
+            # 最后一个语音段之后的静音足够长，视为在自然停顿处断句
+            trailing_silence = len(audio) - segments[-1][1]
+            pause = trailing_silence >= silence_samples
+        else:
+            trailing_silence = 0
+            pause = False
+        options = asr_profile_options(self.pipeline.asr_profile)
+        options["language"] = "zh"
+        options["initial_prompt"] = self.committed_text[-STREAM_PROMPT_CHARS:] or None
+        try:
+            text = await asr_scheduler.transcribe(self.connection_id, speech, stream=True, **options)
+        except ASRBusyError as e:
+            # 队列已满时跳过本轮，等下一批音频到达再重试
+            logger.warning(f"[{self.connection_id}] {e}，跳过本轮流式识别")
+            if final:
+                await self._send("busy", "服务器繁忙，最后一段语音未被处理，请稍后再说。")
+            return
+        except Exception as e:
+            logger.error(f"[{self.connection_id}] 流式识别错误: {e}")
+            return
+        text = text.strip()
+
+        if final or pause or len(audio) >= STREAM_MAX_SEGMENT_S * SAMPLE_RATE:
+            # 确认本段：丢弃已识别的音频，保留识别期间新到达的部分
+            self.tail = self.tail[len(audio):]
+            self.last_partial = ""
+            speculation, self.speculation = self.speculation, None
+            if text:
+                self.committed_text += text
+                logger.info(f"[{self.connection_id}] 流式识别确认: '{content_for_log(text)}'")
+                await self._send("final", text)
+                self.reply_tasks = [t for t in self.reply_tasks if not t.done()]
+                self.reply_tasks.append(self.pipeline.submit_text(text, speculation))
+            elif speculation is not None:
+                speculation.cancel()
+        else:
+            self._maybe_speculate(text, trailing_silence)
+            if text and text != self.last_partial:
+                self.last_partial = text
+                await self._send("partial", text)
+
+        if not final and not self.closed:
+            self.decode_task = None
+            self._maybe_decode()
+
 if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host="127.0.0.1", port=8000)
\ No newline at end of file
+    if len(sys.argv) > 1 and sys.argv[1] == "asr-server":
+        # 独立的识别服务：python main.py asr-server [监听地址]，默认监听 ASR_BROKER_URL 中的第一个地址
+        listen = sys.argv[2] if len(sys.argv) > 2 else (ASR_BROKER_URLS[0] if ASR_BROKER_URLS else "unix:///tmp/voice-asr.sock")
+        asyncio.run(ASRBrokerServer(listen, create_local_asr_scheduler()).serve_forever())
+    else:
+        import uvicorn
+        # 超过该大小的消息在协议层直接断开连接，不会被整段读入内存；略大于上限的音频仍能收到拒绝原因
+        uvicorn.run(app, host="127.0.0.1", port=8000, ws_max_size=2 * MAX_AUDIO_BYTES)
\ No newline at end of file
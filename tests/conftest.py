@@ -0,0 +1,12 @@
+"""
+测试公共设置
+
+测试直接导入 main.py：需要安装 requirements.txt 中的依赖，但不需要 openai-whisper / torch
+（只有识别进程里的 WhisperBackend 才导入它们），也不需要大模型 API 密钥。
+"""
+import os
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+os.environ["LOG_FILE"] = ""  # 不写日志文件
@@ -0,0 +1,81 @@
+"""
+准入控制测试：连接数上限下的排队、拒绝与恢复会话，以及整段音频的大小、并发段数和内存预算检查
+"""
+import asyncio
+import types
+
+import pytest
+
+main = pytest.importorskip("main")
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.sent = []
+        self.close_code = None
+
+    async def send_text(self, text):
+        self.sent.append(text)
+
+    async def close(self, code=1000):
+        self.close_code = code
+
+
+def test_admission_queues_and_rejects(monkeypatch):
+    monkeypatch.setattr(main, "sessions", {})
+    monkeypatch.setattr(main, "ADMISSION_WAIT_S", 0.2)
+    monkeypatch.setattr(main, "ADMISSION_QUEUE_SIZE", 1)
+
+    async def scenario():
+        controller = main.AdmissionController(max_connections=1, memory_budget=1 << 20)
+        assert await controller.admit(FakeWebSocket())
+
+        # 满员时排队，有连接释放后获准
+        queued = FakeWebSocket()
+        waiter = asyncio.create_task(controller.admit(queued))
+        await asyncio.sleep(0.02)
+        assert controller.waiting == 1
+        overflow = FakeWebSocket()
+        assert not await controller.admit(overflow)  # 排队已满，立即拒绝
+        assert overflow.close_code == 1013
+        await controller.release()
+        assert await waiter
+        assert '"queued"' in queued.sent[0]
+
+        # 等待超时被拒绝；恢复会话不受限制
+        late = FakeWebSocket()
+        assert not await controller.admit(late)
+        assert late.close_code == 1013
+        assert await controller.admit(FakeWebSocket(), resume=True)
+        assert controller.connections == 2
+
+    asyncio.run(scenario())
+
+
+def test_admission_check_audio(monkeypatch):
+    monkeypatch.setattr(main, "sessions", {})
+    controller = main.AdmissionController(max_connections=10, memory_budget=1000)
+    session = types.SimpleNamespace(pipeline=types.SimpleNamespace(inflight=0))
+    assert controller.check_audio(session, 500) is None
+    assert controller.check_audio(session, 1001) == "memory"
+    assert controller.check_audio(session, main.MAX_AUDIO_BYTES + 1) == "size"
+    session.pipeline.inflight = main.MAX_INFLIGHT_UTTERANCES
+    assert controller.check_audio(session, 500) == "inflight"
+
+
+def test_admission_waits_for_memory_budget(monkeypatch):
+    buffered = types.SimpleNamespace(total=2000)
+    session = types.SimpleNamespace(buffered_bytes=lambda: {"total": buffered.total})
+    monkeypatch.setattr(main, "sessions", {"a": session})
+    monkeypatch.setattr(main, "ADMISSION_WAIT_S", 2.0)
+
+    async def scenario():
+        controller = main.AdmissionController(max_connections=10, memory_budget=1000)
+        waiter = asyncio.create_task(controller.admit(FakeWebSocket()))
+        await asyncio.sleep(0.1)
+        assert not waiter.done()  # 缓冲超出预算，新连接排队
+        buffered.total = 0  # 缓冲释放后，最多0.5秒内重新检查并放行
+        assert await asyncio.wait_for(waiter, 1.0)
+        assert controller.status()["connections"] == 1
+
+    asyncio.run(scenario())
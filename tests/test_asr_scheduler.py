@@ -0,0 +1,283 @@
+"""
+识别调度器测试：按连接轮询的公平调度、队列满时的背压、取消与停止、进程池损坏后的重建，以及跨连接合批
+
+识别进程池换成线程池，识别函数换成记录调用顺序的假函数，不加载模型。
+"""
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+import pytest
+
+main = pytest.importorskip("main")
+
+
+class FakeWorker:
+    """代替 _transcribe_batch_in_worker：按批记录音频编号；gate 未打开前阻塞（模拟正在识别）"""
+
+    def __init__(self):
+        self.batches = []
+        self.options = []
+        self.entered = threading.Event()
+        self.gate = threading.Event()
+        self.gate.set()
+        self.fail_next = None
+
+    def __call__(self, audios, options, stream=False):
+        self.entered.set()
+        self.gate.wait(5)
+        if self.fail_next is not None:
+            error, self.fail_next = self.fail_next, None
+            raise error
+        labels = [int(audio[0]) for audio in audios]
+        self.batches.append(labels)
+        self.options.append(options)
+        return [f"文本{label}" for label in labels]
+
+    @property
+    def order(self):
+        return [label for batch in self.batches for label in batch]
+
+
+def audio(label, seconds=1.0):
+    return np.full(int(seconds * main.SAMPLE_RATE), label, dtype=np.float32)
+
+
+@pytest.fixture
+def worker(monkeypatch):
+    worker = FakeWorker()
+    monkeypatch.setattr(main, "_transcribe_batch_in_worker", worker)
+    return worker
+
+
+def make_scheduler(monkeypatch, num_workers=1, max_queue=16, max_batch=1, batch_wait=0.0):
+    scheduler = main.ASRScheduler(
+        {"model": "tiny", "backend": "fake"}, num_workers, max_queue, max_batch=max_batch, batch_wait=batch_wait,
+    )
+    monkeypatch.setattr(scheduler, "_create_executor", lambda: ThreadPoolExecutor(num_workers))
+
+    async def warm_up(executor):
+        pass
+
+    monkeypatch.setattr(scheduler, "_warm_up", warm_up)
+    return scheduler
+
+
+async def wait_until(condition, timeout=2.0):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not condition():
+        assert loop.time() < deadline, "等待超时"
+        await asyncio.sleep(0.01)
+
+
+async def block_worker(scheduler, worker):
+    """提交一个任务占住唯一的识别线程，返回该任务"""
+    worker.gate.clear()
+    worker.entered.clear()
+    blocker = asyncio.create_task(scheduler.transcribe("blocker", audio(0)))
+    await wait_until(worker.entered.is_set)
+    return blocker
+
+
+def test_round_robin_between_connections(monkeypatch, worker):
+    async def scenario():
+        scheduler = make_scheduler(monkeypatch)
+        await scheduler.start()
+        assert scheduler.ready
+        blocker = await block_worker(scheduler, worker)
+
+        # 连接A一次提交4段，连接B随后提交1段：B不必等A的全部任务完成
+        jobs = [asyncio.create_task(scheduler.transcribe("A", audio(label))) for label in (1, 2, 3, 4)]
+        await asyncio.sleep(0)
+        jobs.append(asyncio.create_task(scheduler.transcribe("B", audio(10))))
+        await wait_until(lambda: scheduler.queue_depth() == 5)
+        worker.gate.set()
+        results = await asyncio.gather(blocker, *jobs)
+        assert results == ["文本0", "文本1", "文本2", "文本3", "文本4", "文本10"]
+        assert worker.order == [0, 1, 10, 2, 3, 4]
+        assert scheduler.queue_depth() == 0
+        await scheduler.stop()
+
+    asyncio.run(scenario())
+
+
+def test_rejects_when_queue_full(monkeypatch, worker):
+    async def scenario():
+        scheduler = make_scheduler(monkeypatch, max_queue=2)
+        await scheduler.start()
+        blocker = await block_worker(scheduler, worker)
+        queued = [asyncio.create_task(scheduler.transcribe("A", audio(label))) for label in (1, 2)]
+        await wait_until(lambda: scheduler.queue_depth() == 2)
+        with pytest.raises(main.ASRBusyError):
+            await scheduler.transcribe("B", audio(3))
+        worker.gate.set()
+        assert await asyncio.gather(blocker, *queued) == ["文本0", "文本1", "文本2"]
+        await scheduler.stop()
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_job_leaves_queue(monkeypatch, worker):
+    async def scenario():
+        scheduler = make_scheduler(monkeypatch)
+        await scheduler.start()
+        blocker = await block_worker(scheduler, worker)
+        cancelled = asyncio.create_task(scheduler.transcribe("A", audio(1)))
+        kept = asyncio.create_task(scheduler.transcribe("B", audio(2)))
+        await wait_until(lambda: scheduler.queue_depth() == 2)
+        cancelled.cancel()
+        await asyncio.gather(cancelled, return_exceptions=True)
+        assert scheduler.queue_depth() == 1
+        assert "A" not in scheduler.queues
+        worker.gate.set()
+        assert await asyncio.gather(blocker, kept) == ["文本0", "文本2"]
+        assert worker.order == [0, 2]
+        await scheduler.stop()
+
+    asyncio.run(scenario())
+
+
+def test_stop_fails_queued_jobs(monkeypatch, worker):
+    async def scenario():
+        scheduler = make_scheduler(monkeypatch)
+        await scheduler.start()
+        blocker = await block_worker(scheduler, worker)
+        queued = asyncio.create_task(scheduler.transcribe("A", audio(1)))
+        await wait_until(lambda: scheduler.queue_depth() == 1)
+        await scheduler.stop()
+        assert not scheduler.ready
+        with pytest.raises(RuntimeError):
+            await queued
+        worker.gate.set()
+        await asyncio.gather(blocker, return_exceptions=True)
+
+    asyncio.run(scenario())
+
+
+def test_broken_pool_is_rebuilt(monkeypatch, worker):
+    async def scenario():
+        scheduler = make_scheduler(monkeypatch)
+        await scheduler.start()
+        broken = scheduler.executor
+        worker.fail_next = BrokenProcessPool("识别进程异常退出")
+        with pytest.raises(BrokenProcessPool):
+            await scheduler.transcribe("A", audio(1))
+        # 受影响的任务以错误结束；重建完成前 ready 为False，之后的任务使用新的进程池
+        assert await scheduler.transcribe("A", audio(2)) == "文本2"
+        assert scheduler.ready
+        assert scheduler.executor is not broken
+        await scheduler.stop()
+
+    asyncio.run(scenario())
+
+
+def test_not_ready_while_rebuilding(monkeypatch, worker):
+    async def scenario():
+        scheduler = make_scheduler(monkeypatch)
+        rebuilding = asyncio.Event()
+        finish = asyncio.Event()
+        warm_ups = []
+
+        async def slow_warm_up(executor):
+            warm_ups.append(executor)
+            if len(warm_ups) > 1:  # 启动时的预热直接完成，只拖慢重建
+                rebuilding.set()
+                await finish.wait()
+
+        monkeypatch.setattr(scheduler, "_warm_up", slow_warm_up)
+        await scheduler.start()
+        worker.fail_next = BrokenProcessPool("识别进程异常退出")
+        failed = asyncio.create_task(scheduler.transcribe("A", audio(1)))
+        await asyncio.wait_for(rebuilding.wait(), 2)
+        assert not scheduler.ready
+        # 重建期间提交的任务排队等待，不会失败
+        waiting = asyncio.create_task(scheduler.transcribe("B", audio(2)))
+        await asyncio.sleep(0.05)
+        assert not waiting.done()
+        finish.set()
+        assert await waiting == "文本2"
+        assert scheduler.ready
+        with pytest.raises(BrokenProcessPool):
+            await failed
+        await scheduler.stop()
+
+    asyncio.run(scenario())
+
+
+def test_batches_jobs_across_connections(monkeypatch, worker):
+    async def scenario():
+        scheduler = make_scheduler(monkeypatch, max_batch=3, batch_wait=0.05)
+        await scheduler.start()
+        blocker = await block_worker(scheduler, worker)
+        jobs = [
+            asyncio.create_task(scheduler.transcribe(connection, audio(label), language="zh"))
+            for connection, label in (("A", 1), ("B", 2), ("C", 3), ("D", 4))
+        ]
+        await wait_until(lambda: scheduler.queue_depth() == 4)
+        worker.gate.set()
+        # 每批不超过 max_batch，结果按任务各自返回
+        assert await asyncio.gather(*jobs) == ["文本1", "文本2", "文本3", "文本4"]
+        await blocker
+        assert worker.batches == [[0], [1, 2, 3], [4]]
+        await scheduler.stop()
+
+    asyncio.run(scenario())
+
+
+def test_waits_for_batch_within_window(monkeypatch, worker):
+    async def scenario():
+        scheduler = make_scheduler(monkeypatch, max_batch=4, batch_wait=0.2)
+        await scheduler.start()
+        first = asyncio.create_task(scheduler.transcribe("A", audio(1)))
+        await asyncio.sleep(0.05)
+        second = asyncio.create_task(scheduler.transcribe("B", audio(2)))
+        assert await asyncio.gather(first, second) == ["文本1", "文本2"]
+        assert worker.batches == [[1, 2]]
+        await scheduler.stop()
+
+    asyncio.run(scenario())
+
+
+def test_different_options_not_batched(monkeypatch, worker):
+    async def scenario():
+        scheduler = make_scheduler(monkeypatch, max_batch=4, batch_wait=0.05)
+        await scheduler.start()
+        blocker = await block_worker(scheduler, worker)
+        jobs = [
+            asyncio.create_task(scheduler.transcribe("A", audio(1), language="zh")),
+            asyncio.create_task(scheduler.transcribe("B", audio(2), language="en")),
+            asyncio.create_task(scheduler.transcribe("C", audio(3), language="zh")),
+        ]
+        await wait_until(lambda: scheduler.queue_depth() == 3)
+        worker.gate.set()
+        assert await asyncio.gather(*jobs) == ["文本1", "文本2", "文本3"]
+        await blocker
+        assert worker.batches == [[0], [1, 3], [2]]
+        assert worker.options[1:] == [{"language": "zh"}, {"language": "en"}]
+        await scheduler.stop()
+
+    asyncio.run(scenario())
+
+
+def test_long_audio_not_batched(monkeypatch, worker):
+    async def scenario():
+        scheduler = make_scheduler(monkeypatch, max_batch=4, batch_wait=0.05)
+        await scheduler.start()
+        blocker = await block_worker(scheduler, worker)
+        # 超过30秒的音频需要分段识别，单独执行
+        jobs = [
+            asyncio.create_task(scheduler.transcribe("A", audio(1, seconds=31))),
+            asyncio.create_task(scheduler.transcribe("B", audio(2))),
+            asyncio.create_task(scheduler.transcribe("C", audio(3))),
+        ]
+        await wait_until(lambda: scheduler.queue_depth() == 3)
+        worker.gate.set()
+        assert await asyncio.gather(*jobs) == ["文本1", "文本2", "文本3"]
+        await blocker
+        assert worker.batches == [[0], [1], [2, 3]]
+        await scheduler.stop()
+
+    asyncio.run(scenario())
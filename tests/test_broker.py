@@ -0,0 +1,148 @@
+"""
+拆分部署测试：帧编解码、网关与识别服务之间的任务往返、忙碌与错误的传递，以及取消
+"""
+import asyncio
+
+import numpy as np
+import pytest
+
+main = pytest.importorskip("main")
+
+
+class FakeScheduler:
+    """代替识别服务端的 ASRScheduler：记录收到的任务；hold 为True时任务一直等待，直到被取消"""
+
+    def __init__(self):
+        self.ready = True
+        self.calls = []
+        self.cancelled = []
+        self.hold = False
+        self.error = None
+        self.started = asyncio.Event()
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        self.ready = False
+
+    def queue_depth(self):
+        return 0
+
+    async def transcribe(self, connection_id, audio, stream=False, **options):
+        self.calls.append((connection_id, audio, stream, options))
+        self.started.set()
+        if self.error is not None:
+            raise self.error
+        if self.hold:
+            try:
+                await asyncio.Event().wait()
+            except asyncio.CancelledError:
+                self.cancelled.append(connection_id)
+                raise
+        return f"识别了{len(audio)}个采样"
+
+
+async def wait_until(condition, timeout=2.0):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not condition():
+        assert loop.time() < deadline, "等待超时"
+        await asyncio.sleep(0.01)
+
+
+def run_with_broker(tmp_path, scenario):
+    """启动识别服务和连接它的网关调度器，执行 scenario(gateway, scheduler) 后全部关闭"""
+    address = f"unix://{tmp_path}/asr.sock"
+
+    async def run():
+        scheduler = FakeScheduler()
+        server = main.ASRBrokerServer(address, scheduler, status_interval=0.05)
+        serving = asyncio.create_task(server.serve_forever())
+        gateway = main.RemoteASRScheduler([address])
+        try:
+            await asyncio.wait_for(gateway.start(), 5)
+            await scenario(gateway, scheduler)
+        finally:
+            await gateway.stop()
+            serving.cancel()
+            await asyncio.gather(serving, return_exceptions=True)
+
+    asyncio.run(run())
+
+
+def test_frame_round_trip():
+    async def scenario():
+        reader = asyncio.StreamReader()
+        audio = np.arange(5, dtype=np.float32)
+        reader.feed_data(
+            main._encode_frame({"type": "transcribe", "id": "a", "options": {"language": "zh"}}, audio.tobytes())
+            + main._encode_frame({"type": "cancel", "id": "a"})
+        )
+        reader.feed_eof()
+        message, payload = await main._read_frame(reader)
+        assert message == {"type": "transcribe", "id": "a", "options": {"language": "zh"}}
+        assert np.array_equal(np.frombuffer(payload, dtype=np.float32), audio)
+        assert await main._read_frame(reader) == ({"type": "cancel", "id": "a"}, b"")
+        with pytest.raises(asyncio.IncompleteReadError):
+            await main._read_frame(reader)
+
+    asyncio.run(scenario())
+
+
+def test_parse_broker_address():
+    assert main._parse_broker_address("tcp://10.0.0.2:9000") == ("tcp", ("10.0.0.2", 9000))
+    assert main._parse_broker_address("tcp://:9000") == ("tcp", ("127.0.0.1", 9000))
+    assert main._parse_broker_address("unix:///run/asr.sock") == ("unix", ("/run/asr.sock",))
+    assert main._parse_broker_address("/run/asr.sock") == ("unix", ("/run/asr.sock",))
+
+
+def test_transcribe_through_broker(tmp_path):
+    async def scenario(gateway, scheduler):
+        audio = np.linspace(-1, 1, 1600, dtype=np.float32)
+        text = await gateway.transcribe("conn", audio, stream=True, language="zh")
+        assert text == "识别了1600个采样"
+        connection_id, received, stream, options = scheduler.calls[0]
+        # 连接标识加上网关前缀，多个网关的连接一起轮询
+        assert connection_id.endswith(":conn") and connection_id != "conn"
+        assert np.array_equal(received, audio)
+        assert stream is True and options == {"language": "zh"}
+        assert gateway.queue_depth() == 0
+
+    run_with_broker(tmp_path, scenario)
+
+
+def test_busy_and_errors_reach_gateway(tmp_path):
+    async def scenario(gateway, scheduler):
+        scheduler.error = main.ASRBusyError("识别队列已满")
+        with pytest.raises(main.ASRBusyError):
+            await gateway.transcribe("conn", np.zeros(10, dtype=np.float32))
+        scheduler.error = ValueError("解码失败")
+        with pytest.raises(RuntimeError, match="解码失败"):
+            await gateway.transcribe("conn", np.zeros(10, dtype=np.float32))
+
+    run_with_broker(tmp_path, scenario)
+
+
+def test_cancel_removes_job_on_broker(tmp_path):
+    async def scenario(gateway, scheduler):
+        scheduler.hold = True
+        task = asyncio.create_task(gateway.transcribe("conn", np.zeros(10, dtype=np.float32)))
+        await asyncio.wait_for(scheduler.started.wait(), 2)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        # 网关发出 cancel 消息，识别服务取消对应的任务
+        await wait_until(lambda: scheduler.cancelled)
+        assert scheduler.cancelled[0].endswith(":conn")
+        assert gateway.queue_depth() == 0
+
+    run_with_broker(tmp_path, scenario)
+
+
+def test_busy_without_ready_broker():
+    async def scenario():
+        gateway = main.RemoteASRScheduler(["unix:///nonexistent/asr.sock"])
+        with pytest.raises(main.ASRBusyError):
+            await gateway.transcribe("conn", np.zeros(10, dtype=np.float32))
+
+    asyncio.run(scenario())
@@ -0,0 +1,71 @@
+"""
+多轮对话测试：按token预算裁剪最早的轮次、历史消息的组装和副本隔离
+"""
+import pytest
+
+main = pytest.importorskip("main")
+
+
+@pytest.fixture(autouse=True)
+def char_tokens(monkeypatch):
+    """按字符数估算token，使预算计算可以预先算出"""
+    monkeypatch.setattr(main, "_tokenizer", None)
+
+
+def turn_tokens(prompt, reply):
+    return len(prompt) + len(reply) + 2 * main.Conversation.MESSAGE_OVERHEAD_TOKENS
+
+
+def test_messages_include_history_then_prompt():
+    conversation = main.Conversation(max_tokens=1000)
+    conversation.add_turn("你好", "你好！")
+    assert conversation.messages("再见") == [
+        {"role": "user", "content": "你好"},
+        {"role": "assistant", "content": "你好！"},
+        {"role": "user", "content": "再见"},
+    ]
+
+
+def test_oldest_turns_dropped_when_over_budget():
+    per_turn = turn_tokens("问题0", "回答0")
+    conversation = main.Conversation(max_tokens=per_turn * 3)
+    for i in range(5):
+        conversation.add_turn(f"问题{i}", f"回答{i}")
+    assert [user["content"] for user, _, _ in conversation.turns] == ["问题2", "问题3", "问题4"]
+    assert conversation.total_tokens == per_turn * 3
+
+
+def test_total_tokens_tracks_trimmed_history():
+    conversation = main.Conversation(max_tokens=100)
+    conversation.add_turn("短", "短")
+    conversation.add_turn("长" * 60, "长" * 30)
+    # 第二轮加入后超出预算，最早的一轮被丢弃
+    assert len(conversation.turns) == 1
+    assert conversation.total_tokens == turn_tokens("长" * 60, "长" * 30)
+
+    # 单轮本身超出预算时整段历史清空，请求只带本轮输入
+    conversation.add_turn("长" * 200, "长")
+    assert len(conversation.turns) == 0
+    assert conversation.total_tokens == 0
+    assert conversation.messages("你好") == [{"role": "user", "content": "你好"}]
+
+
+def test_copy_does_not_affect_original():
+    conversation = main.Conversation(max_tokens=1000)
+    conversation.add_turn("你好", "你好！")
+    snapshot = conversation.copy()
+    snapshot.add_turn("推测", "推测的回复")
+    assert len(conversation.turns) == 1
+    assert len(snapshot.turns) == 2
+    assert snapshot.total_tokens > conversation.total_tokens
+
+
+def test_count_tokens_uses_loaded_encoding(monkeypatch):
+    class Encoding:
+        def encode(self, text):
+            return text.split()
+
+    monkeypatch.setattr(main, "_tokenizer", Encoding())
+    assert main.count_tokens("one two three") == 3
+    monkeypatch.setattr(main, "_tokenizer", None)
+    assert main.count_tokens("one two three") == len("one two three")
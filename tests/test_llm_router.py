@@ -0,0 +1,254 @@
+"""
+大模型路由测试：对冲请求的胜负、取消时并发名额的归还、熔断与恢复
+
+大模型请求用假的 client.chat.completions.create 代替，不访问网络。
+"""
+import asyncio
+import time
+import types
+
+import pytest
+
+main = pytest.importorskip("main")
+
+
+# ---------------- 假的大模型客户端 ----------------
+
+def make_chunk(content):
+    return types.SimpleNamespace(
+        usage=None,
+        choices=[types.SimpleNamespace(delta=types.SimpleNamespace(content=content))],
+    )
+
+
+class FakeStream:
+    """按模型配置的首token延迟输出回复；fail 为True时在输出前抛出异常"""
+
+    def __init__(self, model, ttft, fail, close_delay):
+        self.model = model
+        self.ttft = ttft
+        self.fail = fail
+        self.close_delay = close_delay
+        self.closed = False
+
+    async def _generate(self):
+        await asyncio.sleep(self.ttft)
+        if self.fail:
+            raise RuntimeError(f"{self.model} 请求失败")
+        for content in ("来自", self.model):
+            yield make_chunk(content)
+
+    def __aiter__(self):
+        return self._generate()
+
+    async def close(self):
+        await asyncio.sleep(self.close_delay)
+        self.closed = True
+
+
+class FakeClient:
+    def __init__(self):
+        self.ttft = {}
+        self.failing = set()
+        self.close_delay = 0.0
+        self.calls = []
+        self.streams = []
+        self.chat = types.SimpleNamespace(completions=types.SimpleNamespace(create=self.create))
+
+    async def create(self, model, messages, **kwargs):
+        self.calls.append(model)
+        stream = FakeStream(model, self.ttft.get(model, 0.0), model in self.failing, self.close_delay)
+        self.streams.append(stream)
+        return stream
+
+
+@pytest.fixture
+def fake_client(monkeypatch):
+    client = FakeClient()
+    monkeypatch.setattr(main, "client", client)
+    monkeypatch.setattr(main, "LLM_HEDGE", True)
+    monkeypatch.setattr(main, "LLM_TTFT_SLO_MS", 100)
+    monkeypatch.setattr(main, "LLM_HEDGE_MIN_MS", 50)
+    monkeypatch.setattr(main, "LLM_FIRST_TOKEN_TIMEOUT", 1.0)
+    monkeypatch.setattr(main, "LLM_BREAKER_FAILURES", 2)
+    monkeypatch.setattr(main, "LLM_BREAKER_COOLDOWN_S", 0.2)
+    return client
+
+
+async def read_reply(router):
+    attempt = await router.open([{"role": "user", "content": "你好"}])
+    try:
+        reply = "".join([chunk.choices[0].delta.content async for chunk in attempt.chunks()])
+    finally:
+        await attempt.close()
+    return reply, attempt
+
+
+def assert_slots_free(router, max_concurrency):
+    assert router.in_flight == 0
+    assert router.slots._value == max_concurrency
+
+
+# ---------------- 大模型路由 ----------------
+
+def test_primary_wins_without_hedge(fake_client):
+    async def scenario():
+        router = main.LLMRouter("big", "small", 4)
+        fake_client.ttft.update(big=0.01, small=0.01)
+        reply, attempt = await read_reply(router)
+        assert reply == "来自big"
+        assert (attempt.model, attempt.role) == ("big", "primary")
+        assert fake_client.calls == ["big"]
+        assert_slots_free(router, 4)
+
+    asyncio.run(scenario())
+
+
+def test_hedge_wins_when_primary_is_slow(fake_client):
+    async def scenario():
+        router = main.LLMRouter("big", "small", 4)
+        fake_client.ttft.update(big=0.5, small=0.01)
+        reply, attempt = await read_reply(router)
+        assert reply == "来自small"
+        assert (attempt.model, attempt.role) == ("small", "hedge")
+        assert fake_client.calls == ["big", "small"]
+        # 落选的主模型请求被关闭，已等待的时间计入其首token统计
+        assert fake_client.streams[0].closed
+        assert router.health["big"].percentile(0.5) >= 0.05
+        assert_slots_free(router, 4)
+
+    asyncio.run(scenario())
+
+
+def test_hedge_loses_when_primary_answers_first(fake_client):
+    async def scenario():
+        router = main.LLMRouter("big", "small", 4)
+        fake_client.ttft.update(big=0.15, small=0.5)
+        reply, attempt = await read_reply(router)
+        assert reply == "来自big"
+        assert attempt.role == "primary"
+        assert fake_client.calls == ["big", "small"]
+        assert fake_client.streams[1].closed
+        assert_slots_free(router, 4)
+
+    asyncio.run(scenario())
+
+
+def test_no_hedge_without_free_slot(fake_client):
+    async def scenario():
+        router = main.LLMRouter("big", "small", 1)
+        fake_client.ttft.update(big=0.2, small=0.01)
+        reply, attempt = await read_reply(router)
+        assert reply == "来自big"
+        assert fake_client.calls == ["big"]
+        assert_slots_free(router, 1)
+
+    asyncio.run(scenario())
+
+
+def test_error_retries_other_model(fake_client):
+    async def scenario():
+        router = main.LLMRouter("big", "small", 4)
+        fake_client.failing.add("big")
+        reply, attempt = await read_reply(router)
+        assert reply == "来自small"
+        assert attempt.role == "retry"
+        assert router.health["big"].failures == 1
+        assert_slots_free(router, 4)
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("cancel_after", [0.02, 0.08, 0.3])
+def test_cancelled_open_releases_slots(fake_client, cancel_after):
+    async def scenario():
+        router = main.LLMRouter("big", "small", 2)
+        fake_client.ttft.update(big=0.5, small=0.5)
+        fake_client.close_delay = 0.05
+        task = asyncio.create_task(router.open([]))
+        await asyncio.sleep(cancel_after)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        assert_slots_free(router, 2)
+
+    asyncio.run(scenario())
+
+
+def test_cancel_while_closing_losers_releases_winner(fake_client):
+    async def scenario():
+        router = main.LLMRouter("big", "small", 2)
+        fake_client.ttft.update(big=0.5, small=0.01)
+        fake_client.close_delay = 0.2
+        task = asyncio.create_task(router.open([]))
+        # 对冲请求在约100ms时发出并很快胜出，随后开始关闭落选的主模型请求
+        await asyncio.sleep(0.15)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        assert task.cancelled()
+        assert_slots_free(router, 2)
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_close_releases_slot(fake_client):
+    async def scenario():
+        router = main.LLMRouter("big", "small", 2)
+        fake_client.ttft.update(big=0.01)
+        attempt = await router.open([])
+        attempt.stream.close_delay = 0.5
+        task = asyncio.create_task(attempt.close())
+        await asyncio.sleep(0.05)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        assert_slots_free(router, 2)
+        await attempt.close()  # 重复调用不会多归还名额
+        assert_slots_free(router, 2)
+
+    asyncio.run(scenario())
+
+
+def test_circuit_opens_and_closes(fake_client):
+    async def scenario():
+        router = main.LLMRouter("big", "small", 4)
+        fake_client.failing.add("big")
+        for _ in range(2):
+            reply, _ = await read_reply(router)
+            assert reply == "来自small"
+        assert not router.health["big"].available
+        assert router.candidates() == ["small"]
+        assert router.status()["models"]["big"]["circuit_open"]
+
+        # 熔断到期后放行试探请求，成功即解除熔断
+        await asyncio.sleep(0.25)
+        assert router.candidates() == ["big", "small"]
+        fake_client.failing.clear()
+        reply, attempt = await read_reply(router)
+        assert attempt.model == "big"
+        assert router.health["big"].failures == 0
+        assert not router.status()["models"]["big"]["circuit_open"]
+
+    asyncio.run(scenario())
+
+
+def test_half_open_failure_reopens_immediately(fake_client):
+    health = main.ModelHealth("big")
+    health.record_failure()
+    health.record_failure()
+    assert not health.available
+    health.open_until = time.monotonic() - 1  # 熔断到期
+    assert health.available
+    health.record_failure()
+    assert not health.available
+
+
+def test_all_models_open_raises_unavailable(fake_client):
+    async def scenario():
+        router = main.LLMRouter("big", "small", 4)
+        for health in router.health.values():
+            health.record_failure()
+            health.record_failure()
+        with pytest.raises(main.LLMUnavailableError):
+            await router.open([])
+        assert_slots_free(router, 4)
+
+    asyncio.run(scenario())
@@ -0,0 +1,100 @@
+"""
+单连接流水线测试：识别阶段并行、回复按说话顺序发送，且每轮都带上前一轮的对话历史
+"""
+import asyncio
+import json
+
+import pytest
+
+main = pytest.importorskip("main")
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.messages = []
+
+    async def send_text(self, text):
+        self.messages.append(json.loads(text))
+
+
+@pytest.fixture
+def fake_stages(monkeypatch):
+    """识别按音频内容给出的延迟完成；大模型记录每轮看到的历史并回显"""
+    asr_started = []
+    histories = []
+
+    async def fake_asr(audio_data, connection_id, profile=None, on_decoded=None):
+        text, delay = audio_data.decode().split(":")
+        asr_started.append(text)
+        await asyncio.sleep(float(delay))
+        return text
+
+    async def fake_llm(prompt, on_delta=None, conversation=None):
+        histories.append([m["content"] for m in conversation.messages(prompt)])
+        reply = f"回复{prompt}"
+        if on_delta is not None:
+            await on_delta(reply)
+        conversation.add_turn(prompt, reply)
+        return reply
+
+    monkeypatch.setattr(main, "process_audio_with_whisper", fake_asr)
+    monkeypatch.setattr(main, "call_tongyi_model", fake_llm)
+    monkeypatch.setattr(main, "audio_dedup", None)
+    return asr_started, histories
+
+
+def test_replies_follow_utterance_order(fake_stages):
+    asr_started, histories = fake_stages
+
+    async def scenario():
+        websocket = FakeWebSocket()
+        pipeline = main.UtterancePipeline(websocket, "conn", main.Conversation(max_tokens=1000))
+        # 第一段识别较慢，第二、三段先识别完成
+        tasks = [
+            pipeline.submit_audio(b"first:0.1"),
+            pipeline.submit_audio(b"second:0.01"),
+            pipeline.submit_audio(b"third:0"),
+        ]
+        await asyncio.sleep(0.05)
+        # 识别阶段不等待前面的语音
+        assert sorted(asr_started) == ["first", "second", "third"]
+        assert not tasks[0].done() and not tasks[1].done()
+        await asyncio.gather(*tasks)
+        assert pipeline.idle() and pipeline.inflight == 0 and pipeline.buffered == {}
+        return websocket.messages
+
+    messages = asyncio.run(scenario())
+    users = [(m["seq"], m["content"]) for m in messages if m.get("role") == "user"]
+    dones = [(m["seq"], m["content"]) for m in messages if m["type"] == "done"]
+    assert users == [(0, "first"), (1, "second"), (2, "third")]
+    assert dones == [(0, "回复first"), (1, "回复second"), (2, "回复third")]
+    # 每段的消息都在下一段开始发送之前发完
+    assert [m["seq"] for m in messages] == sorted(m["seq"] for m in messages)
+    assert histories == [
+        ["first"],
+        ["first", "回复first", "second"],
+        ["first", "回复first", "second", "回复second", "third"],
+    ]
+
+
+def test_failed_turn_does_not_block_later_ones(monkeypatch, fake_stages):
+    _, histories = fake_stages
+    llm = main.call_tongyi_model
+
+    async def failing_llm(prompt, on_delta=None, conversation=None):
+        if prompt == "first":
+            raise RuntimeError("大模型调用失败")
+        return await llm(prompt, on_delta, conversation)
+
+    monkeypatch.setattr(main, "call_tongyi_model", failing_llm)
+
+    async def scenario():
+        websocket = FakeWebSocket()
+        pipeline = main.UtterancePipeline(websocket, "conn", main.Conversation(max_tokens=1000))
+        await asyncio.gather(pipeline.submit_audio(b"first:0.02"), pipeline.submit_audio(b"second:0"))
+        return websocket.messages
+
+    messages = asyncio.run(scenario())
+    assert [m["seq"] for m in messages if m["type"] == "done"] == [1]
+    assert any(m["seq"] == 0 and m.get("content") == "抱歉，处理您的请求时发生错误。" for m in messages)
+    assert histories == [["second"]]
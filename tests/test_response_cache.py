@@ -0,0 +1,129 @@
+"""
+回复缓存测试：键的规范化、TTL、LRU淘汰、近似匹配、SQLite持久化，以及多轮对话不使用缓存
+"""
+import asyncio
+import time
+import types
+
+import pytest
+
+main = pytest.importorskip("main")
+
+
+def test_response_cache_normalizes_keys():
+    cache = main.ResponseCache(8, 60)
+    cache.put("今天天气怎么样？", "晴")
+    assert cache.get("今天 天气怎么样") == "晴"
+    assert cache.get("明天天气怎么样") is None
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_response_cache_expires_after_ttl():
+    cache = main.ResponseCache(8, 0.05)
+    cache.put("你好", "你好！")
+    assert cache.get("你好") == "你好！"
+    time.sleep(0.1)
+    assert cache.get("你好") is None
+    assert cache.stats()["size"] == 0
+
+
+def test_response_cache_evicts_least_recently_used():
+    cache = main.ResponseCache(2, 60)
+    cache.put("一", "1")
+    cache.put("二", "2")
+    assert cache.get("一") == "1"  # "二" 成为最久未使用的条目
+    cache.put("三", "3")
+    assert cache.get("二") is None
+    assert cache.get("一") == "1"
+    assert cache.get("三") == "3"
+
+
+def test_response_cache_similarity_match():
+    cache = main.ResponseCache(8, 60, similarity=0.8)
+    cache.put("请介绍一下北京的天气情况", "北京晴")
+    assert cache.get("请介绍一下北京的天气情况吧") == "北京晴"
+    assert cache.get("上海有什么好吃的") is None
+
+
+def test_response_cache_persists_to_sqlite(tmp_path):
+    path = str(tmp_path / "cache.db")
+
+    async def fill():
+        cache = main.ResponseCache(8, 60, path=path)
+        cache.put("你好", "你好！")
+        await asyncio.sleep(0.1)  # 写入在线程池中进行
+        cache.close()
+
+    asyncio.run(fill())
+    reloaded = main.ResponseCache(8, 60, path=path)
+    assert reloaded.get("你好") == "你好！"
+    reloaded.close()
+
+
+# ---------------- call_tongyi_model 与缓存 ----------------
+
+class FakeStream:
+    def __init__(self, reply):
+        self.reply = reply
+
+    async def _generate(self):
+        yield types.SimpleNamespace(
+            usage=None,
+            choices=[types.SimpleNamespace(delta=types.SimpleNamespace(content=self.reply))],
+        )
+
+    def __aiter__(self):
+        return self._generate()
+
+    async def close(self):
+        pass
+
+
+class FakeClient:
+    """回复中带上请求的消息条数，便于区分不同历史下的回复"""
+
+    def __init__(self):
+        self.calls = 0
+        self.chat = types.SimpleNamespace(completions=types.SimpleNamespace(create=self.create))
+
+    async def create(self, model, messages, **kwargs):
+        self.calls += 1
+        return FakeStream(f"回复{len(messages)}")
+
+
+@pytest.fixture
+def cached_llm(monkeypatch):
+    client = FakeClient()
+    monkeypatch.setattr(main, "client", client)
+    monkeypatch.setattr(main, "LLM_MODEL", "big")
+    monkeypatch.setattr(main, "llm_router", main.LLMRouter("big", "small", 4))
+    monkeypatch.setattr(main, "response_cache", main.ResponseCache(8, 60))
+    return client
+
+
+def test_first_turn_uses_cache(cached_llm):
+    async def scenario():
+        first = await main.call_tongyi_model("今天天气怎么样", conversation=main.Conversation())
+        second = await main.call_tongyi_model("今天天气怎么样", conversation=main.Conversation())
+        assert first == second == "回复1"
+        assert cached_llm.calls == 1
+
+    asyncio.run(scenario())
+
+
+def test_follow_up_questions_skip_cache(cached_llm):
+    async def scenario():
+        # 另一个用户的第一轮问答写入缓存
+        await main.call_tongyi_model("那明天呢", conversation=main.Conversation())
+        assert main.response_cache.stats()["size"] == 1
+
+        # 有历史的追问既不读取也不写入缓存，回复基于自己的历史生成
+        conversation = main.Conversation()
+        conversation.add_turn("今天天气怎么样", "晴")
+        reply = await main.call_tongyi_model("那明天呢", conversation=conversation)
+        assert reply == "回复3"
+        assert cached_llm.calls == 2
+        assert main.response_cache.get("那明天呢") == "回复1"
+
+    asyncio.run(scenario())
@@ -0,0 +1,160 @@
+"""
+会话测试：断开期间的待发队列与补发，以及按会话隔离的音频去重
+"""
+import asyncio
+import json
+
+import pytest
+
+main = pytest.importorskip("main")
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.messages = []
+        self.close_code = None
+
+    async def send_text(self, text):
+        self.messages.append(json.loads(text))
+
+    async def send_bytes(self, data):
+        self.messages.append(data)
+
+    async def close(self, code=1000):
+        self.close_code = code
+
+    def of_type(self, kind):
+        return [m for m in self.messages if isinstance(m, dict) and m.get("type") == kind]
+
+
+# ---------------- 待发队列 ----------------
+
+def test_outbox_replays_in_order_after_reconnect(monkeypatch):
+    monkeypatch.setattr(main, "sessions", {})
+    monkeypatch.setattr(main, "SESSION_OUTBOX_SIZE", 3)
+
+    async def scenario():
+        session = main.Session()
+        first = FakeWebSocket()
+        await session.attach(first, resumed=False)
+        await session.detach(first)
+        for i in range(5):
+            await session.send_text(json.dumps({"type": "delta", "n": i}))
+        assert session.dropped == 2  # 超出条数上限，丢弃最早的
+
+        second = FakeWebSocket()
+        assert await session.attach(second, resumed=True) == 3
+        info = second.messages[0]
+        assert (info["type"], info["id"], info["resumed"], info["dropped"]) == ("session", session.id, True, 2)
+        assert [m["n"] for m in second.messages[1:]] == [2, 3, 4]
+        assert session.outbox_bytes == 0
+
+        # 同一会话的新连接接管旧连接
+        third = FakeWebSocket()
+        await session.attach(third, resumed=True)
+        assert second.close_code == 4001
+        await session.close()
+        assert session.id not in main.sessions
+
+    asyncio.run(scenario())
+
+
+# ---------------- 音频去重 ----------------
+
+def test_audio_dedup_cache_lru_and_ttl():
+    async def scenario():
+        cache = main.AudioDedupCache(2, 0.05)
+        a, b, c = (main.AudioDedupCache.digest(data) for data in (b"a", b"b", b"c"))
+        future_a = cache.register("s1", a)
+        cache.register("s1", b)
+        assert cache.get(("s1",), a) is future_a
+        cache.register("s1", c)  # 容量为2，淘汰最久未使用的 b
+        assert cache.get(("s1",), b) is None
+        assert cache.get(("s1",), a) is future_a
+        await asyncio.sleep(0.1)
+        assert cache.get(("s1",), a) is None
+
+    asyncio.run(scenario())
+
+
+def test_audio_dedup_cache_is_scoped_to_session():
+    async def scenario():
+        cache = main.AudioDedupCache(8, 60)
+        digest = cache.digest(b"audio")
+        future = cache.register("s1", digest)
+        assert cache.get(("s2",), digest) is None
+        assert cache.get(("s2", "s1"), digest) is future  # 声明了前一个会话时可以复用
+
+    asyncio.run(scenario())
+
+
+@pytest.fixture
+def fake_pipeline(monkeypatch):
+    """识别固定返回同一句话，回复中带上本轮之前的对话轮数"""
+    calls = {"asr": 0, "llm": 0}
+
+    async def fake_asr(audio_data, connection_id, profile=None, on_decoded=None):
+        calls["asr"] += 1
+        return "那明天呢"
+
+    async def fake_llm(prompt, on_delta=None, conversation=None):
+        calls["llm"] += 1
+        reply = f"回复(历史{len(conversation.turns)}轮)"
+        if on_delta is not None:
+            await on_delta(reply)
+        conversation.add_turn(prompt, reply)
+        return reply
+
+    monkeypatch.setattr(main, "sessions", {})
+    monkeypatch.setattr(main, "audio_dedup", main.AudioDedupCache(16, 60))
+    monkeypatch.setattr(main, "process_audio_with_whisper", fake_asr)
+    monkeypatch.setattr(main, "call_tongyi_model", fake_llm)
+    return calls
+
+
+async def open_session(previous_id=None):
+    session = main.Session(previous_id=previous_id)
+    websocket = FakeWebSocket()
+    await session.attach(websocket, resumed=False)
+    return session, websocket
+
+
+def test_same_audio_from_another_session_is_not_reused(fake_pipeline):
+    async def scenario():
+        audio = b"same-bytes"
+        owner, _ = await open_session()
+        owner.conversation.add_turn("今天天气怎么样", "晴")
+        owner.conversation.add_turn("要带伞吗", "不用")
+        await owner.pipeline.submit_audio(audio)
+        assert owner.conversation.turns[-1][1]["content"] == "回复(历史2轮)"
+
+        # 另一个用户发送相同的音频：重新识别和调用大模型，回复只基于自己的历史
+        other, websocket = await open_session()
+        await other.pipeline.submit_audio(audio)
+        assert fake_pipeline == {"asr": 2, "llm": 2}
+        assert websocket.of_type("done")[0]["content"] == "回复(历史0轮)"
+        assert other.conversation.turns[-1][1]["content"] == "回复(历史0轮)"
+
+    asyncio.run(scenario())
+
+
+def test_resent_audio_after_failed_resume_is_reused(fake_pipeline):
+    async def scenario():
+        audio = b"resent-bytes"
+        original, _ = await open_session()
+        await original.pipeline.submit_audio(audio)
+        await original.close()  # 会话已失效
+
+        # 页面带着旧会话ID重连，得到新会话并重发没有收到结果的录音
+        successor, websocket = await open_session(previous_id=original.id)
+        await successor.pipeline.submit_audio(audio)
+        assert fake_pipeline == {"asr": 1, "llm": 1}
+        assert websocket.of_type("message")[0]["content"] == "那明天呢"
+        assert websocket.of_type("done")[0]["content"] == "回复(历史0轮)"
+        assert len(successor.conversation.turns) == 1
+
+        # 同一会话内的重复音频同样复用
+        await successor.pipeline.submit_audio(audio)
+        assert fake_pipeline == {"asr": 1, "llm": 1}
+
+    asyncio.run(scenario())
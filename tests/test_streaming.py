@@ -0,0 +1,182 @@
+"""
+流式识别测试：尾部在自然停顿或超长时确认、识别期间到达的音频保留到下一段、结束时确认剩余尾部
+"""
+import asyncio
+import json
+
+import numpy as np
+import pytest
+
+main = pytest.importorskip("main")
+
+
+def tone(seconds, amplitude=0.3):
+    t = np.arange(int(seconds * main.SAMPLE_RATE)) / main.SAMPLE_RATE
+    return (amplitude * np.sin(2 * np.pi * 220 * t)).astype(np.float32)
+
+
+def silence(seconds):
+    return np.zeros(int(seconds * main.SAMPLE_RATE), dtype=np.float32)
+
+
+def pcm(*parts):
+    return (np.concatenate(parts) * 32767).astype(np.int16).tobytes()
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.messages = []
+
+    async def send_text(self, text):
+        self.messages.append(json.loads(text))
+
+    def contents(self, kind):
+        return [m["content"] for m in self.messages if m["type"] == kind]
+
+
+class FakePipeline:
+    """只记录确认后交给大模型的文本"""
+
+    def __init__(self):
+        self.asr_profile = None
+        self.conversation = None
+        self.texts = []
+
+    def idle(self):
+        return True
+
+    def submit_text(self, text, speculation=None):
+        self.texts.append(text)
+        return asyncio.create_task(asyncio.sleep(0))
+
+
+class FakeScheduler:
+    """按顺序返回预设的识别结果；gate 未打开前识别一直等待"""
+
+    def __init__(self, texts):
+        self.texts = list(texts)
+        self.calls = []
+        self.gate = asyncio.Event()
+        self.gate.set()
+
+    async def transcribe(self, connection_id, audio, stream=False, **options):
+        self.calls.append((len(audio), stream, options))
+        await self.gate.wait()
+        return self.texts.pop(0)
+
+
+@pytest.fixture(autouse=True)
+def stream_config(monkeypatch):
+    monkeypatch.setattr(main, "VAD_ENABLED", True)
+    monkeypatch.setattr(main, "VAD_FRAME_MS", 30)
+    monkeypatch.setattr(main, "VAD_ENERGY_THRESHOLD", 0.01)
+    monkeypatch.setattr(main, "VAD_MIN_SPEECH_MS", 200)
+    monkeypatch.setattr(main, "VAD_MIN_SILENCE_MS", 300)
+    monkeypatch.setattr(main, "VAD_PAD_MS", 150)
+    monkeypatch.setattr(main, "STREAM_STEP_MS", 500)
+    monkeypatch.setattr(main, "STREAM_SILENCE_MS", 600)
+    monkeypatch.setattr(main, "STREAM_MAX_SEGMENT_S", 15)
+    monkeypatch.setattr(main, "SPECULATIVE_LLM", False)
+
+
+def start_stream(monkeypatch, texts):
+    scheduler = FakeScheduler(texts)
+    monkeypatch.setattr(main, "asr_scheduler", scheduler)
+    websocket = FakeWebSocket()
+    pipeline = FakePipeline()
+    return main.StreamingSession(websocket, "conn", pipeline), scheduler, websocket, pipeline
+
+
+async def settle(stream):
+    """等待当前这轮识别（及其触发的下一轮）结束"""
+    while stream.decode_task is not None and not stream.decode_task.done():
+        await stream.decode_task
+
+
+def test_tail_committed_at_pause(monkeypatch):
+    stream, scheduler, websocket, pipeline = start_stream(monkeypatch, ["你好", "你好", "再见", "再见"])
+
+    async def scenario():
+        stream.feed(pcm(tone(1.0)))
+        await settle(stream)
+        assert websocket.contents("partial") == ["你好"]
+        assert websocket.contents("final") == []
+
+        # 尾部静音超过 STREAM_SILENCE_MS：确认本段并交给大模型，已识别的音频被丢弃
+        stream.feed(pcm(silence(1.0)))
+        await settle(stream)
+        assert websocket.contents("final") == ["你好"]
+        assert pipeline.texts == ["你好"]
+        assert len(stream.tail) == 0 and stream.last_partial == ""
+
+        # 已确认的文本作为下一段识别的 prompt
+        stream.feed(pcm(tone(1.0)))
+        await settle(stream)
+        assert websocket.contents("partial") == ["你好", "再见"]
+        await stream.finish()
+
+    asyncio.run(scenario())
+    assert [options["initial_prompt"] for _, _, options in scheduler.calls] == [None, None, "你好", "你好"]
+    assert all(stream_flag for _, stream_flag, _ in scheduler.calls)
+    assert websocket.contents("final") == ["你好", "再见"]
+    assert pipeline.texts == ["你好", "再见"]
+
+
+def test_audio_arriving_during_decode_kept(monkeypatch):
+    stream, scheduler, websocket, pipeline = start_stream(monkeypatch, ["你好", "再见"])
+
+    async def scenario():
+        scheduler.gate.clear()
+        stream.feed(pcm(tone(1.0), silence(1.0)))
+        await asyncio.sleep(0.01)
+        assert scheduler.calls  # 正在识别
+        stream.feed(pcm(tone(0.3)))
+        scheduler.gate.set()
+        await settle(stream)
+        # 确认时只丢弃参与识别的音频，识别期间到达的0.3秒保留在尾部
+        assert websocket.contents("final") == ["你好"]
+        assert len(stream.tail) == int(0.3 * main.SAMPLE_RATE)
+
+        # 结束时不论是否停顿都确认剩余尾部
+        await stream.finish()
+        assert len(stream.tail) == 0
+
+    asyncio.run(scenario())
+    assert websocket.contents("final") == ["你好", "再见"]
+    assert pipeline.texts == ["你好", "再见"]
+
+
+def test_long_tail_force_committed(monkeypatch):
+    monkeypatch.setattr(main, "VAD_ENABLED", False)
+    monkeypatch.setattr(main, "STREAM_MAX_SEGMENT_S", 1)
+    stream, scheduler, websocket, pipeline = start_stream(monkeypatch, ["一二", "一二三四"])
+
+    async def scenario():
+        stream.feed(pcm(tone(0.6)))
+        await settle(stream)
+        assert websocket.contents("partial") == ["一二"]
+        # 没有停顿但尾部超过 STREAM_MAX_SEGMENT_S，强制确认
+        stream.feed(pcm(tone(0.6)))
+        await settle(stream)
+
+    asyncio.run(scenario())
+    assert websocket.contents("final") == ["一二三四"]
+    assert pipeline.texts == ["一二三四"]
+    assert len(stream.tail) == 0
+
+
+def test_finish_reports_busy(monkeypatch):
+    stream, scheduler, websocket, pipeline = start_stream(monkeypatch, [])
+
+    async def busy(connection_id, audio, stream=False, **options):
+        raise main.ASRBusyError("识别队列已满")
+
+    monkeypatch.setattr(scheduler, "transcribe", busy)
+
+    async def scenario():
+        stream.feed(pcm(tone(0.2)))  # 不足一个 STREAM_STEP_MS，只在结束时识别
+        await stream.finish()
+
+    asyncio.run(scenario())
+    assert websocket.contents("busy") == ["服务器繁忙，最后一段语音未被处理，请稍后再说。"]
+    assert pipeline.texts == []
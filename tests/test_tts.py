@@ -0,0 +1,84 @@
+"""
+语音合成测试：增量内容按句切分、长句在逗号处切开、合成失败跳过，以及音频消息格式
+"""
+import asyncio
+import json
+import struct
+
+import pytest
+
+main = pytest.importorskip("main")
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.messages = []
+
+    async def send_text(self, text):
+        self.messages.append(json.loads(text))
+
+    async def send_bytes(self, data):
+        (size,) = struct.unpack("!I", data[:4])
+        self.messages.append((json.loads(data[4:4 + size]), data[4 + size:]))
+
+
+class FakeEngine:
+    def __init__(self, fail=()):
+        self.fail = set(fail)
+
+    async def synthesize(self, text):
+        if text in self.fail:
+            raise RuntimeError("合成失败")
+        return f"WAV:{text}".encode()
+
+
+def speak(deltas, engine=None):
+    """把增量内容依次交给 TTSStream，返回发送的消息"""
+    async def scenario():
+        websocket = FakeWebSocket()
+        tts = main.TTSStream(websocket, engine or FakeEngine(), "r1", seq=3)
+        for delta in deltas:
+            tts.feed(delta)
+        await tts.finish()
+        return websocket.messages
+
+    return asyncio.run(scenario())
+
+
+def spoken(messages):
+    return [header["text"] for header, _ in messages[:-1]]
+
+
+def test_sentences_split_across_deltas():
+    messages = speak(["你好，", "世界。今天", "天气不错！", "还有"])
+    assert spoken(messages) == ["你好，世界。", "今天天气不错！", "还有"]
+    header, audio = messages[0]
+    assert (header["type"], header["id"], header["seq"], header["index"], header["format"]) == (
+        "audio", "r1", 3, 0, "wav",
+    )
+    assert audio == "WAV:你好，世界。".encode()
+    assert messages[-1] == {"type": "audio_end", "id": "r1", "seq": 3, "count": 3}
+
+
+def test_closing_quotes_stay_with_sentence():
+    assert spoken(speak(['他说“好的。”然后', "走了"])) == ["他说“好的。”", "然后走了"]
+
+
+def test_punctuation_only_fragments_skipped():
+    messages = speak(["好。", "。。", "！\n", "  "])
+    assert spoken(messages) == ["好。"]
+    assert messages[-1]["count"] == 1
+
+
+def test_long_sentence_cut_at_last_clause(monkeypatch):
+    monkeypatch.setattr(main, "TTS_MAX_SENTENCE_CHARS", 10)
+    # 没有句末标点时累积到上限才切，在最后一个逗号处切开；没有逗号时整段切出
+    assert spoken(speak(["一二三，四五，六七八九", "十"])) == ["一二三，四五，", "六七八九十"]
+    assert spoken(speak(["一二三四五六七八九十", "一"])) == ["一二三四五六七八九十", "一"]
+
+
+def test_failed_sentence_skipped():
+    messages = speak(["第一句。第二句。第三句。"], FakeEngine(fail={"第二句。"}))
+    assert spoken(messages) == ["第一句。", "第三句。"]
+    assert [header["index"] for header, _ in messages[:-1]] == [0, 1]
+    assert messages[-1]["count"] == 2
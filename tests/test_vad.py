@@ -0,0 +1,60 @@
+"""
+语音活动检测（VAD）测试：语音段检测、短停顿合并、噪声丢弃和静音裁剪
+"""
+import numpy as np
+import pytest
+
+main = pytest.importorskip("main")
+
+
+def tone(seconds, amplitude=0.3):
+    t = np.arange(int(seconds * main.SAMPLE_RATE)) / main.SAMPLE_RATE
+    return (amplitude * np.sin(2 * np.pi * 220 * t)).astype(np.float32)
+
+
+def silence(seconds):
+    return np.zeros(int(seconds * main.SAMPLE_RATE), dtype=np.float32)
+
+
+@pytest.fixture(autouse=True)
+def vad_config(monkeypatch):
+    """使用默认的VAD参数，不受环境变量影响"""
+    monkeypatch.setattr(main, "VAD_FRAME_MS", 30)
+    monkeypatch.setattr(main, "VAD_ENERGY_THRESHOLD", 0.01)
+    monkeypatch.setattr(main, "VAD_MIN_SPEECH_MS", 200)
+    monkeypatch.setattr(main, "VAD_MIN_SILENCE_MS", 300)
+    monkeypatch.setattr(main, "VAD_PAD_MS", 150)
+
+
+def test_detect_speech_segments_merges_short_pauses(monkeypatch):
+    monkeypatch.setattr(main, "VAD_PAD_MS", 0)
+    audio = np.concatenate([
+        silence(0.3), tone(0.6), silence(0.12), tone(0.6),  # 短停顿，合并为一段
+        silence(1.0), tone(0.06),  # 咔哒声，丢弃
+        silence(1.0), tone(0.6), silence(0.3),
+    ])
+    segments = main.detect_speech_segments(audio)
+    assert len(segments) == 2
+    (start1, end1), (start2, end2) = segments
+    rate = main.SAMPLE_RATE
+    assert abs(start1 / rate - 0.3) < 0.04 and abs(end1 / rate - 1.62) < 0.04
+    assert abs(start2 / rate - 3.68) < 0.04 and abs(end2 / rate - 4.28) < 0.04
+
+
+def test_detect_speech_segments_silence_and_padding():
+    assert main.detect_speech_segments(silence(1.0)) == []
+    assert main.detect_speech_segments(np.zeros(10, dtype=np.float32)) == []
+    audio = np.concatenate([silence(0.05), tone(0.6), silence(0.05)])
+    segments = main.detect_speech_segments(audio)
+    assert segments == [(0, len(audio))]  # 余量不超出音频边界
+
+
+def test_trim_silence_drops_leading_trailing_and_long_pauses(monkeypatch):
+    monkeypatch.setattr(main, "VAD_PAD_MS", 0)
+    speech = tone(0.6)
+    audio = np.concatenate([silence(1.0), speech, silence(2.0), speech, silence(1.0)])
+    trimmed = main.trim_silence(audio)
+    # 只剩两段语音（按帧对齐，误差在一帧以内）
+    frame = main.VAD_FRAME_MS * main.SAMPLE_RATE // 1000
+    assert abs(len(trimmed) - 2 * len(speech)) <= 2 * frame
+    assert len(main.trim_silence(silence(2.0))) == 0